@@ -4,39 +4,66 @@ from globals import *
 import interface
 import sys
 import os
-from dash import Dash, html, Input, Output, State, dcc, ctx
+from dash import Dash, html, Input, Output, State, dcc, ctx, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import pandas as pd
 import map
+import result_cache
+import cache_warmer
+import metrics
 
 interface_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code")
 sys.path.insert(0, interface_path)
 
 db = database.Database()
 iface = interface.Interface(db)
-i = map_interface.MapInterface(db)
+i = map_interface.MapInterface(db, result_cache=result_cache.ResultCache())
+# views warmed by the last run are in memory right away
+cache_warmer.load_snapshot(i, i.result_cache.fingerprint)
 app_map = map.Map(db)
 
-# for initialisation
-default_time_end = 10
-start_time = datetime.datetime(year=2013, month=6, day=1, hour=0)
-end_time = datetime.datetime(year=2013, month=6, day=default_time_end, hour=23)
+# for initialisation, the time controls cover the days in the data (day 1 is 2013-06-01)
+first_day, last_day = db.day_range()
+default_time_end = min(first_day + 9, last_day)
+start_time = day_start(first_day)
+end_time = day_end(default_time_end)
 init_time_dist = i.compute_current_tree("Salinity", 1, start_time, end_time, 1)
-rects, max_heat = i.get_rects_and_heat(8)
+rects, max_heat = i.get_rects_and_heat(default_region)
 app_map.render_heatmap(rects, max_heat, default_region)
-app_map.load_trajectories(0)
+app_map.load_trajectories(app_map.map.zoom)
+if warm_on_start:
+    cache_warmer.start(db, i.result_cache, [("Salinity", 1, start_time, end_time, 1)])
 
 
-def make_time_distribution(data):
+def day_marks(first, last):
+    # first day and the first day of every month
+    marks = {first: day_start(first).strftime("%d %b")}
+    for day in range(first + 1, last + 1):
+        if day_start(day).day == 1:
+            marks[day] = day_start(day).strftime("%d %b")
+    return marks
+
+
+def make_time_distribution(data, visible_area=False, approximate=False):
     fig = px.bar(data)
-    fig.update_layout(xaxis_title="Time", yaxis_title="Number of uncertainties", showlegend=False)
+    # one bar segment per sensor when comparing all sensors
+    show_legend = isinstance(data, pd.DataFrame) and len(data.columns) > 1
+    fig.update_layout(xaxis_title="Time", yaxis_title="Number of uncertainties", showlegend=show_legend, legend_title_text="Sensor")
+    if visible_area:
+        fig.update_layout(title="Visible area")
+    if approximate:
+        fig.update_layout(title="Estimated from a sample, refining")
     return fig
 
 
+global_distr = init_time_dist
 global_plot = make_time_distribution(init_time_dist)
+# view parameters of the approximate heatmap that is being refined, None if the shown heatmap is exact
+refining = None
 
 external_stylesheets = [dbc.themes.BOOTSTRAP]
 
@@ -48,6 +75,7 @@ app = Dash(
 )
 
 contra_time_distr = dcc.Graph(id="time_distr", animate=False)
+cell_threshold_curve = dcc.Graph(id="threshold_curve", animate=False)
 
 app.layout = html.Div(
     [
@@ -64,9 +92,10 @@ app.layout = html.Div(
                     },
                 ),
                 dcc.RangeSlider(
-                    1,
-                    30,
-                    value=[1, default_time_end],
+                    first_day,
+                    last_day,
+                    value=[first_day, default_time_end],
+                    marks=day_marks(first_day, last_day),
                     step=1,
                     id="slider_time_map",
                     allowCross=False,
@@ -90,6 +119,7 @@ app.layout = html.Div(
                         "DO": "Dissolved Oxygen (DO)",
                         "DOSat": "DO Saturation",
                         "DO_Anomaly": "DO Anomaly",
+                        all_sensors: "All sensors (threshold relative to each sensor's range)",
                     },
                     "Salinity",
                     id="dropdown_sensor_map",
@@ -103,7 +133,7 @@ app.layout = html.Div(
                         "text-decoration": "underline",
                     },
                 ),
-                dcc.Slider(value=1, id="distance", max=1, min=0),
+                dcc.Slider(value=min(1, max_distance_threshold), id="distance", max=max_distance_threshold, min=0),
                 html.P(
                     "Threshold:",
                     style={
@@ -131,6 +161,15 @@ app.layout = html.Div(
                         "text-decoration": "underline",
                     },
                 ),
+                dbc.Button("Play hour by hour", id="playback_button", color="secondary", size="sm"),
+                html.Span(id="playback_time", style={"margin-left": "20px"}),
+                dcc.Store(id="playback_frames"),
+                dcc.Interval(id="playback_interval", interval=1000 / playback_fps, disabled=True),
+                dbc.Switch(id="client_filter", label="Filter in the browser", value=False, style={"margin-top": "10px"}),
+                html.Span(id="client_filter_status"),
+                dcc.Store(id="client_table"),
+                html.Div(id="heatmap_status", style={"margin-top": "10px"}),
+                dcc.Store(id="refine_request"),
             ],
             style={
                 "margin-top": "50px",
@@ -159,6 +198,59 @@ app.layout = html.Div(
                 "margin": "auto",
                 "margin-top": "50px"
             }
+        ),
+        html.Div(
+            [
+                html.P("Uncertainties vs threshold in the clicked cell:",
+                       style={
+                           "font-weight": "bold",
+                           "text-decoration": "underline",
+                           "margin-bottom": "10px"
+                       },
+                       ),
+                cell_threshold_curve
+            ],
+            style={
+                "width": "80%",
+                "height": "40vh",
+                "margin": "auto",
+                "margin-top": "50px"
+            }
+        ),
+        html.Div(
+            [
+                html.P("Uncertainties in the clicked cell:",
+                       style={
+                           "font-weight": "bold",
+                           "text-decoration": "underline",
+                           "margin-bottom": "10px"
+                       },
+                       ),
+                html.Div(id="cell_panel")
+            ],
+            style={
+                "width": "80%",
+                "margin": "auto",
+                "margin-top": "50px"
+            }
+        ),
+        html.Div(
+            [
+                html.P("Neighbours of the clicked point:",
+                       style={
+                           "font-weight": "bold",
+                           "text-decoration": "underline",
+                           "margin-bottom": "10px"
+                       },
+                       ),
+                html.Div(id="neighbour_panel")
+            ],
+            style={
+                "width": "80%",
+                "margin": "auto",
+                "margin-top": "50px",
+                "margin-bottom": "50px"
+            }
         )
 
     ]
@@ -166,6 +258,7 @@ app.layout = html.Div(
 
 
 server = app.server
+metrics.register(server)
 
 
 @app.callback(
@@ -174,27 +267,21 @@ server = app.server
     Input("dropdown_sensor_map", "value"),
 )
 def update_max_threshold(sensor):
-    sensors = [
-        "Salinity",
-        "Temperature",
-        "CDOM",
-        "Chlorophyll",
-        "DO",
-        "DOSat",
-        "DO_Anomaly",
-    ]
-    maxs = [13.14, 5.87, 267.6, 54.688, 302.74237, 122.06771, 313.9831]
-    mins = [0.12, 0.06069784417908664, 2.694795877619763, 0.4561302076278833, 1.4704905987017072, 0.5743938969588057,
-            1.5104531916051702]
-    for j in range(len(sensors)):
-        if sensor == sensors[j]:
-            return maxs[j], mins[j]
+    for j in range(len(sensor_names)):
+        if sensor == sensor_names[j]:
+            return sensor_threshold_max[j], sensor_threshold_min[j]
     return 1, 0
 
 
+def approximation_status(approximation):
+    return f"Approximate heatmap from {approximation['sampled']:,} of {approximation['rows']:,} rows (± one standard error), refining…"
+
+
 @app.callback(
     Output("map", "children"),
     Output("time_distr", "figure"),
+    Output("refine_request", "data"),
+    Output("heatmap_status", "children"),
     [
         Input("threshold_input", "max"),
         Input("map", "zoom"),
@@ -203,26 +290,297 @@ def update_max_threshold(sensor):
         Input("distance", "value"),
         State("dropdown_sensor_map", "value"),
         Input("slider_time_map", "value"),
+        Input("client_table", "data"),
     ],
     prevent_initial_call=True,
 )
-def update_map(_, zoom, mbound, sensor_threshold, distance_threshold, sensor, time):
-    global global_plot
+def update_map(_, zoom, mbound, sensor_threshold, distance_threshold, sensor, time, client_table):
+    global global_plot, global_distr, refining
     trigger = ctx.triggered_id
 
-    if trigger in ("threshold_input", "dropdown_sensor_map", "slider_time_map", "distance"):
-        start_time = datetime.datetime(year=2013, month=6, day=time[0], hour=0)
-        end_time = datetime.datetime(year=2013, month=6, day=time[1], hour=23)
-        time_distr = i.compute_current_tree(sensor, sensor_threshold, start_time, end_time, distance_threshold)
-        rects, max_heat = i.get_rects_and_heat(zoom)
-        map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0])
-        global_plot = make_time_distribution(time_distr)
-        return app_map.render_heatmap(rects, max_heat, map_bounds), global_plot
-    if trigger == "map":
-        rects, max_heat = i.get_rects_and_heat(zoom)
+    metrics.count("update_map_calls_total", trigger=trigger)
+
+    # while the browser filters the rows of client_table the sliders need no server work
+    if client_table is not None:
+        if trigger in ("threshold_input", "distance", "slider_time_map"):
+            raise PreventUpdate
+        app_map.clear()
+        refining = None
+        return app_map.map.children, global_plot, dash.no_update, ""
+    if trigger == "client_table":
+        trigger = "map"
+
+    if trigger in ("threshold_input", "dropdown_sensor_map", "slider_time_map", "distance", "map"):
+        start_time = day_start(time[0])
+        end_time = day_end(time[1])
         map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0])
-        return app_map.render_heatmap(rects, max_heat, map_bounds), global_plot
-    return app_map.map.children, global_plot
+        if trigger != "map":
+            # request log of the cache warmer, panning and zooming do not change the view parameters
+            i.result_cache.record_request(sensor, sensor_threshold, start_time, end_time, distance_threshold)
+        # when zoomed in only the viewport is aggregated, panning recomputes once it leaves the aggregated area.
+        # Long intervals are first shown approximately, refine_map then computes the exact heatmap
+        with metrics.span("update_map_stage", stage="compute_current_tree"):
+            time_distr = i.compute_current_tree(sensor, sensor_threshold, start_time, end_time, distance_threshold, map_bounds, approximate=True)
+        with metrics.span("update_map_stage", stage="get_rects_and_heat"):
+            rects, max_heat, errors = i.get_rects_and_heat(map_bounds, errors=True)
+        view = (sensor, sensor_threshold, time[0], time[1], distance_threshold)
+        refine_request, status = dash.no_update, ""
+        if i.approximation is not None:
+            status = approximation_status(i.approximation)
+            # panning while the view is refined shows a new approximation without restarting the refinement
+            if refining != view:
+                refine_request = dict(zip(["sensor", "threshold", "first_day", "last_day", "distance"], view))
+            refining = view
+        else:
+            refining = None
+        if time_distr is not global_distr:
+            global_distr = time_distr
+            with metrics.span("update_map_stage", stage="time_distribution_figure"):
+                global_plot = make_time_distribution(time_distr, visible_area=i.extent is not None, approximate=i.approximation is not None)
+        # the clustering of the trajectory overlay follows the zoom
+        if app_map.trajectory_cut(zoom) != app_map.trajectory_cut(app_map.trajectory_zoom):
+            with metrics.span("update_map_stage", stage="load_trajectories"):
+                app_map.load_trajectories(zoom)
+        with metrics.span("update_map_stage", stage="render_heatmap"):
+            children = app_map.render_heatmap(rects, max_heat, map_bounds, errors)
+        metrics.count("heatmap_rectangles_total", len(app_map.heat_layer))
+        return children, global_plot, refine_request, status
+    return app_map.map.children, global_plot, dash.no_update, dash.no_update
+
+
+@app.callback(
+    Output("map", "children", allow_duplicate=True),
+    Output("time_distr", "figure", allow_duplicate=True),
+    Output("heatmap_status", "children", allow_duplicate=True),
+    Input("refine_request", "data"),
+    State("map", "bounds"),
+    prevent_initial_call=True,
+)
+def refine_map(request, mbound):
+    global global_plot, global_distr, refining
+    view = (request["sensor"], request["threshold"], request["first_day"], request["last_day"], request["distance"])
+    # the view changed since the approximation was shown
+    if refining != view:
+        raise PreventUpdate
+    start_time = day_start(view[2])
+    end_time = day_end(view[3])
+    map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0])
+    with metrics.span("refine_map_stage", stage="compute_current_tree"):
+        time_distr = i.compute_current_tree(view[0], view[1], start_time, end_time, view[4], map_bounds)
+    if refining != view:
+        raise PreventUpdate
+    refining = None
+    rects, max_heat = i.get_rects_and_heat(map_bounds)
+    global_distr = time_distr
+    global_plot = make_time_distribution(time_distr, visible_area=i.extent is not None)
+    with metrics.span("refine_map_stage", stage="render_heatmap"):
+        children = app_map.render_heatmap(rects, max_heat, map_bounds)
+    return children, global_plot, ""
+
+
+@app.callback(
+    Output("map", "children", allow_duplicate=True),
+    Input("threshold_input", "drag_value"),
+    Input("distance", "drag_value"),
+    State("threshold_input", "value"),
+    State("distance", "value"),
+    State("map", "bounds"),
+    State("dropdown_sensor_map", "value"),
+    State("slider_time_map", "value"),
+    State("client_table", "data"),
+    prevent_initial_call=True,
+)
+def preview_map(threshold_drag, distance_drag, sensor_threshold, distance_threshold, mbound, sensor, time, client_table):
+    if client_table is not None:
+        raise PreventUpdate
+    # live preview from the sweep histograms while dragging, the released value is handled by update_map
+    threshold_drag = sensor_threshold if threshold_drag is None else threshold_drag
+    distance_drag = distance_threshold if distance_drag is None else distance_drag
+    if (threshold_drag, distance_drag) == (sensor_threshold, distance_threshold):
+        raise PreventUpdate
+    start_time = day_start(time[0])
+    end_time = day_end(time[1])
+    map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0])
+    with metrics.span("preview_map_stage", stage="sweep_counts"):
+        preview = i.preview_rects_and_heat(sensor, threshold_drag, start_time, end_time, distance_drag, map_bounds)
+    if preview is None:
+        raise PreventUpdate
+    rects, max_heat = preview
+    with metrics.span("preview_map_stage", stage="render_heatmap"):
+        return app_map.render_heatmap(rects, max_heat, map_bounds)
+
+
+@app.callback(
+    Output("playback_frames", "data"),
+    Output("playback_interval", "disabled"),
+    Output("playback_interval", "n_intervals"),
+    Output("playback_button", "children"),
+    Output("map", "children", allow_duplicate=True),
+    Input("playback_button", "n_clicks"),
+    State("playback_interval", "disabled"),
+    State("dropdown_sensor_map", "value"),
+    State("threshold_input", "value"),
+    State("distance", "value"),
+    State("slider_time_map", "value"),
+    State("map", "bounds"),
+    prevent_initial_call=True,
+)
+def toggle_playback(_, stopped, sensor, sensor_threshold, distance_threshold, time, mbound):
+    # the frames of all hours are sent once, the interval steps through them on the client (assets/playback.js)
+    map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0]) if mbound else default_region
+    if not stopped:
+        rects, max_heat = i.get_rects_and_heat(map_bounds)
+        return None, True, 0, "Play hour by hour", app_map.render_heatmap(rects, max_heat, map_bounds)
+    with metrics.span("playback_stage", stage="playback_frames"):
+        frames = i.playback_frames(sensor, sensor_threshold, day_start(time[0]), day_end(time[1]), distance_threshold, map_bounds)
+    metrics.count("playback_frames_total", frames["hours"])
+    # the static heatmap is hidden while the playback runs
+    app_map.clear()
+    return frames, False, 0, "Stop playback", app_map.map.children
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="playback", function_name="frame"),
+    Output("playback_layer", "children"),
+    Output("playback_time", "children"),
+    Input("playback_interval", "n_intervals"),
+    Input("playback_frames", "data"),
+)
+
+
+@app.callback(
+    Output("client_table", "data"),
+    Output("client_filter_status", "children"),
+    Input("client_filter", "value"),
+    Input("dropdown_sensor_map", "value"),
+    Input("map", "bounds"),
+    State("client_table", "data"),
+    prevent_initial_call=True,
+)
+def update_client_table(enabled, sensor, mbound, client_table):
+    # the rows of all days are sent, so the time slider is filtered in the browser as well
+    if not enabled:
+        return None, ""
+    map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0]) if mbound else default_region
+    if client_table is not None and client_table["sensor"] == sensor and region_within(map_bounds, Region(*client_table["extent"])):
+        raise PreventUpdate
+    with metrics.span("client_table_stage", stage="client_table"):
+        table = i.client_table(sensor, day_start(first_day), day_end(last_day), map_bounds)
+    if table is None:
+        return None, f"The viewport has more than {client_table_rows} rows, zoom in to filter in the browser."
+    return table, ""
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="client_heatmap", function_name="filter"),
+    Output("client_layer", "children"),
+    Input("threshold_input", "value"),
+    Input("threshold_input", "drag_value"),
+    Input("distance", "value"),
+    Input("distance", "drag_value"),
+    Input("slider_time_map", "value"),
+    Input("slider_time_map", "drag_value"),
+    Input("client_table", "data"),
+)
+
+
+@app.callback(
+    Output("threshold_curve", "figure"),
+    Input("map", "clickData"),
+    Input("distance", "value"),
+    Input("slider_time_map", "value"),
+    State("dropdown_sensor_map", "value"),
+    prevent_initial_call=True,
+)
+def update_threshold_curve(click_data, distance_threshold, time, sensor):
+    if not click_data or "latlng" not in click_data:
+        raise PreventUpdate
+    start_time = day_start(time[0])
+    end_time = day_end(time[1])
+    latlng = click_data["latlng"]
+    curve = i.threshold_curve(sensor, latlng["lng"], latlng["lat"], start_time, end_time, distance_threshold)
+    if curve is None:
+        raise PreventUpdate
+    fig = px.line(x=curve[0], y=curve[1], line_shape="hv")
+    fig.update_layout(xaxis_title=f"{sensor} threshold", yaxis_title="Number of uncertainties")
+    return fig
+
+
+@app.callback(
+    Output("cell_panel", "children"),
+    Input("map", "clickData"),
+    Input("distance", "value"),
+    Input("threshold_input", "value"),
+    Input("slider_time_map", "value"),
+    State("dropdown_sensor_map", "value"),
+    State("map", "bounds"),
+    prevent_initial_call=True,
+)
+def update_cell_panel(click_data, distance_threshold, sensor_threshold, time, sensor, mbound):
+    if not click_data or "latlng" not in click_data:
+        raise PreventUpdate
+    latlng = click_data["latlng"]
+    map_bounds = Region(mbound[0][1], mbound[1][1], mbound[0][0], mbound[1][0]) if mbound else default_region
+    with metrics.span("cell_panel_stage", stage="cell_drilldown"):
+        result = i.cell_drilldown(
+            sensor, sensor_threshold, latlng["lng"], latlng["lat"], day_start(time[0]), day_end(time[1]), distance_threshold, map_bounds
+        )
+    if result is None:
+        return html.P("No uncertainties in the clicked cell.")
+    cell, rows = result
+    summary = html.P(
+        f"Cell {cell.y_min:.4f}..{cell.y_max:.4f} N, {cell.x_min:.4f}..{cell.x_max:.4f} E: {len(rows)} uncertainties "
+        f"of {rows.label.nunique()} trajectories"
+    )
+    shown = sensor_names if sensor == all_sensors else [sensor]
+    table = rows[["time", "label", "longitude", "latitude"] + shown].head(100).round(4)
+    table["time"] = table.time.dt.strftime("%Y-%m-%d %H:00")
+    table = table.rename(columns={"time": "Time", "label": "Label", "longitude": "Longitude", "latitude": "Latitude"})
+    return [summary, dbc.Table.from_dataframe(table, striped=True, bordered=True, size="sm")]
+
+
+@app.callback(
+    Output("neighbour_panel", "children"),
+    Input("map", "clickData"),
+    Input("distance", "value"),
+    Input("threshold_input", "value"),
+    Input("slider_time_map", "value"),
+    State("dropdown_sensor_map", "value"),
+    prevent_initial_call=True,
+)
+def update_neighbour_panel(click_data, distance_threshold, sensor_threshold, time, sensor):
+    if not click_data or "latlng" not in click_data:
+        raise PreventUpdate
+    if db.graph is None:
+        return html.P("No neighbour graph available, it is written by database.getddict().")
+    latlng = click_data["latlng"]
+    with metrics.span("neighbour_panel_stage", stage="clicked_neighbours"):
+        result = i.clicked_neighbours(
+            sensor, sensor_threshold, latlng["lng"], latlng["lat"], day_start(time[0]), day_end(time[1]), distance_threshold
+        )
+    if result is None:
+        return html.P("No trajectory point in the selected interval.")
+    (label, t, lon, lat), neighbours = result
+    summary = html.P(
+        f"Trajectory {label} at {t:%Y-%m-%d %H:00} ({lat:.4f}, {lon:.4f}): {len(neighbours)} neighbours within "
+        f"{distance_threshold} km, {int(neighbours.conflict.sum())} of them conflicting"
+    )
+    # conflicting partners first, the closest ones on top
+    table = neighbours.sort_values(["conflict", "distance"], ascending=[False, True], kind="mergesort").head(50).round(3)
+    table["conflict"] = table.conflict.map({True: "yes", False: ""})
+    table = table.rename(columns={"label": "Label", "distance": "Distance (km)", "conflict": "Conflict"})
+    return [summary, dbc.Table.from_dataframe(table, striped=True, bordered=True, size="sm")]
+
+
+@app.callback(
+    Output("slider_time", "min"),
+    Output("slider_time", "max"),
+    Output("slider_time", "marks"),
+    Input("slider_time", "id"),
+)
+def update_time_range(_):
+    # the slider of the overview page is defined without access to the data, it follows the days in the data
+    return first_day, last_day, day_marks(first_day, last_day)
 
 
 @app.callback(
@@ -237,16 +595,19 @@ def update_map(_, zoom, mbound, sensor_threshold, distance_threshold, sensor, ti
 def display_graphs(dropdown_sensor, slider_longitude, slider_latitude, slider_time, checkbox_unique):
     # Get data from UI input
     region = Region(*slider_longitude, *slider_latitude)
-    start_time = pd.Timestamp(year=2013, month=6, day=slider_time[0], hour=0)
-    end_time = pd.Timestamp(year=2013, month=6, day=slider_time[1], hour=23)
-    data = iface.get_graph_data(dropdown_sensor, region, start_time, end_time, checkbox_unique)
+    start_time = pd.Timestamp(day_start(slider_time[0]))
+    end_time = pd.Timestamp(day_end(slider_time[1]))
+    with metrics.span("display_graphs_stage", stage="get_graph_data"):
+        data = iface.get_graph_data(dropdown_sensor, region, start_time, end_time, checkbox_unique)
+    metrics.count("graph_data_rows_total", len(data))
 
     # Histogram for sensor value distribution
-    if checkbox_unique:
-        udata = data.drop_duplicates(subset=["label"])
-        fig_hist = px.histogram(udata, x=udata[dropdown_sensor], labels={"x": "Sensor Wert", "y": "Anzahl"})
-    else:
-        fig_hist = px.histogram(data, x=data[dropdown_sensor], labels={"x": "Sensor Wert", "y": "Anzahl"})
+    with metrics.span("display_graphs_stage", stage="histogram"):
+        if checkbox_unique:
+            udata = data.drop_duplicates(subset=["label"])
+            fig_hist = px.histogram(udata, x=udata[dropdown_sensor], labels={"x": "Sensor Wert", "y": "Anzahl"})
+        else:
+            fig_hist = px.histogram(data, x=data[dropdown_sensor], labels={"x": "Sensor Wert", "y": "Anzahl"})
 
     fig_hist.update_layout(
         xaxis_title=f"{dropdown_sensor} sensor value in {tuple(db.meta[db.meta.long_name == dropdown_sensor].units)[0]}",
@@ -254,9 +615,10 @@ def display_graphs(dropdown_sensor, slider_longitude, slider_latitude, slider_ti
     )
 
     # Time Overview Figure
-    groups = data[["time", dropdown_sensor]].groupby("time")
-    means = groups.mean().sort_values(by="time")
-    stdevs = groups.std().sort_values(by="time")[dropdown_sensor].fillna(0)
+    with metrics.span("display_graphs_stage", stage="time_aggregation"):
+        groups = data[["time", dropdown_sensor]].groupby("time")
+        means = groups.mean().sort_values(by="time")
+        stdevs = groups.std().sort_values(by="time")[dropdown_sensor].fillna(0)
 
     time_distr_fig = go.Figure()
     time_distr_fig.add_trace(
@@ -0,0 +1,37 @@
+/*
+Heatmap filtered in the browser: the rows of the viewport are sent once by the server (MapInterface.client_table),
+the threshold, distance and time sliders are applied here and the rows are counted per cell without a server round trip.
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    client_heatmap: {
+        filter: function (threshold, threshold_drag, distance, distance_drag, days, days_drag, table) {
+            // the dragged values follow the slider while it moves, the released values are used before the first drag
+            threshold = threshold_drag ?? threshold;
+            distance = distance_drag ?? distance;
+            days = days_drag ?? days;
+            if (!table || threshold === undefined || threshold === null || distance === undefined || distance === null || !days) {
+                return [];
+            }
+            const hour = window.heatmap.decode(table.hour, "<u2");
+            const cell = window.heatmap.decode(table.cell, "<u2");
+            const rmin = window.heatmap.decode(table.rmin, "<u2");
+            const rmax = window.heatmap.decode(table.rmax, "<u2");
+            const value = window.heatmap.decode(table.value, "<f4");
+            // Database.distance_selection, hour_bounds of day_start(days[0]) .. day_end(days[1])
+            const dthresh = distance / table.distance_unit;
+            const first = (days[0] - 1) * 24;
+            const last = (days[1] - 1) * 24 + 23;
+            const counts = new Uint32Array(table.bounds.length);
+            for (let i = 0; i < table.rows; i++) {
+                if (value[i] > threshold && rmin[i] <= dthresh && rmax[i] > dthresh && hour[i] >= first && hour[i] <= last) {
+                    counts[cell[i]]++;
+                }
+            }
+            let max_heat = 0;
+            for (let j = 0; j < counts.length; j++) {
+                max_heat = Math.max(max_heat, counts[j]);
+            }
+            return window.heatmap.rectangles(table.bounds, counts, 0, max_heat);
+        },
+    },
+});
@@ -0,0 +1,66 @@
+/*
+Helpers shared by the client-side heatmaps (playback.js, client_heatmap.js): decoding of the base64 arrays sent by
+MapInterface and the rectangles of Map.render_heatmap().
+*/
+window.heatmap = (function () {
+    // decoded arrays by base64 source, only the arrays of the last payload are kept
+    let cache = new Map();
+
+    const types = {
+        "<u2": [Uint16Array, (view, i) => view.getUint16(2 * i, true)],
+        "<f4": [Float32Array, (view, i) => view.getFloat32(4 * i, true)],
+    };
+
+    function decode(source, dtype) {
+        if (!cache.has(source)) {
+            const raw = atob(source);
+            const bytes = new Uint8Array(raw.length);
+            for (let i = 0; i < raw.length; i++) {
+                bytes[i] = raw.charCodeAt(i);
+            }
+            // little-endian like numpy "<u2" and "<f4"
+            const [Type, read] = types[dtype];
+            const view = new DataView(bytes.buffer);
+            const values = new Type(raw.length / Type.BYTES_PER_ELEMENT);
+            for (let i = 0; i < values.length; i++) {
+                values[i] = read(view, i);
+            }
+            if (cache.size > 8) {
+                cache = new Map();
+            }
+            cache.set(source, values);
+        }
+        return cache.get(source);
+    }
+
+    // colors of Map.render_heatmap()
+    function color(scale) {
+        const channel = (low, high) => Math.round(low * (1 - scale) + high * scale).toString(16).padStart(2, "0");
+        return "#" + channel(255, 240) + channel(237, 59) + channel(160, 32);
+    }
+
+    // Rectangle components of the cells with a count > 0, counts[offset + j] is the count of cell j
+    function rectangles(bounds, counts, offset, max_heat) {
+        max_heat = Math.max(1, max_heat);
+        const result = [];
+        for (let j = 0; j < bounds.length; j++) {
+            const count = counts[offset + j];
+            if (count > 0) {
+                result.push({
+                    namespace: "dash_leaflet",
+                    type: "Rectangle",
+                    props: {
+                        bounds: bounds[j],
+                        color: color(Math.min(1, count / max_heat)),
+                        opacity: 0.7,
+                        fillOpacity: 0.7,
+                        stroke: false,
+                    },
+                });
+            }
+        }
+        return result;
+    }
+
+    return {decode: decode, rectangles: rectangles};
+})();
@@ -0,0 +1,19 @@
+/*
+Hour-by-hour heatmap playback: the frames are sent once by the server (MapInterface.playback_frames)
+and every tick of the interval draws the next hour from them, without a server round trip.
+*/
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    playback: {
+        frame: function (n_intervals, frames) {
+            if (!frames || !frames.hours) {
+                return [[], ""];
+            }
+            const hour = (n_intervals || 0) % frames.hours;
+            const counts = window.heatmap.decode(frames.counts, "<u2");
+            const rectangles = window.heatmap.rectangles(frames.bounds, counts, hour * frames.bounds.length, frames.max);
+            const time = new Date(Date.parse(frames.start + "Z") + hour * 3600 * 1000);
+            const label = time.toISOString().slice(0, 13).replace("T", " ") + ":00";
+            return [rectangles, label + " (" + (hour + 1) + "/" + frames.hours + ")"];
+        },
+    },
+});
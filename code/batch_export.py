@@ -0,0 +1,230 @@
+import argparse
+import multiprocessing
+import struct
+import time
+import zlib
+import numpy
+import pandas
+from globals import *
+
+"""
+Headless batch export of contradiction heatmaps and time distributions for reports.
+The parameter grid sensors x thresholds x day windows is computed with Database and MapInterface (no Dash) on a process pool.
+The data is loaded once before the pool is started, the forked workers share it copy-on-write.
+
+Output in OUTPUT_DIR:
+    counts/<sensor>_t<threshold>_<window start>.parquet   contradictions per cell, columns level, cell, count
+    png/<sensor>_t<threshold>_<window start>.png          optional raster of one tree level (--png-level)
+    time_distributions.parquet                            columns sensor, threshold, window_start, series, time, count
+
+Thresholds are relative to the threshold range of each sensor (0 = minimal, 1 = maximal threshold), like for "All sensors".
+
+Usage: python batch_export.py OUTPUT_DIR [--sensors S ...] [--thresholds T ...] [--distance D] [--start 2013-06-01]
+                              [--end 2013-06-30] [--window-days 7] [--levels L ...] [--png-level L] [--workers N]
+"""
+
+# set in the parent before the pool is started (shared with forked workers) or loaded by each worker otherwise
+_db = None
+_mi = None
+_options = None
+
+
+def make_jobs(sensors, thresholds, start, end, window_days, distance):
+    """
+    Builds the parameter grid, the windows of one sensor and threshold are consecutive.
+
+    @return: List of tuples (sensor, relative threshold, absolute threshold, start_time, end_time, distance).
+    """
+    import map_interface
+
+    windows = []
+    day = start
+    while day <= end:
+        last = min(day + datetime.timedelta(days=window_days - 1), end)
+        windows.append((day, last.replace(hour=23)))
+        day = last + datetime.timedelta(days=1)
+    jobs = []
+    for sensor in sensors:
+        for relative in thresholds:
+            if sensor == all_sensors:
+                absolute = relative
+            else:
+                absolute = float(map_interface.MapInterface.relative_thresholds(relative)[sensor_names.index(sensor)])
+            for window_start, window_end in windows:
+                jobs.append((sensor, relative, absolute, window_start, window_end, distance))
+    return jobs
+
+
+def job_name(sensor, relative, window_start):
+    return f"{sensor.replace(' ', '_')}_t{relative:g}_{window_start:%Y%m%d}"
+
+
+def heat_colors(scale):
+    """Colors of render_heatmap() in map.py as RGB array for scales in [0, 1]"""
+    low = numpy.array([255, 237, 160], dtype=numpy.float64)
+    high = numpy.array([240, 59, 32], dtype=numpy.float64)
+    return numpy.round(low * (1 - scale[..., None]) + high * scale[..., None]).astype(numpy.uint8)
+
+
+def write_png(path, rgba):
+    """
+    Writes an RGBA image as PNG without any imaging library.
+
+    @param path: Output file.
+    @param rgba: uint8 array of shape (height, width, 4), row 0 is the top.
+    @return: None.
+    """
+    height, width, _ = rgba.shape
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    raw = numpy.concatenate([numpy.zeros((height, 1), dtype=numpy.uint8), rgba.reshape(height, width * 4)], axis=1)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def raster(layer, level):
+    """
+    Renders a layer as RGBA image with one pixel per cell of level, the area of interest is the whole image.
+    Cells that are shallower than level (leaves of sparse areas) cover several pixels.
+
+    @param layer: DataFrame with the columns cell, count.
+    @param level: Tree level of the layer.
+    @return: uint8 array of shape (2^level, 2^level, 4).
+    """
+    n = 2**level
+    image = numpy.zeros((n, n, 4), dtype=numpy.uint8)
+    if not len(layer):
+        return image
+    x_min, x_max, y_min, y_max = cell_bounds(layer.cell.values)
+    # pixel ranges, rows are counted from the north
+    x0 = numpy.round((x_min - lon_west) / default_region.w * n).astype(numpy.int64)
+    x1 = numpy.round((x_max - lon_west) / default_region.w * n).astype(numpy.int64)
+    y0 = numpy.round((lat_north - y_max) / default_region.h * n).astype(numpy.int64)
+    y1 = numpy.round((lat_north - y_min) / default_region.h * n).astype(numpy.int64)
+    counts = layer["count"].values
+    scale = numpy.minimum(counts / max(1, counts.max()), 1)
+    colors = heat_colors(scale)
+    for j in numpy.flatnonzero(counts > 0):
+        image[y0[j] : y1[j], x0[j] : x1[j], :3] = colors[j]
+        image[y0[j] : y1[j], x0[j] : x1[j], 3] = round(0.7 * 255)
+    return image
+
+
+def init_worker(options):
+    global _db, _mi, _options
+    import database
+    import map_interface
+
+    if _db is None:
+        _db = database.Database()
+    _mi = map_interface.MapInterface(_db)
+    _options = options
+
+
+def run_job(job):
+    """
+    Computes one heatmap and writes its per-level counts (and raster).
+
+    @param job: Tuple from make_jobs().
+    @return: Tuple (job, time distribution, number of cells written, seconds).
+    """
+    t0 = time.perf_counter()
+    sensor, relative, absolute, window_start, window_end, distance = job
+    distribution = _mi.compute_current_tree(sensor, absolute, window_start, window_end, distance)
+    name = job_name(sensor, relative, window_start)
+    levels = _options["levels"] if _options["levels"] else sorted(_mi.layers)
+    frames = []
+    for level in levels:
+        layer = _mi.layers.get(level)
+        if layer is not None and len(layer):
+            frames.append(pandas.DataFrame({"level": numpy.uint8(level), "cell": layer.cell.values, "count": layer["count"].values}))
+    counts = pandas.concat(frames, ignore_index=True) if frames else pandas.DataFrame({"level": [], "cell": [], "count": []})
+    counts.to_parquet(os.path.join(_options["output"], "counts", f"{name}.parquet"), index=False)
+    if _options["png_level"] is not None:
+        level = min(_options["png_level"], max(_mi.layers, default=0))
+        layer = _mi.layers.get(level, pandas.DataFrame({"cell": [], "count": []}))
+        write_png(os.path.join(_options["output"], "png", f"{name}.png"), raster(layer, level))
+    return job, distribution, len(counts), time.perf_counter() - t0
+
+
+def distribution_frame(job, distribution):
+    """Long format of a time distribution (Series or per-sensor DataFrame) of a job"""
+    sensor, relative, _, window_start, _, _ = job
+    if isinstance(distribution, pandas.Series):
+        distribution = distribution.to_frame(sensor)
+    frame = distribution.rename_axis("time").reset_index().melt(id_vars="time", var_name="series", value_name="count")
+    frame.insert(0, "window_start", pandas.Timestamp(window_start))
+    frame.insert(0, "threshold", relative)
+    frame.insert(0, "sensor", sensor)
+    return frame
+
+
+def export(jobs, options, workers):
+    """
+    Runs all jobs on a process pool and writes the time distributions.
+
+    @param jobs: List of jobs from make_jobs().
+    @param options: Dictionary with output, levels and png_level.
+    @param workers: Number of worker processes.
+    @return: None.
+    """
+    global _db
+    import database
+
+    os.makedirs(os.path.join(options["output"], "counts"), exist_ok=True)
+    if options["png_level"] is not None:
+        os.makedirs(os.path.join(options["output"], "png"), exist_ok=True)
+    methods = multiprocessing.get_all_start_methods()
+    if "fork" in methods:
+        # load once, the workers inherit the loaded data
+        t0 = time.time()
+        _db = database.Database()
+        print(f"Data loaded in {time.time()-t0:.02f}s")
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+
+    t0 = time.time()
+    distributions = []
+    with context.Pool(workers, initializer=init_worker, initargs=(options,)) as pool:
+        # chunks keep the windows of one sensor and threshold on one worker, which reuses its day cache
+        chunksize = max(1, min(8, len(jobs) // (4 * workers)))
+        for done, (job, distribution, cells, seconds) in enumerate(pool.imap_unordered(run_job, jobs, chunksize), 1):
+            distributions.append(distribution_frame(job, distribution))
+            elapsed = time.time() - t0
+            print(f"{done}/{len(jobs)} jobs, {done / elapsed:.2f} jobs/s ({job_name(job[0], job[1], job[3])}: {cells} cells, {seconds:.2f}s)")
+    if distributions:
+        pandas.concat(distributions, ignore_index=True).to_parquet(os.path.join(options["output"], "time_distributions.parquet"), index=False)
+    elapsed = time.time() - t0
+    print(f"{len(jobs)} jobs exported in {elapsed:.02f}s ({len(jobs) / max(elapsed, 1e-9):.2f} jobs/s) to {options['output']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export contradiction heatmaps and time distributions for a parameter grid")
+    parser.add_argument("output_dir")
+    parser.add_argument("--sensors", nargs="+", default=sensor_names, help=f"sensor names or '{all_sensors}'")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[0.1, 0.25, 0.5], help="relative thresholds in [0, 1]")
+    parser.add_argument("--distance", type=float, default=1.0, help="distance threshold in km")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2013, 6, 1))
+    parser.add_argument("--end", type=datetime.date.fromisoformat, default=datetime.date(2013, 6, 30))
+    parser.add_argument("--window-days", type=int, default=7)
+    parser.add_argument("--levels", nargs="+", type=int, help="tree levels to write, default all")
+    parser.add_argument("--png-level", type=int, help="write a PNG raster of this tree level per job")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # span logging of every job is not wanted here
+    os.environ.setdefault("OTV_METRICS", "0")
+    for sensor in args.sensors:
+        if sensor not in sensor_names and sensor != all_sensors:
+            parser.error(f"unknown sensor {sensor}")
+    start = datetime.datetime.combine(args.start, datetime.time())
+    end = datetime.datetime.combine(args.end, datetime.time())
+    jobs = make_jobs(args.sensors, args.thresholds, start, end, args.window_days, args.distance)
+    options = {"output": args.output_dir, "levels": args.levels, "png_level": args.png_level}
+    export(jobs, options, args.workers)
@@ -0,0 +1,214 @@
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import os
+
+"""
+Benchmark suite for the hot paths of the app and the preprocessing scripts.
+Runs on a synthetic dataset (see synthetic.py) so that it does not depend on the real data.
+Every run is written as a JSON file to the results directory, two runs can be compared with --compare.
+
+Usage:
+    python benchmark.py [--data DIR] [--labels N] [--hours H] [--repeat R] [--results DIR] [--skip-preprocessing]
+    python benchmark.py --compare OLD.json NEW.json [--tolerance 1.2]
+"""
+
+code_path = os.path.dirname(os.path.abspath(__file__))
+preprocessing_path = os.path.join(code_path, "preprocessing")
+default_results_path = os.path.join(os.path.split(code_path)[0], "bench_results")
+
+
+def measure(func, repeat=3):
+    """
+    Times func repeat times.
+
+    @param func: Function without arguments.
+    @param repeat: Number of runs.
+    @return: Dictionary with min, median and mean runtime in seconds.
+    """
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - t0)
+    return {"min": min(runs), "median": statistics.median(runs), "mean": statistics.mean(runs), "repeat": repeat}
+
+
+def run_script(args):
+    """Runs a preprocessing script in a fresh interpreter with the benchmark environment."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([code_path, preprocessing_path, env.get("PYTHONPATH", "")])
+    subprocess.run([sys.executable] + args, cwd=preprocessing_path, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def benchmark_app(repeat):
+    """Times the functions that are called by the Dash callbacks."""
+    # imported here, the data location has to be set in the environment first
+    import database
+    import interface
+    import map
+    import map_interface
+    from globals import Region, TimeSpan, Salinity, default_region
+
+    results = dict()
+    start_time = datetime.datetime(2013, 6, 1)
+    end_time = datetime.datetime(2013, 6, 10, 23)
+
+    results["Database.__init__"] = measure(database.Database, repeat)
+    db = database.Database()
+    results["Database.query"] = measure(lambda: db.query(timespan=TimeSpan(start_time, end_time)), repeat)
+    results["Database.query(contradictions)"] = measure(
+        lambda: db.query(timespan=TimeSpan(start_time, end_time), sensor=Salinity(), contradictions=True), repeat
+    )
+
+    def compute():
+        mi = map_interface.MapInterface(db)
+        mi.compute_current_tree("Salinity", 1, start_time, end_time, 1)
+
+    results["compute_current_tree"] = measure(compute, repeat)
+
+    def compute_viewport():
+        mi = map_interface.MapInterface(db)
+        mi.compute_current_tree("Salinity", 1, start_time, end_time, 1, Region(7.9, 8.1, 54.0, 54.1))
+
+    results["compute_current_tree(viewport)"] = measure(compute_viewport, repeat)
+    mi = map_interface.MapInterface(db)
+    mi.compute_current_tree("Salinity", 1, start_time, end_time, 1)
+    viewports = {"full": default_region, "zoomed": Region(7.9, 8.1, 54.0, 54.1)}
+    for name, viewport in viewports.items():
+        results[f"get_rects_and_heat({name})"] = measure(lambda: mi.get_rects_and_heat(viewport), repeat)
+
+    app_map = map.Map(db)
+    rects, max_heat = mi.get_rects_and_heat(viewports["zoomed"])
+    results["render_heatmap"] = measure(lambda: app_map.render_heatmap(rects, max_heat, default_region), repeat)
+    results["load_trajectories(clustered)"] = measure(lambda: app_map.load_trajectories(), repeat)
+    results["load_trajectories(all)"] = measure(lambda: app_map.load_trajectories(single=True), repeat)
+
+    iface = interface.Interface(db)
+    region = Region(7.2, 9.5, 53.5, 54.6)
+    results["get_graph_data"] = measure(lambda: iface.get_graph_data("Salinity", region, start_time, end_time), repeat)
+    return results
+
+
+def benchmark_tree(data_path, repeat):
+    """Times TimeQuadTree.time_query for a one-hour, a one-day and a full time window over the whole area."""
+    sys.path.insert(0, preprocessing_path)
+    import pandas
+    import quadTree as qt
+    from globals import default_region
+
+    trajectories = pandas.read_parquet(os.path.join(data_path, "trajectories.parquet"))
+    tree = qt.TimeQuadTree(default_region, max_points=20)
+    for row in trajectories.iterrows():
+        tree.insert(qt.Point(row))
+    times = trajectories.index.get_level_values("time")
+    first, last = times.min(), times.max()
+    windows = {
+        "hour": (first, first),
+        "day": (first, first + datetime.timedelta(hours=23)),
+        "all": (first, last),
+    }
+    results = dict()
+    for name, (time_min, time_max) in windows.items():
+        results[f"TimeQuadTree.time_query({name})"] = measure(lambda: tree.time_query(default_region, [], time_min, time_max), repeat)
+    return results
+
+
+def benchmark_preprocessing(data_path, repeat):
+    """Times the preprocessing scripts in the order of the pipeline."""
+    results = dict()
+    results["quadTreePrecompute"] = measure(
+        lambda: run_script(["quadTreePrecompute.py", os.path.join(data_path, "trajectories.parquet"), "allData"]), repeat
+    )
+    results["points2treecode"] = measure(lambda: run_script(["points2treecode.py"]), repeat)
+    results["nearestneighbours"] = measure(lambda: run_script(["nearestneighbours.py"]), repeat)
+    results["getddict"] = measure(lambda: run_script(["-c", "import database; database.getddict()"]), repeat)
+    results["uniteTrajectories"] = measure(lambda: run_script(["uniteTrajectories.py"]), repeat)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=code_path, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path, tolerance):
+    """
+    Prints the median runtimes of two runs side by side.
+
+    @param tolerance: Ratio new/old above which a benchmark counts as regression.
+    @return: Number of regressions.
+    """
+    with open(old_path) as f:
+        old = json.load(f)["results"]
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    print(f"{'benchmark':40} {'old [s]':>10} {'new [s]':>10} {'ratio':>7}")
+    for name in new:
+        if name not in old:
+            print(f"{name:40} {'-':>10} {new[name]['median']:10.4f}")
+            continue
+        ratio = new[name]["median"] / max(old[name]["median"], 1e-9)
+        flag = ""
+        if ratio > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:40} {old[name]['median']:10.4f} {new[name]['median']:10.4f} {ratio:7.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on synthetic data")
+    parser.add_argument("--data", help="directory with an existing (synthetic) dataset, generated into a temporary directory if omitted")
+    parser.add_argument("--labels", type=int, default=500)
+    parser.add_argument("--hours", type=int, default=48)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--results", default=default_results_path)
+    parser.add_argument("--skip-preprocessing", action="store_true")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--tolerance", type=float, default=1.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.tolerance) else 0)
+
+    work_path = tempfile.mkdtemp(prefix="otv-bench-")
+    data_path = args.data or os.path.join(work_path, "data")
+    os.environ["OTV_DATA_PREFIX"] = data_path
+    os.environ["OTV_NEIGHBOUR_PREFIX"] = os.path.join(work_path, "neighbours")
+    os.environ["OTV_TREE_PREFIX"] = os.path.join(work_path, "trees")
+    os.makedirs(os.environ["OTV_NEIGHBOUR_PREFIX"])
+
+    if not args.data:
+        import synthetic
+
+        synthetic.generate(data_path, args.labels, args.hours)
+
+    results = benchmark_app(args.repeat)
+    results.update(benchmark_tree(data_path, args.repeat))
+    if not args.skip_preprocessing:
+        results.update(benchmark_preprocessing(data_path, args.repeat))
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "scale": {"labels": args.labels, "hours": args.hours, "data": args.data},
+        "results": results,
+    }
+    os.makedirs(args.results, exist_ok=True)
+    output = os.path.join(args.results, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    for name, result in results.items():
+        print(f"{name:40} {result['median']:10.4f}s")
+    print(f"Results written to {output}")
@@ -0,0 +1,117 @@
+import pickle
+import threading
+import time
+from globals import *
+import map_interface
+import metrics
+
+"""
+Background cache warmer: after the start of the app the most requested views (ranked by the request log of the
+result cache, see ResultCache.record_request) are computed in a daemon thread and stored in the result cache.
+The warmed layers are also written to a snapshot (path_warm_snapshot), which load_snapshot() puts into the memory cache
+of the app on the next start, so that these views need neither a query nor a read of the result cache.
+The snapshot is bound to the fingerprint of the input data like the result cache and to the result format version.
+"""
+
+
+def warm_views(default_views, result_cache, limit=warm_requests):
+    """
+    Views to warm: the most requested ones, then the default views that are not among them.
+
+    @param default_views: List of parameter tuples (sensor, threshold, start_time, end_time, distance), e.g. the initial view.
+    @param result_cache: ResultCache with the request log.
+    @param limit: Maximal number of views.
+    @return: List of parameter tuples.
+    """
+    views = result_cache.frequent_requests(limit)
+    for view in default_views:
+        if view not in views:
+            views.append(view)
+    return views[:limit]
+
+
+def warm(db, result_cache, views, path=path_warm_snapshot, pause=warm_pause):
+    """
+    Computes the views (or reads them from the result cache) and writes the snapshot.
+    Runs on its own MapInterface with a worker view of the database, the state of the app is not changed.
+
+    @param db: Database of the app.
+    @param result_cache: ResultCache shared with the app, computed views are stored in it.
+    @param views: List of parameter tuples, see warm_views().
+    @param path: Snapshot file.
+    @param pause: Seconds to sleep between two views.
+    @return: Number of views in the snapshot.
+    """
+    t0 = time.time()
+    interface = map_interface.MapInterface(db.worker_view(), result_cache=result_cache)
+    entries = dict()
+    for view in views:
+        try:
+            with metrics.span("cache_warmer_stage", stage="warm_view"):
+                interface.compute_current_tree(*view)
+        except (KeyError, ValueError) as e:
+            # e.g. a sensor of an old request log that is not in the data anymore
+            print(f"Cache warmer skipped {view}: {e}")
+            continue
+        entries[tuple(view)] = interface.tree_cache[tuple(view)]
+        time.sleep(pause)
+    write_snapshot(entries, result_cache.fingerprint, path)
+    print(f"Cache warmer: {len(entries)} views warmed in {time.time()-t0:.02f}s")
+    return len(entries)
+
+
+def write_snapshot(entries, fingerprint, path=path_warm_snapshot):
+    """
+    Writes the snapshot atomically (temporary file and rename), so that a starting worker never reads a partial file.
+
+    @param entries: Dictionary parameter tuple -> (layers, time distribution) like MapInterface.tree_cache.
+    @param fingerprint: Fingerprint of the input data.
+    @param path: Snapshot file.
+    @return: None.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        pickle.dump({"format": result_format_version, "fingerprint": fingerprint, "entries": entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def load_snapshot(interface, fingerprint, path=path_warm_snapshot):
+    """
+    Puts the views of the snapshot into the memory cache of interface.
+
+    @param interface: MapInterface of the app.
+    @param fingerprint: Fingerprint of the current input data, snapshots of other data or of another result format
+                        version are ignored.
+    @param path: Snapshot file.
+    @return: Number of loaded views.
+    """
+    if not os.path.exists(path):
+        return 0
+    t0 = time.time()
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, OSError) as e:
+        print(f"Cache warmer snapshot not readable: {e}")
+        return 0
+    if snapshot.get("format") != result_format_version or snapshot.get("fingerprint") != fingerprint:
+        return 0
+    interface.tree_cache.update(snapshot["entries"])
+    print(f"{len(snapshot['entries'])} warmed views loaded in {time.time()-t0:.03f}s")
+    return len(snapshot["entries"])
+
+
+def start(db, result_cache, default_views, limit=warm_requests):
+    """
+    Starts the warmer in a daemon thread.
+
+    @param db: Database of the app.
+    @param result_cache: ResultCache of the app.
+    @param default_views: Views that are always warmed, see warm_views().
+    @param limit: Maximal number of views.
+    @return: The started thread.
+    """
+    views = warm_views(default_views, result_cache, limit)
+    thread = threading.Thread(target=warm, args=(db, result_cache, views), name="cache-warmer", daemon=True)
+    thread.start()
+    return thread
@@ -1,8 +1,11 @@
 from copy import copy
+import pickle
 import time
 import pandas
 import numpy
 from globals import *
+import sweep
+import neighbour_graph
 
 
 def getstring(day, hour, label):
@@ -17,135 +20,488 @@ def getstring(day, hour, label):
     return f"{str(day).zfill(2)}{str(hour).zfill(2)}{label}"
 
 
-def getlabelids():
+# columns of the timeline_ranged rows of distance_bands(), before the treecode is added
+timeline_ranged_columns = ["time", "label", "longitude", "latitude", "rmin", "rmax", "s0", "s1", "s2", "s3", "s4", "s5", "s6"]
+
+
+def distance_to_units(distances):
+    """
+    Quantizes distances in km to integer multiples of distance_unit, rounded up.
+    Rounding rmin and rmax the same way keeps the distance bands of a label contiguous.
+
+    @param distances: Array of distances in km.
+    @return: Array of uint16 distances in distance_unit.
+    """
+    units = numpy.ceil(numpy.asarray(distances, dtype=numpy.float64) / distance_unit - 1e-3)
+    return numpy.clip(units, 0, numpy.iinfo(numpy.uint16).max).astype(numpy.uint16)
+
+
+def sensor_differences_up(values):
+    """
+    Converts sensor differences to float32, rounded up towards +inf so that a difference above a threshold stays above it.
+    The stored value exceeds the original by less than one float32 ulp (relative error below 2**-23), only differences
+    within that distance below a threshold can turn into contradictions.
+
+    @param values: Array of sensor differences.
+    @return: float32 array.
+    """
+    values = numpy.asarray(values)
+    rounded = values.astype(numpy.float32)
+    below = rounded < values
+    rounded[below] = numpy.nextafter(rounded[below], numpy.float32(numpy.inf))
+    return rounded
+
+
+def treecodes_to_cells(treecodes):
+    """
+    Converts treecode strings to integer cell codes, every distinct code is only converted once.
+
+    @param treecodes: Series or array of treecode strings.
+    @return: Array of uint64 cell codes.
+    """
+    codes, uniques = pandas.factorize(numpy.asarray(treecodes))
+    cells = numpy.array([treecode_to_cell(code) for code in uniques], dtype=numpy.uint64)
+    return cells[codes]
+
+
+def compact_timeline_ranged(tlr):
+    """
+    Converts timeline_ranged to the compact schema:
+    hour (uint16 offset from time_epoch), label (int32), longitude/latitude (float32), rmin/rmax (uint16 in distance_unit),
+    s0..s6 (float32 rounded up, see sensor_differences_up) and cell (uint64 cell code of the leaf, see
+    globals.treecode_to_cell). Rows are sorted by hour.
+
+    @param tlr: timeline_ranged with the columns time, label, longitude, latitude, rmin, rmax, s0..s6 and treecode.
+    @return: Compact DataFrame.
+    """
+    compact = pandas.DataFrame(
+        {
+            "hour": ((tlr.time.values - numpy.datetime64(time_epoch)) // numpy.timedelta64(1, "h")).astype(numpy.uint16),
+            "label": tlr.label.values.astype(numpy.int32),
+            "longitude": tlr.longitude.values.astype(numpy.float32),
+            "latitude": tlr.latitude.values.astype(numpy.float32),
+            "rmin": distance_to_units(tlr.rmin.values),
+            "rmax": distance_to_units(tlr.rmax.values),
+        }
+    )
+    for j in range(7):
+        compact[f"s{j}"] = sensor_differences_up(tlr[f"s{j}"].values)
+    compact["cell"] = treecodes_to_cells(tlr.treecode.values)
+    return compact.sort_values("hour", kind="mergesort").reset_index(drop=True)
+
+
+def compact_timeline(timeline):
+    """
+    Converts the (time, label) indexed timeline to the compact on-disk schema hour (uint16), label (int32), longitude, latitude (float32).
+
+    @param timeline: timeline DataFrame as written by preprocessing.py.
+    @return: Compact DataFrame without index.
+    """
+    timeline = timeline.reset_index()
+    return pandas.DataFrame(
+        {
+            "hour": ((timeline.time.values - numpy.datetime64(time_epoch)) // numpy.timedelta64(1, "h")).astype(numpy.uint16),
+            "label": timeline.label.values.astype(numpy.int32),
+            "longitude": timeline.longitude.values.astype(numpy.float32),
+            "latitude": timeline.latitude.values.astype(numpy.float32),
+        }
+    )
+
+
+def read_timeline_ranged(path=path_timeline_ranged_db, **kwargs):
+    """
+    Reads timeline_ranged in either schema and returns it in the compact schema sorted by hour.
+
+    @param path: Parquet file.
+    @param kwargs: Passed to pandas.read_parquet.
+    @return: Compact DataFrame.
+    """
+    tlr = pandas.read_parquet(path, **kwargs)
+    if "treecode" in tlr.columns:
+        return compact_timeline_ranged(tlr)
+    if not tlr.hour.is_monotonic_increasing:
+        tlr = tlr.sort_values("hour", kind="mergesort").reset_index(drop=True)
+    return tlr
+
+
+def read_timeline(path=path_time_db):
+    """
+    Reads the timeline in either schema and returns it indexed by (time, label) with int32 labels.
+
+    @param path: Parquet file.
+    @return: DataFrame with the columns longitude, latitude.
+    """
+    timeline = pandas.read_parquet(path)
+    if "hour" in timeline.columns:
+        timeline["time"] = hours_to_time(timeline.hour.values).astype("datetime64[ns]")
+        timeline = timeline.drop(columns=["hour"]).set_index(["time", "label"]).sort_index()
+    return timeline
+
+
+def tree_leaf_codes(lon, lat):
+    """
+    Treecodes of the leaves of the existing TimeQuadTree (trees/allData/timeQuadTree.p) that contain the positions.
+    The tree is only searched, not changed, so the codes of the data already processed stay valid.
+    Positions outside of the tree and a missing tree fall back to the cells of a full tree of depth max_cell_depth.
+
+    @param lon: Array of longitudes.
+    @param lat: Array of latitudes.
+    @return: numpy array of treecode strings.
+    """
+    codes = treecodes(lon, lat, max_cell_depth)
+    tree_file = os.path.join(tree_path, "timeQuadTree.p")
+    if not os.path.exists(tree_file):
+        return codes
+    with open(tree_file, "rb") as f:
+        tree = pickle.load(f)
+    for i, (x, y) in enumerate(zip(lon, lat)):
+        code = tree.get_tree_code(_Position(x, y))
+        if code is not None:
+            codes[i] = code
+    return codes
+
+
+class _Position:
+    """Minimal point for QuadTree.get_tree_code()"""
+
+    def __init__(self, long, lat):
+        self.long = long
+        self.lat = lat
+
+
+class LabelEncoding:
+    """
+    Dense integer ids for the trajectory labels (the index of the label in the sorted array of all labels).
+    The sensor values are held as array of shape (number of labels, 7) and the positions as arrays sorted by
+    (hour, id), so lookups by label are array gathers instead of index lookups in DataFrames.
+    """
+
+    def __init__(self, sensors, timeline):
+        """
+        @param sensors: DataFrame indexed by label with the columns of globals.sensor_names.
+        @param timeline: DataFrame indexed by (time, label) with the columns longitude, latitude (see read_timeline).
+        """
+        timeline_labels = timeline.index.get_level_values("label").values.astype(numpy.int64)
+        self.labels = numpy.union1d(sensors.index.values.astype(numpy.int64), timeline_labels)
+        self.sensor_values = numpy.full((len(self.labels), 7), numpy.nan)
+        self.sensor_values[self.ids(sensors.index.values)] = sensors[sensor_names].values
+        # positions sorted by (hour, id), the first position wins for duplicate (time, label) pairs like in timeline.loc
+        hours = (timeline.index.get_level_values("time").values - numpy.datetime64(time_epoch)) // numpy.timedelta64(1, "h")
+        ids = self.ids(timeline_labels)
+        order = numpy.lexsort((ids, hours))
+        self.position_ids = ids[order]
+        self.longitude = timeline.longitude.values[order]
+        self.latitude = timeline.latitude.values[order]
+        self.first_hour = int(hours.min()) if len(hours) else 0
+        self.hour_offsets = numpy.searchsorted(hours[order], numpy.arange(self.first_hour, int(hours.max(initial=0)) + 2))
+
+    def ids(self, labels):
+        """
+        @param labels: Array of labels.
+        @return: int64 array of the dense ids, KeyError for unknown labels.
+        """
+        labels = numpy.asarray(labels, dtype=numpy.int64)
+        ids = numpy.minimum(numpy.searchsorted(self.labels, labels), max(len(self.labels) - 1, 0))
+        if len(labels) and (not len(self.labels) or (self.labels[ids] != labels).any()):
+            raise KeyError(f"Unknown labels {labels[self.labels[ids] != labels][:5] if len(self.labels) else labels[:5]}")
+        return ids
+
+    def positions(self, t, ids):
+        """
+        Positions of labels at one hour, a binary search within the positions of the hour.
+
+        @param t: datetime of the hour.
+        @param ids: Array of dense ids.
+        @return: Tuple (longitudes, latitudes), KeyError if a label has no position at t.
+        """
+        hour = (numpy.datetime64(t, "ns") - numpy.datetime64(time_epoch)) // numpy.timedelta64(1, "h") - self.first_hour
+        if hour < 0 or hour + 1 >= len(self.hour_offsets):
+            raise KeyError(f"No positions at {t}")
+        start, end = self.hour_offsets[hour], self.hour_offsets[hour + 1]
+        index = start + numpy.searchsorted(self.position_ids[start:end], ids)
+        if len(ids) and ((index >= end).any() or (self.position_ids[numpy.minimum(index, end - 1)] != ids).any()):
+            raise KeyError(f"Labels without position at {t}")
+        return self.longitude[index], self.latitude[index]
+
+    def nearest(self, lon, lat, first_hour, last_hour):
+        """
+        Position nearest to (lon, lat) within some hours, in degrees scaled by the cosine of the latitude.
+
+        @param first_hour: First hour offset from time_epoch.
+        @param last_hour: Last hour offset (inclusive).
+        @return: Tuple (label, hour offset, longitude, latitude) or None if there are no positions in the hours.
+        """
+        first = self.hour_offsets[min(max(first_hour - self.first_hour, 0), len(self.hour_offsets) - 1)]
+        last = self.hour_offsets[min(max(last_hour + 1 - self.first_hour, 0), len(self.hour_offsets) - 1)]
+        if first >= last:
+            return None
+        dx = (self.longitude[first:last] - lon) * math.cos(math.radians(lat))
+        dy = self.latitude[first:last] - lat
+        i = first + int(numpy.argmin(dx * dx + dy * dy))
+        hour = self.first_hour + int(numpy.searchsorted(self.hour_offsets, i, side="right")) - 1
+        return int(self.labels[self.position_ids[i]]), hour, float(self.longitude[i]), float(self.latitude[i])
+
+
+def hour_ranges(timenow, result_path, encoding, max_distance=max_distance_threshold):
+    """
+    Distance bands of the points of one hour from its neighbour list: per label the distances at which the running
+    maximum of the sensor differences to its neighbours changes.
+
+    @param timenow: datetime of the hour.
+    @param result_path: Directory of the neighbour lists.
+    @param encoding: LabelEncoding of the sensors and the timeline.
+    @param max_distance: Radius of the neighbour lists in km, the last band of a label ends there.
+    @return: None if no point has neighbours, otherwise a tuple (timeline_ranged rows without treecode (see distance_bands),
+             edges of the neighbour graph (hour, label, neighbour, distance), sensor differences of all pairs with NaN set to 0,
+             valid mask).
+    """
+    # one row per (key label, neighbour label) pair of the neighbour list
+    keys, neighbours, lines = [], [], []
+    with open(neighbour_file(result_path, timenow), "r") as f:
+        for n, line in enumerate(f):
+            label_list = line.strip().rstrip(",").split(",")
+            # Corner case: No neighbors: don't save aka, we don't need them
+            if len(label_list) <= 1:
+                continue
+            keys.extend([label_list[0]] * (len(label_list) - 1))
+            neighbours.extend(label_list[1:])
+            lines.extend([n] * (len(label_list) - 1))
+    if not keys:
+        return None
+    key_ids = encoding.ids(numpy.array(keys, dtype=numpy.int64))
+    neighbour_ids = encoding.ids(numpy.array(neighbours, dtype=numpy.int64))
+    key_lon, key_lat = encoding.positions(timenow, key_ids)
+    lon, lat = encoding.positions(timenow, neighbour_ids)
+    distance = distance_wgs(key_lon, key_lat, lon, lat).astype(numpy.float32)
+    hour = (numpy.datetime64(timenow, "ns") - numpy.datetime64(time_epoch)) // numpy.timedelta64(1, "h")
+    edges = (numpy.full(len(distance), hour, dtype=numpy.uint16), encoding.labels[key_ids], encoding.labels[neighbour_ids], distance)
+    sensor_difference = numpy.abs(encoding.sensor_values[key_ids] - encoding.sensor_values[neighbour_ids])
+    valid = ~numpy.isnan(sensor_difference)
+    sensor_difference[~valid] = 0
+    frame = distance_bands(timenow, lines, encoding.labels[key_ids], key_lon, key_lat, distance, sensor_difference, max_distance)
+    return frame, edges, sensor_difference, valid
+
+
+def distance_bands(timenow, lines, labels, lon, lat, distance, sensor_difference, max_distance=max_distance_threshold):
+    """
+    timeline_ranged rows of the points of one hour from their neighbour pairs: per point the distances at which the
+    running maximum of the sensor differences changes, each row is valid from rmin up to rmax (exclusive).
+
+    @param timenow: datetime of the hour.
+    @param lines: Point index of every pair, ascending.
+    @param labels: Label of the point of every pair.
+    @param lon: Longitude of the point of every pair.
+    @param lat: Latitude of the point of every pair.
+    @param distance: Distance of every pair in km.
+    @param sensor_difference: Absolute sensor differences of every pair, array of shape (pairs, 7) without NaN.
+    @param max_distance: Neighbour radius in km, the last band of a point ends there.
+    @return: DataFrame with the columns time, label, longitude, latitude, rmin, rmax, s0..s6.
+    """
+    # Key values sind sortiert - Idee:
+    # 1) wir berechnen die max map pro key
+    # 2) Jeder Key bekommt range [key,next_key)
+    # 2) Wir werfen keys raus, deren max map sich nicht vom vorherigen key unterscheidet
+    # Wir fügen in eine DB ein:
+    #   Index: Time, Label, key, nextkey
+    #   Columns: Original time,label,lon,lat + 7 maxvals (precomputed s_dict from below function)
+    # Corner case, lets say we have vals 0.46, 0.83, how to fully define 0-1?
+    # [0.00, 0.46) -> no threshold -> no errors -> does not need to appear in error list
+    # [0.46, 0.83) -> 0.46 max values
+    # [0.83, 1.00) -> 0.83 max values
+    # all keys of the hour at once: sort by (key, distance), running max per key, keep the rows where it changes
+    line_index = numpy.array(lines, dtype=numpy.int64)
+    pairs = pandas.DataFrame(sensor_difference, columns=["s0", "s1", "s2", "s3", "s4", "s5", "s6"])
+    pairs.insert(0, "line", line_index)
+    pairs.insert(1, "rmin", distance)
+    pairs = pairs.iloc[numpy.lexsort((distance, line_index))].reset_index(drop=True)
+    values = pairs.groupby("line")[["s0", "s1", "s2", "s3", "s4", "s5", "s6"]].cummax().values
+    line = pairs.line.values
+    first = numpy.concatenate([[True], line[1:] != line[:-1]])
+    changed = numpy.concatenate([[True], (values[1:] != values[:-1]).any(axis=1)])
+    keep = first | changed
+    rows = numpy.flatnonzero(keep)
+    rmin = pairs.rmin.values[rows]
+    # the range of a kept row ends at the next kept row of the same key, the last one at the maximal distance
+    last = numpy.concatenate([line[rows][1:] != line[rows][:-1], [True]])
+    rmax = numpy.where(last, numpy.float32(max_distance + 0.0001), numpy.roll(rmin, -1)).astype(numpy.float32)
+    # rows of a key from the largest to the smallest distance
+    order = numpy.lexsort((-numpy.arange(len(rows)), line[rows]))
+    rows, rmin, rmax = rows[order], rmin[order], rmax[order]
+    first_pairs = numpy.searchsorted(line_index, line[rows])
+    frame = pandas.DataFrame(
+        {
+            "time": pandas.Timestamp(timenow),
+            "label": numpy.asarray(labels)[first_pairs].astype(numpy.int32),
+            "longitude": numpy.asarray(lon)[first_pairs],
+            "latitude": numpy.asarray(lat)[first_pairs],
+            "rmin": rmin,
+            "rmax": rmax,
+        }
+    )
+    for j in range(7):
+        frame[f"s{j}"] = values[rows, j].astype(numpy.float32)
+    return frame
+
+
+def with_treecodes(frame, points2trees=None, leaf=False):
     """
-    Reads a parquet file containing timeline data, adds a new 'id' column by combining time and label information,
-    and then saves the modified dataframe back to a parquet file.
+    Adds the treecode column to timeline_ranged rows: the code of the leaf of the existing TimeQuadTree that contains
+    the point (leaf), the code of points2treecode.p (points2trees) or the cell of a full tree of depth max_cell_depth.
 
-    @return: None. This function performs operations on a dataframe and saves the result, but does not return any value.
+    @param frame: DataFrame with the columns time, label, longitude, latitude.
+    @param points2trees: Mapping of the point ids (day, hour, label) to treecodes, see points2treecode.py.
+    @param leaf: Whether to look up the leaves of the existing tree, for hours that are not in points2treecode.p.
+    @return: The frame.
     """
-    tlr = pandas.read_parquet(f"{path_timeline_ranged_db}")
-    tlr["id"] = tlr.apply(lambda x: x.time.strftime("%d%H") + str(x.label), axis=1)
-    print(tlr)
-    tlr.to_parquet(path_timeline_ranged_db)
+    if leaf:
+        frame["treecode"] = tree_leaf_codes(frame.longitude.values, frame.latitude.values)
+    elif points2trees is not None:
+        ids = frame.time.dt.strftime("%d%H") + frame.label.astype(str)
+        frame["treecode"] = ids.map(points2trees)
+    else:
+        frame["treecode"] = treecodes(frame.longitude.values, frame.latitude.values, max_cell_depth)
+    return frame
 
 
-def getddict():
+def getddict(hours=None, max_distance=max_distance_threshold, output=None, graph_path=None, chunk_hours=getddict_chunk_hours):
     """
     Creates a dictionary (ddict) mapping sensor labels to various attributes like positions, sensors, and distances.
     It reads data from parquet files, computes distances and aggregates sensor data.
+    The hours are processed in chunks of chunk_hours, only the neighbour pairs of one chunk are in memory at a time.
 
-    @return: None. This function is used for side effects (like creating or modifying a global variable) rather than returning a value.
+    @param hours: datetimes of the hours to process. By default all hours of the timeline are written to output chunk by
+                  chunk and the neighbour graph is rebuilt.
+                  Given hours (append mode) are returned instead and replace only their hours in the neighbour graph,
+                  their leaf treecodes are looked up in the existing TimeQuadTree as the ids of points2treecode.p are
+                  only unique within one month.
+    @param max_distance: Radius of the neighbour lists in km (see globals.neighbour_dir).
+    @param output: Parquet file of all hours, default is neighbours/timelinenew.parquet.
+    @param graph_path: Directory of the neighbour graph, default is neighbour_graph/ next to output (the live graph of
+                       the app is path_neighbour_graph).
+    @param chunk_hours: Number of hours per chunk.
+    @return: timeline_ranged rows of the given hours in the compact schema, for all hours the path of the written file.
     """
-    neighbour_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "neighbours")
-    result_path = os.path.join(neighbour_path, f"{max_distance_threshold}km_distance")
+    import pyarrow
+    import pyarrow.parquet as pq
+
+    result_path = neighbour_dir(max_distance)
+    output = os.path.join(neighbour_prefix, "timelinenew.parquet") if output is None else output
+    graph_path = os.path.join(os.path.dirname(output), neighbour_graph_suffix) if graph_path is None else graph_path
     sensors = pandas.read_parquet(f"{path_sensors_db}")
-    timeline = pandas.read_parquet(f"{path_time_db}")
-    ddict = {}
-    global_index = 0
+    timeline = read_timeline(path_time_db)
+    append = hours is not None
+    if hours is None:
+        hours = [t.to_pydatetime() for t in timeline.index.get_level_values("time").unique().sort_values()]
+    encoding = LabelEncoding(sensors, timeline)
+    # leaf codes of the TimeQuadTree (points2treecode.py), cells of a full tree of depth max_cell_depth if not available
+    points2treecode_path = os.path.join(tree_path, "points2treecode.p")
+    points2trees = pandas.read_pickle(points2treecode_path) if not append and os.path.exists(points2treecode_path) else None
     t10 = time.time()
-    max_sensors_threshold = [0, 0, 0, 0, 0, 0, 0]
-    min_sensor_thresholds = [0, 0, 0, 0, 0, 0, 0]
+    max_sensors_threshold = numpy.zeros(7)
+    min_sensor_thresholds = numpy.zeros(7)
     threshold_count = 0
-    for day in range(1, 31):
-        for hour in range(0, 24):
-            prefix = f"{str(day).zfill(2)}{str(hour).zfill(2)}"
-            print(prefix)
-            timenow = datetime.datetime(2013, 6, day, hour)
-            with open(os.path.join(result_path, f"{day}_{hour}.csv"), "r") as f:
-                for line in f:
-                    label_list = line.strip().rstrip(",").split(",")
-                    key_label = numpy.int32(label_list[0])
-                    key_pos = timeline.loc[(timenow, key_label)].values[0]
-                    key_sensors = sensors.loc[key_label].values[3:11]
-                    key_value = []
-                    if len(label_list) <= 1:
-                        continue
-                    for i in range(1, len(label_list)):
-                        current_label = int(label_list[i])
-                        current_pos = timeline.loc[(timenow, current_label)].values[0]
-                        current_sensors = sensors.loc[current_label].values[3:11]
-                        distance = numpy.float32(distance_wgs(key_pos[0], key_pos[1], current_pos[0], current_pos[1]))
-                        sensor_difference = numpy.zeros([len(current_sensors)])
-                        for j in range(0, len(current_sensors)):
-                            if numpy.isnan(key_sensors[j]) or numpy.isnan(current_sensors[j]):
-                                sensor_difference[j] = 0
-                            else:
-                                diff = abs(key_sensors[j] - current_sensors[j])
-                                sensor_difference[j] = diff
-                                threshold_count += 1
-                                min_sensor_thresholds[j] += diff
-                                if diff > max_sensors_threshold[j]:
-                                    max_sensors_threshold[j] = diff
-
-                        key_value.append((distance, sensor_difference))
-
-                    key_value = sorted(key_value, key=lambda tup: tup[0])
-                    # Key values sind sortiert - Idee:
-                    # 1) wir berechnen die max map pro key
-                    # 2) Jeder Key bekommt range [key,next_key)
-                    # 2) Wir werfen keys raus, deren max map sich nicht vom vorherigen key unterscheidet
-                    # Wir fügen in eine DB ein:
-                    #   Index: Time, Label, key, nextkey
-                    #   Columns: Original time,label,lon,lat + 7 maxvals (precomputed s_dict from below function)
-                    # Corner case: No neighbors: don't save aka, we don't need them
-                    # Corner case, lets say we have vals 0.46, 0.83, how to fully define 0-1?
-                    # [0.00, 0.46) -> no threshold -> no errors -> does not need to appear in error list
-                    # [0.46, 0.83) -> 0.46 max values
-                    # [0.83, 1.00) -> 0.83 max values
-                    for i in range(1, len(key_value)):
-                        key_value[i] = (key_value[i][0], numpy.maximum(key_value[i - 1][1], key_value[i][1]))
-                    rmax = numpy.float32(max_distance_threshold + 0.0001)  # in km
-                    for i in reversed(range(1, len(key_value))):
-                        if numpy.array_equal(key_value[i][1], key_value[i - 1][1]):
-                            continue
-                        ddict[global_index] = [
-                            timenow,
-                            key_label,
-                            key_pos[0],
-                            key_pos[1],
-                            key_value[i][0],
-                            rmax,
-                            numpy.float32(key_value[i][1][0]),
-                            numpy.float32(key_value[i][1][1]),
-                            numpy.float32(key_value[i][1][2]),
-                            numpy.float32(key_value[i][1][3]),
-                            numpy.float32(key_value[i][1][4]),
-                            numpy.float32(key_value[i][1][5]),
-                            numpy.float32(key_value[i][1][6]),
-                        ]
-                        global_index += 1
-                        rmax = key_value[i][0]
-                    # last value
-                    ddict[global_index] = [timenow, key_label, key_pos[0], key_pos[1], key_value[0][0], rmax]
-                    ddict[global_index] = [
-                        timenow,
-                        key_label,
-                        key_pos[0],
-                        key_pos[1],
-                        key_value[0][0],
-                        rmax,
-                        numpy.float32(key_value[0][1][0]),
-                        numpy.float32(key_value[0][1][1]),
-                        numpy.float32(key_value[0][1][2]),
-                        numpy.float32(key_value[0][1][3]),
-                        numpy.float32(key_value[0][1][4]),
-                        numpy.float32(key_value[0][1][5]),
-                        numpy.float32(key_value[0][1][6]),
-                    ]
-                    global_index += 1
-    timeline_new = pandas.DataFrame.from_dict(
-        ddict, orient="index", columns=["time", "label", "longitude", "latitude", "rmin", "rmax", "s0", "s1", "s2", "s3", "s4", "s5", "s6"]
-    )
-    for i in range(0, len(min_sensor_thresholds)):
-        min_sensor_thresholds[i] /= threshold_count
-        min_sensor_thresholds[i] /= 2
-    print(f"Min: {min_sensor_thresholds}")
-    print(f"Max: {max_sensors_threshold}")
+    # append mode returns the rows of its hours, otherwise every chunk is written before the next one is computed
+    results, result_edges = [], []
+    graph_writer = None if append else neighbour_graph.NeighbourGraphWriter(graph_path)
+    parquet_writer = None
+    rows = 0
+    for start in range(0, max(len(hours), 1), chunk_hours):
+        frames = []
+        # edges of the neighbour graph (hour, label, neighbour, distance), kept after the neighbour lists (see neighbour_graph.py)
+        edges = []
+        for timenow in hours[start : start + chunk_hours]:
+            print(f"{timenow:%Y-%m-%d %H}")
+            ranges = hour_ranges(timenow, result_path, encoding, max_distance)
+            if ranges is None:
+                continue
+            frame, hour_edges, sensor_difference, valid = ranges
+            threshold_count += valid.sum()
+            min_sensor_thresholds += sensor_difference.sum(axis=0)
+            max_sensors_threshold = numpy.maximum(max_sensors_threshold, sensor_difference.max(axis=0))
+            frames.append(frame)
+            edges.append(hour_edges)
+        timeline_new = pandas.concat(frames, ignore_index=True) if frames else pandas.DataFrame(columns=timeline_ranged_columns)
+        timeline_new = compact_timeline_ranged(with_treecodes(timeline_new, points2trees, append))
+        edges = [numpy.concatenate(column) for column in zip(*edges)] if edges else [numpy.array([])] * 4
+        if append:
+            results.append(timeline_new)
+            result_edges.append(edges)
+            continue
+        graph_writer.append(*edges)
+        table = pyarrow.Table.from_pandas(timeline_new, preserve_index=False)
+        if parquet_writer is None:
+            parquet_writer = pq.ParquetWriter(output, table.schema)
+        parquet_writer.write_table(table)
+        rows += len(timeline_new)
+        print(f"{min(start + chunk_hours, len(hours))}/{len(hours)} hours, {rows} rows written after {time.time()-t10:.02f}s")
+    min_sensor_thresholds = min_sensor_thresholds / max(threshold_count, 1) / 2
+    print(f"Min: {min_sensor_thresholds.tolist()}")
+    print(f"Max: {max_sensors_threshold.tolist()}")
     t12 = time.time()
     print(f"Nearest neighbours loaded in:{t12-t10:.02f}s")
-    timeline_new.to_parquet(os.path.join(neighbour_path, "timelinenew.parquet"))
-    return
+    if append:
+        neighbour_graph.update_neighbour_graph(*[numpy.concatenate(column) for column in zip(*result_edges)], path=graph_path)
+        return pandas.concat(results, ignore_index=True)
+    parquet_writer.close()
+    graph_writer.close()
+    return output
+
+
+def empty_timeline_ranged(path=path_timeline_ranged_db):
+    """
+    Empty timeline_ranged in the compact schema, read from the schema of the file only.
+
+    @param path: Parquet file in either schema.
+    @return: Empty DataFrame.
+    """
+    import pyarrow.parquet as pq
+
+    tlr = pq.ParquetFile(path).schema_arrow.empty_table().to_pandas()
+    if "treecode" in tlr.columns:
+        return compact_timeline_ranged(tlr)
+    return tlr
+
+
+def max_cell(path=path_timeline_ranged_db):
+    """
+    Largest cell code in timeline_ranged from the row group statistics (compact schema) or a column scan.
+
+    @param path: Parquet file in either schema.
+    @return: Cell code.
+    """
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(path)
+    if "treecode" in parquet.schema_arrow.names:
+        codes = pq.read_table(path, columns=["treecode"]).column("treecode").to_pandas().unique()
+        return max((treecode_to_cell(code) for code in codes), default=1)
+    column = parquet.schema_arrow.get_field_index("cell")
+    result = 1
+    for g in range(parquet.num_row_groups):
+        statistics = parquet.metadata.row_group(g).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            return int(pq.read_table(path, columns=["cell"]).column("cell").to_numpy().max(initial=1))
+        result = max(result, int(statistics.max))
+    return result
+
+
+def hour_bounds(timespan: TimeSpan):
+    """
+    First and last hour offset inside timespan, clipped to the range of the uint16 hour column.
+
+    @param timespan: Time interval.
+    @return: Tuple (first, last) of ints, first > last if no hour is inside.
+    """
+    limit = numpy.iinfo(numpy.uint16).max
+    first = min(max(math.ceil(hour_offset(timespan.start)), 0), limit + 1)
+    last = min(max(math.floor(hour_offset(timespan.end)), -1), limit)
+    return first, last
+
+
+def _row_group_overlaps(statistics, first, last):
+    if statistics is None or not statistics.has_min_max:
+        return True
+    return statistics.max >= first and statistics.min <= last
 
 
 class Database:
@@ -158,12 +514,34 @@ class Database:
         @return: None. This is a constructor method for initializing a new instance of the Database class.
         """
         self.sensors = pandas.read_parquet(path_sensors_db)
-        self.timeline = pandas.read_parquet(path_time_db)
-        self.tlr = pandas.read_parquet(path_timeline_ranged_db)
+        self.timeline = read_timeline(path_time_db)
+        # compact schema sorted by hour, so that queries only have to filter the rows of the queried timespan
+        # in streaming mode only the schema is loaded and contradiction queries scan the file (see scan_timeline_ranged)
+        self.streaming = streaming
+        if self.streaming:
+            self.tlr = empty_timeline_ranged(path_timeline_ranged_db)
+        else:
+            self.tlr = read_timeline_ranged(path_timeline_ranged_db)
+        # deepest tree level of the cells in timeline_ranged, cell codes grow with the level so the largest code is on it
+        self.leaf_level = int(cell_depth([max_cell(path_timeline_ranged_db) if self.streaming else self.tlr.cell.values.max(initial=0)])[0])
         self.trajectories = pandas.read_parquet(path_trajectories_db)
+        # dense label ids with the sensor values as array, lookups by label are gathers (see LabelEncoding)
+        self.encoding = LabelEncoding(self.sensors, self.timeline)
+        # optional neighbour graph (written by getddict), memory-mapped
+        self.graph = neighbour_graph.NeighbourGraph() if os.path.exists(os.path.join(path_neighbour_graph, "offsets.npy")) else None
         self.meta = pandas.read_csv(path_meta_db)
         self.clustered = pandas.read_parquet(path_clustered)
+        # optional clusterings of several distance cuts (preprocessing/hierarchicalClustering.py), index (cut, label, time)
+        self.clustered_levels = pandas.read_parquet(path_clustered_levels) if os.path.exists(path_clustered_levels) else None
         self.rdict = pandas.read_pickle(path_range_dict)
+        # optional precomputed threshold/distance sweep histograms (preprocessing/sweepHistograms.py)
+        self.sweep = sweep.SweepHistograms(path_sweep_histograms) if os.path.exists(path_sweep_histograms) else None
+        # spatial index of timeline_ranged (row order sorted by Morton key and the sorted keys), built on the first region query
+        self.cell_order = None
+        self.sorted_keys = None
+        self.min_depth = None
+        # inverted index per tree level: level -> (cells, starts, ends) of the rows of each cell in the spatial index
+        self.cell_ranges = dict()
         self.dthresh = max_distance_threshold
         self.sthresh = numpy.array([1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0])
         # Wie gehen wir vor?
@@ -184,36 +562,416 @@ class Database:
         # Update: All got preprocessed in timeline_ranged as sdict
         # We now just need to update d and s thresh and do a dynamic query
 
+    def worker_view(self):
+        """
+        Database for computations in another thread: it shares the loaded data but has its own thresholds,
+        so that spatial_range_update() and sensor_update() do not change the queries of the app.
+
+        @return: Shallow copy of the database.
+        """
+        view = copy(self)
+        view.sthresh = self.sthresh.copy()
+        view.cell_ranges = dict()
+        return view
+
+    def nearest_point(self, lon, lat, timespan: TimeSpan):
+        """
+        Trajectory point nearest to a position within a timespan, e.g. the point clicked on the map.
+
+        @param lon: Longitude.
+        @param lat: Latitude.
+        @param timespan: Timespan of the points.
+        @return: Tuple (label, datetime, longitude, latitude) or None if there are no points in the timespan.
+        """
+        first_hour, last_hour = hour_bounds(timespan)
+        point = self.encoding.nearest(lon, lat, first_hour, last_hour)
+        if point is None:
+            return None
+        label, hour, point_lon, point_lat = point
+        return label, time_epoch + datetime.timedelta(hours=hour), point_lon, point_lat
+
+    def neighbours(self, label, t, distance=max_distance_threshold):
+        """
+        Neighbours of a trajectory point from the neighbour graph together with the sensor differences.
+
+        @param label: Trajectory label.
+        @param t: datetime of the hour.
+        @param distance: Distance threshold in km, neighbours at most this far away are returned.
+        @return: DataFrame with the columns label, distance (km) and the absolute difference of every sensor (columns named
+                 like globals.sensor_names, NaN if a value is missing) sorted by distance.
+                 Empty if the point has no neighbours or there is no neighbour graph.
+        """
+        if self.graph is None:
+            labels, distances = numpy.array([], dtype=numpy.int32), numpy.array([], dtype=numpy.float32)
+        else:
+            hour = int((t - time_epoch).total_seconds() // 3600)
+            labels, distances = self.graph.neighbours(label, hour, distance)
+        differences = numpy.abs(self.encoding.sensor_values[self.encoding.ids(labels)] - self.encoding.sensor_values[self.encoding.ids([label])])
+        result = pandas.DataFrame(differences, columns=sensor_names)
+        result.insert(0, "label", labels)
+        result.insert(1, "distance", distances)
+        return result
+
+    def day_range(self):
+        """
+        First and last day number (see globals.day_number) of the timeline, the time controls of the app follow it.
+
+        @return: Tuple (first day, last day).
+        """
+        times = self.timeline.index.get_level_values("time")
+        if not len(times):
+            return 1, 1
+        return day_number(times.min()), day_number(times.max())
+
     def query(
         self, region: Region = default_region, timespan: TimeSpan = default_timespan, sensor: Sensor = Salinity(), contradictions: bool = False
     ):
+        """
+        Queries positions or contradictions.
+
+        @param region: Spatial region of interest.
+        @param timespan: Time interval of interest.
+        @param sensor: Sensor whose threshold (sthresh) defines contradictions.
+        @param contradictions: If True the contradictions under the current dthresh and sthresh are returned as DataFrame
+                               with the columns hour, label, cell, otherwise the positions from the timeline.
+        @return: DataFrame.
+        """
         cregion = copy(region)
         ctimespan = copy(timespan)
         sensorid = sensor.index
         if cregion.projection == "Web":
             cregion.web_to_wgs()
-        results = []
         if contradictions:
-            results = self.tlr.loc[
-                (self.tlr.time >= ctimespan.start)
-                & (self.tlr.time <= ctimespan.end)
-                & (self.tlr.rmin <= self.dthresh)
-                & (self.tlr.rmax > self.dthresh)
-                & (self.tlr[f"s{sensorid}"] > self.sthresh[sensorid])
-            ]
-            results = results.iloc[:, [0, 1, 13, 14]]
-        else:
-            results = self.timeline.loc[ctimespan.start : ctimespan.end]
+            if self.streaming:
+                return pandas.concat(list(self.stream_contradictions(cregion, ctimespan, sensor)) + [self.tlr[["hour", "label", "cell"]]])
+            return self.contradictions(self.tlr_candidates(cregion, ctimespan), cregion, sensorid)
 
+        results = self.timeline.loc[ctimespan.start : ctimespan.end]
         if cregion != default_region:
-            results = results[
-                (results.longitude >= cregion.x_min)
-                & (results.longitude < cregion.x_max)
-                & (results.latitude >= cregion.y_min)
-                & (results.latitude < cregion.y_max)
-            ]
+            results = results[self.region_selection(results, cregion)]
         return results
 
+    def contradictions(self, tlr, region: Region, sensorid):
+        """
+        Contradictions of one sensor among rows of timeline_ranged under the current dthresh and sthresh.
+
+        @param tlr: Rows of timeline_ranged.
+        @param region: Region in WGS 84.
+        @param sensorid: Index of the sensor.
+        @return: DataFrame with the columns hour, label, cell.
+        """
+        selection = self.distance_selection(tlr) & (tlr[f"s{sensorid}"].values > self.sthresh[sensorid])
+        if region != default_region:
+            selection &= self.region_selection(tlr, region)
+        return tlr.loc[selection, ["hour", "label", "cell"]]
+
+    def scan_timeline_ranged(self, timespan: TimeSpan, path=path_timeline_ranged_db, batch_size=stream_batch_rows):
+        """
+        Reads timeline_ranged chunk by chunk, only one chunk is in memory at a time.
+        Row groups whose hour statistics lie outside timespan are skipped without reading them.
+
+        @param timespan: Time interval.
+        @param path: Parquet file in either schema.
+        @param batch_size: Maximal number of rows per chunk.
+        @return: Generator of DataFrames in the compact schema with the rows inside timespan.
+        """
+        import pyarrow.parquet as pq
+
+        first, last = hour_bounds(timespan)
+        parquet = pq.ParquetFile(path)
+        legacy = "treecode" in parquet.schema_arrow.names
+        row_groups = list(range(parquet.num_row_groups))
+        if not legacy:
+            column = parquet.schema_arrow.get_field_index("hour")
+            row_groups = [g for g in row_groups if _row_group_overlaps(parquet.metadata.row_group(g).column(column).statistics, first, last)]
+        for batch in parquet.iter_batches(batch_size=batch_size, row_groups=row_groups):
+            chunk = batch.to_pandas()
+            if legacy:
+                chunk = compact_timeline_ranged(chunk)
+            hours = chunk.hour.values
+            chunk = chunk[(hours >= first) & (hours <= last)]
+            if len(chunk):
+                yield chunk
+
+    def stream_contradictions(self, region: Region, timespan: TimeSpan, sensor: Sensor = None, thresholds=None):
+        """
+        Contradiction query over timeline_ranged on disk, chunk by chunk.
+        With a sensor the chunks are like the result of query(contradictions=True), otherwise like query_all_sensors().
+
+        @param region: Region in WGS 84.
+        @param timespan: Time interval.
+        @param sensor: Sensor whose threshold (sthresh) defines contradictions, None for all sensors.
+        @param thresholds: Array of the 7 sensor thresholds if sensor is None, default is the current sthresh.
+        @return: Generator of DataFrames.
+        """
+        for chunk in self.scan_timeline_ranged(timespan):
+            if sensor is not None:
+                yield self.contradictions(chunk, region, sensor.index)
+            else:
+                yield self.all_sensor_contradictions(chunk, region, self.sthresh if thresholds is None else thresholds)
+
+    def tlr_timespan(self, timespan: TimeSpan):
+        """
+        Slices the rows of timeline_ranged inside timespan with two binary searches on the sorted hour column.
+
+        @param timespan: Time interval.
+        @return: DataFrame view of timeline_ranged.
+        """
+        start, end = self.hour_rows(timespan)
+        return self.tlr.iloc[start:end]
+
+    def hour_rows(self, timespan: TimeSpan):
+        """
+        Row range of timeline_ranged inside timespan.
+
+        @param timespan: Time interval.
+        @return: Tuple (start, end) of row positions.
+        """
+        hours = self.tlr.hour.values
+        limit = numpy.iinfo(numpy.uint16).max
+        first, last = hour_bounds(timespan)
+        start = hours.searchsorted(first, side="left") if first <= limit else len(hours)
+        end = hours.searchsorted(last, side="right") if last >= 0 else 0
+        return start, max(start, end)
+
+    def day_rows(self, timespan: TimeSpan):
+        """
+        Row ranges of the days of timeline_ranged inside timespan, the first and the last day may be partial.
+
+        @param timespan: Time interval.
+        @return: Tuple (first day, edges) where first day is the day of the first hour (hour offset // 24) and the rows of
+                 day first day + d are edges[d]:edges[d + 1]. No day if no row is inside.
+        """
+        start, end = self.hour_rows(timespan)
+        if start == end:
+            return 0, numpy.array([start], dtype=numpy.int64)
+        hours = self.tlr.hour.values
+        first_day, last_day = int(hours[start]) // 24, int(hours[end - 1]) // 24
+        inner = hours[start:end].searchsorted(numpy.arange(first_day + 1, last_day + 1) * 24, side="left") + start
+        return first_day, numpy.concatenate([[start], inner, [end]]).astype(numpy.int64)
+
+    def spatial_index(self):
+        """
+        Builds the spatial index of timeline_ranged: the rows in Morton order, i.e. sorted by the code of the first
+        descendant of their cell on the leaf level (see globals.cell_zkeys). The rows below a cell on level d are then
+        the keys [cell << 2 * (leaf_level - d), (cell + 1) << 2 * (leaf_level - d)), whatever the depth of the leaves.
+
+        @return: None.
+        """
+        if self.cell_order is None:
+            cells = self.tlr.cell.values
+            keys = cell_zkeys(cells, self.leaf_level)
+            self.cell_order = numpy.argsort(keys, kind="stable")
+            self.sorted_keys = keys[self.cell_order]
+            self.min_depth = int(cell_depth(cells).min()) if len(cells) else self.leaf_level
+
+    def region_ranges(self, region: Region):
+        """
+        Ranges of the spatial index whose leaf cells intersect region.
+
+        @param region: Region in WGS 84.
+        @return: numpy array of shape (n, 2) with start and end positions in the sorted keys, ranges may overlap.
+        """
+        self.spatial_index()
+        if not len(self.sorted_keys):
+            return numpy.zeros((0, 2), dtype=numpy.int64)
+        # deepest level on which at most spatial_index_cells cells cover the region
+        level = 0
+        while level < self.leaf_level and len(region_cells(region, level + 1)) <= spatial_index_cells:
+            level += 1
+        covering = region_cells(region, level)
+        # descendants of the covering cells
+        shift = numpy.uint64(2 * (self.leaf_level - level))
+        lo, hi = [covering << shift], [(covering + numpy.uint64(1)) << shift]
+        # leaves that are ancestors of the covering cells
+        for depth in range(self.min_depth, level):
+            ancestors = numpy.unique(covering >> numpy.uint64(2 * (level - depth)))
+            keys = cell_zkeys(ancestors, self.leaf_level)
+            lo.append(keys)
+            hi.append(keys + numpy.uint64(1))
+        lo, hi = numpy.concatenate(lo), numpy.concatenate(hi)
+        ranges = numpy.stack([self.sorted_keys.searchsorted(lo, side="left"), self.sorted_keys.searchsorted(hi, side="left")], axis=1)
+        return ranges[ranges[:, 1] > ranges[:, 0]]
+
+    def cell_index(self, level):
+        """
+        Inverted index of the cells of one tree level (the cells of MapInterface.layers[level]): the range of the rows
+        of every cell in the spatial index. Built on first use of a level from the runs of equal ancestors in Morton order.
+
+        @param level: Tree level.
+        @return: Tuple (cells, starts, ends) of arrays sorted by cell code.
+        """
+        if level not in self.cell_ranges:
+            self.spatial_index()
+            ancestors = cell_ancestor(self.tlr.cell.values[self.cell_order], level)
+            starts = numpy.flatnonzero(numpy.concatenate([[True], ancestors[1:] != ancestors[:-1]])) if len(ancestors) else numpy.array([], dtype=numpy.int64)
+            ends = numpy.append(starts[1:], len(ancestors))
+            order = numpy.argsort(ancestors[starts], kind="stable")
+            self.cell_ranges[level] = (ancestors[starts][order], starts[order], ends[order])
+        return self.cell_ranges[level]
+
+    def cell_rows(self, cell, level):
+        """
+        Rows of timeline_ranged in a cell of a tree level, one contiguous range of the spatial index
+        (several only if leaves of different depths overlap, which one TimeQuadTree does not produce).
+
+        @param cell: Cell code.
+        @param level: Tree level of the cell, leaves shallower than level are cells of the level themselves.
+        @return: DataFrame of rows of timeline_ranged sorted by hour.
+        """
+        cells, starts, ends = self.cell_index(level)
+        first, last = cells.searchsorted(numpy.uint64(cell), side="left"), cells.searchsorted(numpy.uint64(cell), side="right")
+        positions = [numpy.arange(starts[i], ends[i]) for i in range(first, last)]
+        return self.tlr.iloc[numpy.sort(self.cell_order[numpy.concatenate(positions + [numpy.array([], dtype=numpy.int64)])])]
+
+    def cell_contradictions(self, cell, level, timespan: TimeSpan, sensor: Sensor = None, thresholds=None):
+        """
+        Drill-down into one heatmap cell: its contradictions under the current dthresh with their sensor differences.
+
+        @param cell: Cell code.
+        @param level: Tree level of the cell.
+        @param timespan: Time interval.
+        @param sensor: Sensor whose threshold (sthresh) defines contradictions, None for all sensors.
+        @param thresholds: Array of the 7 sensor thresholds if sensor is None, default is the current sthresh.
+        @return: DataFrame with the columns time, label, longitude, latitude, rmin, rmax (km) and the maximal sensor
+                 difference within rmin (one column per sensor name) sorted by time.
+        """
+        if self.streaming:
+            chunks = [chunk[cell_ancestor(chunk.cell.values, level) == cell] for chunk in self.scan_timeline_ranged(timespan)]
+            rows = pandas.concat(chunks + [self.tlr])
+        else:
+            rows = self.cell_rows(cell, level)
+            first, last = hour_bounds(timespan)
+            rows = rows[(rows.hour.values >= first) & (rows.hour.values <= last)]
+        svalues = rows[["s0", "s1", "s2", "s3", "s4", "s5", "s6"]].values.astype(numpy.float32)
+        if sensor is not None:
+            contradicting = svalues[:, sensor.index] > self.sthresh[sensor.index]
+        else:
+            thresholds = self.sthresh if thresholds is None else thresholds
+            contradicting = (svalues > numpy.asarray(thresholds, dtype=numpy.float32)[None, :]).any(axis=1)
+        selection = self.distance_selection(rows) & contradicting
+        rows = rows[selection]
+        result = pandas.DataFrame(
+            {
+                "time": hours_to_time(rows.hour.values).astype("datetime64[ns]"),
+                "label": rows.label.values,
+                "longitude": rows.longitude.values,
+                "latitude": rows.latitude.values,
+                "rmin": rows.rmin.values * distance_unit,
+                "rmax": rows.rmax.values * distance_unit,
+            }
+        )
+        for j, name in enumerate(sensor_names):
+            result[name] = svalues[selection, j]
+        return result
+
+    def region_rows(self, region: Region, timespan: TimeSpan):
+        """
+        All rows of timeline_ranged inside region and timespan, whatever their distance band and sensor differences.
+
+        @param region: Spatial region of interest.
+        @param timespan: Time interval.
+        @return: DataFrame of rows of timeline_ranged.
+        """
+        cregion = copy(region)
+        if cregion.projection == "Web":
+            cregion.web_to_wgs()
+        if self.streaming:
+            chunks = list(self.scan_timeline_ranged(timespan))
+        else:
+            chunks = [self.tlr_candidates(cregion, timespan)]
+        if cregion != default_region:
+            chunks = [chunk[self.region_selection(chunk, cregion)] for chunk in chunks]
+        return pandas.concat(chunks + [self.tlr.iloc[:0]])
+
+    def tlr_candidates(self, region: Region, timespan: TimeSpan):
+        """
+        Rows of timeline_ranged inside timespan that may lie in region. For small regions the spatial index is used,
+        otherwise the hour slice. The exact region test is left to region_selection().
+
+        @param region: Region in WGS 84.
+        @param timespan: Time interval.
+        @return: DataFrame of rows of timeline_ranged sorted by hour.
+        """
+        start, end = self.hour_rows(timespan)
+        if region == default_region or region_within(default_region, region):
+            return self.tlr.iloc[start:end]
+        ranges = self.region_ranges(region)
+        if (ranges[:, 1] - ranges[:, 0]).sum() >= end - start:
+            return self.tlr.iloc[start:end]
+        rows = numpy.unique(self.cell_order[numpy.concatenate([numpy.arange(a, b) for a, b in ranges] + [numpy.array([], dtype=numpy.int64)])])
+        # rows are sorted by hour, so the timespan is a contiguous position range
+        rows = rows[(rows >= start) & (rows < end)]
+        return self.tlr.iloc[rows]
+
+    def distance_selection(self, tlr):
+        """
+        Boolean array of the rows of tlr whose distance band contains the current distance threshold dthresh.
+
+        @param tlr: Rows of timeline_ranged.
+        @return: numpy bool array.
+        """
+        dthresh = self.dthresh / distance_unit
+        return (tlr.rmin.values <= dthresh) & (tlr.rmax.values > dthresh)
+
+    @staticmethod
+    def region_selection(data, region: Region):
+        """
+        Boolean array of the rows of data (with the columns longitude and latitude) inside region.
+
+        @param data: DataFrame.
+        @param region: Region in WGS 84.
+        @return: numpy bool array.
+        """
+        return (
+            (data.longitude.values >= region.x_min)
+            & (data.longitude.values < region.x_max)
+            & (data.latitude.values >= region.y_min)
+            & (data.latitude.values < region.y_max)
+        )
+
+    def query_all_sensors(self, region: Region = default_region, timespan: TimeSpan = default_timespan, thresholds=None):
+        """
+        Evaluates the contradiction thresholds of all seven sensors s0..s6 in a single pass over timeline_ranged.
+
+        @param region: Spatial region of interest.
+        @param timespan: Time interval of interest.
+        @param thresholds: Array of the 7 sensor thresholds, default is the current sthresh.
+        @return: DataFrame with the columns hour, label, cell and mask, where bit j of mask is set if the row
+                 contradicts in sensor j. Rows without any contradiction are dropped.
+        """
+        cregion = copy(region)
+        ctimespan = copy(timespan)
+        if cregion.projection == "Web":
+            cregion.web_to_wgs()
+        if thresholds is None:
+            thresholds = self.sthresh
+        if self.streaming:
+            return pandas.concat(
+                list(self.stream_contradictions(cregion, ctimespan, thresholds=thresholds))
+                + [self.all_sensor_contradictions(self.tlr, cregion, thresholds)]
+            )
+        return self.all_sensor_contradictions(self.tlr_candidates(cregion, ctimespan), cregion, thresholds)
+
+    def all_sensor_contradictions(self, tlr, region: Region, thresholds):
+        """
+        Contradictions of all seven sensors among rows of timeline_ranged, see query_all_sensors().
+
+        @param tlr: Rows of timeline_ranged.
+        @param region: Region in WGS 84.
+        @param thresholds: Array of the 7 sensor thresholds.
+        @return: DataFrame with the columns hour, label, cell and mask.
+        """
+        selection = self.distance_selection(tlr)
+        if region != default_region:
+            selection &= self.region_selection(tlr, region)
+        svalues = tlr[["s0", "s1", "s2", "s3", "s4", "s5", "s6"]].values.astype(numpy.float32)
+        bits = (svalues > numpy.asarray(thresholds, dtype=numpy.float32)[None, :]).astype(numpy.uint8)
+        mask = (bits << numpy.arange(7, dtype=numpy.uint8)[None, :]).sum(axis=1, dtype=numpy.uint8)
+        selection &= mask > 0
+        results = tlr.loc[selection, ["hour", "label", "cell"]]
+        results["mask"] = mask[selection]
+        return results
 
     def spatial_range_update(self, range: float):
         """
@@ -1,6 +1,7 @@
 import math
 import datetime
 import os
+import re
 import pyproj
 import numpy as np
 
@@ -10,12 +11,61 @@ lat_north = 54.6
 lon_west = 7.2
 lon_east = 9.5
 
-# Maximum distance threshold (km)
-max_distance_threshold = 1
+# Maximum distance threshold (km), the radius of the neighbour lists and of timeline_ranged. Changing it (OTV_MAX_DISTANCE)
+# requires neighbour lists and a timeline_ranged computed with that radius, see preprocessing/neighbourRadius.py
+max_distance_threshold = float(os.environ.get("OTV_MAX_DISTANCE", "1"))
+if not 0 < max_distance_threshold < 65:
+    # rmin and rmax are stored as uint16 meters
+    raise ValueError("OTV_MAX_DISTANCE must be between 0 and 65 km")
+# Number of hours getddict() holds in memory at once, the neighbour pairs grow with the square of the radius
+getddict_chunk_hours = 24 * 7
+
+# Sensors in the order of the columns s0..s6 of timeline_ranged and the range of sensible contradiction thresholds
+sensor_names = ["Salinity", "Temperature", "CDOM", "Chlorophyll", "DO", "DOSat", "DO_Anomaly"]
+sensor_threshold_max = [13.14, 5.87, 267.6, 54.688, 302.74237, 122.06771, 313.9831]
+sensor_threshold_min = [0.12, 0.06069784417908664, 2.694795877619763, 0.4561302076278833, 1.4704905987017072, 0.5743938969588057,
+                        1.5104531916051702]
+# Reference time for day and hour offsets
+time_epoch = datetime.datetime(2013, 6, 1)
+# Unit of the quantized rmin/rmax columns of the compact timeline_ranged (km), i.e. meters
+distance_unit = 0.001
+
+# Quantization of the threshold/distance sweep histograms (see sweep.py)
+sweep_levels = [6, 7]
+sweep_threshold_bins = 16
+sweep_distance_step = 0.1  # km
+
+# Maximal number of heatmap rectangles in the viewport, the deepest tree level within this budget is shown
+heatmap_cell_budget = 1500
+# Frames per second of the hour-by-hour heatmap playback
+playback_fps = 4
+# Maximal number of rows sent to the browser for client-side filtering, larger viewports stay on the server
+client_table_rows = 1_000_000
+# Progressive heatmap: intervals that need at least progressive_min_days days to be queried are first shown approximately
+# from a stratified sample of approximate_sample_rows rows of timeline_ranged, then refined to the exact counts
+progressive_min_days = 7
+approximate_sample_rows = 20_000
+
+# Viewport-bounded aggregation: views smaller than this share of the area of interest only aggregate the viewport,
+# enlarged by the margin (relative to its width and height on every side) so that small pans need no recomputation
+viewport_aggregation_share = 0.25
+viewport_margin = 0.5
+# Maximal number of cells covering a queried region in the spatial index of timeline_ranged
+spatial_index_cells = 64
+
+# Out-of-core mode: timeline_ranged is not loaded, contradiction queries scan the parquet file in chunks of stream_batch_rows
+streaming = os.environ.get("OTV_STREAMING", "0") == "1"
+stream_batch_rows = 1_000_000
+
+# Pseudo sensor for contradictions in any of the sensors, its threshold is relative to the threshold range of each sensor
+all_sensors = "All sensors"
 
 # File Locations
-data_prefix = os.path.join(os.path.split(os.path.dirname(os.path.abspath(__file__)))[0], "data")
-tree_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trees", "allData")
+# The environment variables allow to run the app and the preprocessing on another dataset, e.g. the synthetic one from synthetic.py
+data_prefix = os.environ.get("OTV_DATA_PREFIX", os.path.join(os.path.split(os.path.dirname(os.path.abspath(__file__)))[0], "data"))
+neighbour_prefix = os.environ.get("OTV_NEIGHBOUR_PREFIX", os.path.join(os.path.dirname(os.path.abspath(__file__)), "neighbours"))
+tree_prefix = os.environ.get("OTV_TREE_PREFIX", os.path.join(os.path.dirname(os.path.abspath(__file__)), "trees"))
+tree_path = os.path.join(tree_prefix, "allData")
 
 sensors_suffix = "sensors.parquet"
 timeline_suffix = "timeline.parquet"
@@ -29,9 +79,51 @@ path_meta_db = os.path.join(data_prefix, sensor_metadata_suffix)
 path_trajectories_db = os.path.join(data_prefix, trajectories_suffix)
 path_time_db = os.path.join(data_prefix, timeline_suffix)
 path_timeline_ranged_db = os.path.join(data_prefix, timeline_ranged_suffix)
+# Space-time contradictions (preprocessing/spaceTimeNeighbours.py): neighbours in the same and in the adjacent hours.
+# With OTV_SPACETIME=1 the app queries this table (and its sweep histograms) instead of timeline_ranged
+timeline_ranged_spacetime_suffix = "timeline_ranged_spacetime.parquet"
+path_timeline_ranged_spacetime_db = os.path.join(data_prefix, timeline_ranged_spacetime_suffix)
+spacetime = os.environ.get("OTV_SPACETIME", "0") == "1"
+if spacetime:
+    path_timeline_ranged_db = path_timeline_ranged_spacetime_db
 path_clustered = os.path.join(data_prefix, clustered_suffix)
 path_range_dict = os.path.join(data_prefix, range_dict_suffix)
 
+sweep_histograms_suffix = "sweep_histograms_spacetime.npz" if spacetime else "sweep_histograms.npz"
+path_sweep_histograms = os.path.join(data_prefix, sweep_histograms_suffix)
+
+# Hierarchical trajectory clustering (preprocessing/hierarchicalClustering.py): distance cuts in km, minimal number of shared
+# timestamps of two linked trajectories and the cut shown per map zoom, zoom levels deeper than the deepest key keep its
+# cut (the single trajectories of all hours are too many polylines for a map response, see Map.trajectory_cut)
+cluster_cuts = [2, 5, 10, 20]
+cluster_min_shared_hours = 50
+cluster_zoom_cuts = {7: 20, 8: 10, 9: 5, 10: 2}
+clustered_levels_suffix = "clustered-levels.parquet"
+cluster_linkage_suffix = "clustered-linkage.npz"
+path_clustered_levels = os.path.join(data_prefix, clustered_levels_suffix)
+path_cluster_linkage = os.path.join(data_prefix, cluster_linkage_suffix)
+
+# CSR neighbour graph of the trajectory points (see neighbour_graph.py), a directory of memory-mapped .npy files
+neighbour_graph_suffix = "neighbour_graph"
+path_neighbour_graph = os.path.join(data_prefix, neighbour_graph_suffix)
+
+# Persistent result cache (shared by all workers)
+result_cache_suffix = "result_cache.sqlite"
+path_result_cache = os.path.join(data_prefix, result_cache_suffix)
+result_cache_max_bytes = 512 * 1024 * 1024
+# Input files whose size and modification time make up the data fingerprint of cached results
+result_cache_inputs = [path_sensors_db, path_time_db, path_timeline_ranged_db, path_range_dict]
+# Version of the format of cached results (tuple of the layers dict and the time distribution, see MapInterface.tree_cache),
+# part of the data fingerprint and of the warm snapshot. Increase it whenever the layer structure changes
+result_format_version = 2
+# Cache warmer: after the start the most requested views are computed in a background thread (see cache_warmer.py)
+# and written to a snapshot that is loaded into memory on the next start. OTV_WARM=0 switches it off
+warm_on_start = os.environ.get("OTV_WARM", "1") != "0"
+warm_requests = 20
+warm_pause = 0.1  # seconds between two warmed views, leaves the interpreter to the callbacks
+warm_snapshot_suffix = "warm_snapshot.pickle"
+path_warm_snapshot = os.path.join(data_prefix, warm_snapshot_suffix)
+
 # WGS -> Web
 transformer_web = pyproj.Transformer.from_proj(proj_from=pyproj.Proj("EPSG:4326"), proj_to=pyproj.Proj("EPSG:3857"))
 
@@ -69,8 +161,9 @@ def distance_wgs(lon1, lat1, lon2, lat2):
             Longitude, Latitude of second point
     Output: Distance in kilometers
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
+    # convert decimal degrees to radians, works on scalars and arrays
+    lon1, lat1, lon2, lat2 = map(np.radians, [np.asarray(lon1, dtype=np.float64), np.asarray(lat1, dtype=np.float64),
+                                              np.asarray(lon2, dtype=np.float64), np.asarray(lat2, dtype=np.float64)])
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
@@ -175,6 +268,52 @@ class Region:
 default_region = Region()
 
 
+# Tree cell codes
+
+
+def treecodes(lon, lat, depth, region=default_region):
+    """
+    Computes the code of the depth-level cell of a fully divided quadtree over region for each point.
+    Uses the same child names and boundary rules as QuadTree.divide() and Region.contains(), so the codes are
+    prefixes of the codes of the preprocessed TimeQuadTree wherever its leaves are at least depth deep.
+
+    Input:  Arrays of longitudes and latitudes, depth of the cells, root boundary of the tree
+    Output: Array of code strings like '.nw.se...'
+    """
+    x_min = np.full(len(lon), region.x_min, dtype=np.float64)
+    y_min = np.full(len(lat), region.y_min, dtype=np.float64)
+    w, h = region.w, region.h
+    names = np.array([[".sw", ".se"], [".nw", ".ne"]])
+    codes = np.full(len(lon), "", dtype=object)
+    for _ in range(depth):
+        w, h = w / 2, h / 2
+        east = lon >= x_min + w
+        north = lat >= y_min + h
+        codes = codes + names[north.astype(int), east.astype(int)]
+        x_min = x_min + east * w
+        y_min = y_min + north * h
+    return codes
+
+
+def treecode_region(code, region=default_region):
+    """
+    Input:  Code of a tree cell like '.nw.se...', root boundary of the tree
+    Output: Region of the cell, same as the boundary of the TimeQuadTree node with this code
+    """
+    x_min, x_max, y_min, y_max = region.x_min, region.x_max, region.y_min, region.y_max
+    for quadrant in code.split(".")[1:]:
+        x_mid, y_mid = x_min + (x_max - x_min) / 2, y_min + (y_max - y_min) / 2
+        if quadrant[0] == "n":
+            y_min = y_mid
+        else:
+            y_max = y_mid
+        if quadrant[1] == "e":
+            x_min = x_mid
+        else:
+            x_max = x_mid
+    return Region(x_min, x_max, y_min, y_max)
+
+
 class TimeSpan:
     """
     The TimeSpan object is used to define the timespan in a query.
@@ -263,3 +402,253 @@ def DO_Anomaly(max=1.0):
     units = "umol"
     index = 6
     return Sensor(name, units, index, max)
+
+
+# Integer cell codes
+# A tree cell is encoded as an integer with a leading 1 followed by two bits per level (nw=0, ne=1, sw=2, se=3),
+# e.g. '.ne.sw' -> 0b1_01_10 = 22. The root is 1, the parent of a cell is cell >> 2.
+quadrant_names = ["nw", "ne", "sw", "se"]
+quadrant_digits = {name: digit for digit, name in enumerate(quadrant_names)}
+# maximal depth of the TimeQuadTree (QuadTree.max_depth), codes fit into uint64
+max_cell_depth = 20
+
+
+def treecode_to_cell(code):
+    """
+    Input:  Code of a tree cell like '.nw.se...'
+    Output: Integer cell code
+    """
+    cell = 1
+    for quadrant in code.split(".")[1:]:
+        cell = cell * 4 + quadrant_digits[quadrant]
+    return cell
+
+
+def cell_to_treecode(cell):
+    """
+    Input:  Integer cell code
+    Output: Code of the tree cell like '.nw.se...'
+    """
+    cell = int(cell)
+    parts = []
+    while cell > 1:
+        parts.append("." + quadrant_names[cell & 3])
+        cell >>= 2
+    return "".join(reversed(parts))
+
+
+def cell_depth(cells):
+    """
+    Input:  Array of integer cell codes
+    Output: Array of their tree levels
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    depth = np.zeros(cells.shape, dtype=np.int64)
+    for level in range(1, max_cell_depth + 1):
+        depth += cells >= np.uint64(4**level)
+    return depth
+
+
+def cell_ancestor(cells, level):
+    """
+    Input:  Array of integer cell codes, tree level
+    Output: Codes of the ancestors on level, cells that are not as deep as level are kept (like the treecode prefixes)
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    shift = 2 * np.maximum(cell_depth(cells) - level, 0)
+    return cells >> shift.astype(np.uint64)
+
+
+def cell_zkeys(cells, depth):
+    """
+    Input:  Array of integer cell codes, depth of the deepest cells
+    Output: Codes of the first descendants on depth (Morton keys), sorting by them puts every cell before its descendants
+            and the cells of any subtree next to each other
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    shift = 2 * np.maximum(depth - cell_depth(cells), 0)
+    return cells << shift.astype(np.uint64)
+
+
+def point_cells(lon, lat, depth, region=default_region):
+    """
+    Integer version of treecodes()
+
+    Input:  Arrays of longitudes and latitudes, depth of the cells, root boundary of the tree
+    Output: Array of integer cell codes
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x_min = np.full(len(lon), region.x_min, dtype=np.float64)
+    y_min = np.full(len(lat), region.y_min, dtype=np.float64)
+    w, h = region.w, region.h
+    cells = np.ones(len(lon), dtype=np.uint64)
+    for _ in range(depth):
+        w, h = w / 2, h / 2
+        east = lon >= x_min + w
+        north = lat >= y_min + h
+        cells = cells * np.uint64(4) + (2 * (~north) + east).astype(np.uint64)
+        x_min = x_min + east * w
+        y_min = y_min + north * h
+    return cells
+
+
+def grid_cells(ix, iy, level):
+    """
+    Input:  Arrays of column (from the west) and row (from the north) indices on the 2^level x 2^level grid of a tree level
+    Output: Array of integer cell codes
+    """
+    ix = np.asarray(ix, dtype=np.uint64)
+    iy = np.asarray(iy, dtype=np.uint64)
+    cells = np.full(ix.shape, 4**level, dtype=np.uint64)
+    for bit in range(level):
+        cells |= ((ix >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        cells |= ((iy >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return cells
+
+
+def region_cells(region, level, root=default_region):
+    """
+    Input:  Region in WGS 84, tree level, root boundary of the tree
+    Output: Array of the integer codes of all cells on level that intersect region
+    """
+    n = 2**level
+    w, h = root.w / n, root.h / n
+    x0 = min(max(int(np.floor((region.x_min - root.x_min) / w)), 0), n - 1)
+    x1 = min(max(int(np.floor((region.x_max - root.x_min) / w)), 0), n - 1)
+    y0 = min(max(int(np.floor((root.y_max - region.y_max) / h)), 0), n - 1)
+    y1 = min(max(int(np.floor((root.y_max - region.y_min) / h)), 0), n - 1)
+    ix, iy = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+    return grid_cells(ix.ravel(), iy.ravel(), level)
+
+
+def expand_region(region, margin):
+    """
+    Input:  Region, margin relative to the width and height of region
+    Output: New Region enlarged by the margin on every side
+    """
+    return Region(
+        region.x_min - margin * region.w,
+        region.x_max + margin * region.w,
+        region.y_min - margin * region.h,
+        region.y_max + margin * region.h,
+        region.projection,
+    )
+
+
+def region_within(inner, outer):
+    """Whether the Region inner lies completely inside the Region outer"""
+    return inner.x_min >= outer.x_min and inner.x_max <= outer.x_max and inner.y_min >= outer.y_min and inner.y_max <= outer.y_max
+
+
+def cell_bounds(cells, region=default_region):
+    """
+    Input:  Array of integer cell codes, root boundary of the tree
+    Output: Arrays x_min, x_max, y_min, y_max of the cell boundaries
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    depth = cell_depth(cells)
+    x_min = np.full(len(cells), region.x_min, dtype=np.float64)
+    y_min = np.full(len(cells), region.y_min, dtype=np.float64)
+    w = np.full(len(cells), region.w, dtype=np.float64)
+    h = np.full(len(cells), region.h, dtype=np.float64)
+    for level in range(1, int(depth.max(initial=0)) + 1):
+        active = depth >= level
+        digit = (cells >> (2 * np.maximum(depth - level, 0)).astype(np.uint64)) & np.uint64(3)
+        east = active & ((digit & np.uint64(1)) == 1)
+        south = active & ((digit & np.uint64(2)) == 2)
+        w = np.where(active, w / 2, w)
+        h = np.where(active, h / 2, h)
+        x_min = x_min + east * w
+        y_min = y_min + (active & ~south) * h
+    return x_min, x_min + w, y_min, y_min + h
+
+
+def cell_regions(cells, region=default_region):
+    """
+    Input:  Array of integer cell codes, root boundary of the tree
+    Output: List of Region objects of the cells, same as the boundaries of the TimeQuadTree nodes
+    """
+    x_min, x_max, y_min, y_max = cell_bounds(cells, region)
+    return [Region(*bounds) for bounds in zip(x_min.tolist(), x_max.tolist(), y_min.tolist(), y_max.tolist())]
+
+
+# Hour offsets
+
+
+def hour_offset(t):
+    """
+    Input:  datetime
+    Output: Hours since time_epoch as float
+    """
+    return (t - time_epoch).total_seconds() / 3600
+
+
+def hours_to_time(hours):
+    """
+    Input:  Array of hour offsets
+    Output: DatetimeIndex-compatible numpy datetime64 array
+    """
+    return np.datetime64(time_epoch, "h") + np.asarray(hours).astype("timedelta64[h]")
+
+
+# Day numbers
+# The time controls count days from time_epoch, day 1 is 2013-06-01. June 2013 are the days 1 to 30.
+
+
+def day_number(t):
+    """
+    Input:  datetime
+    Output: Day number of t (1 for the day of time_epoch)
+    """
+    return (t - time_epoch).days + 1
+
+
+def day_start(day):
+    """
+    Input:  Day number
+    Output: datetime of 0:00 of the day
+    """
+    return time_epoch + datetime.timedelta(days=int(day) - 1)
+
+
+def day_end(day):
+    """
+    Input:  Day number
+    Output: datetime of 23:00 of the day, the last hour in the data
+    """
+    return day_start(day) + datetime.timedelta(hours=23)
+
+
+# Hourly input files
+
+
+def synop_time(file_name):
+    """
+    Input:  Name of an hourly trajectory file like 'synop_2013060112.nc'
+    Output: datetime of the file or None if the name does not match
+    """
+    match = re.fullmatch(r"synop_(\d{10})\.nc", os.path.basename(file_name))
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), "%Y%m%d%H")
+
+
+def neighbour_dir(distance=max_distance_threshold):
+    """
+    Input:  Neighbour radius in km
+    Output: Directory of the neighbour lists of that radius, e.g. neighbours/1km_distance
+    """
+    return os.path.join(neighbour_prefix, f"{distance:g}km_distance")
+
+
+def neighbour_file(result_path, t):
+    """
+    Input:  Directory of the neighbour lists (neighbours/<distance>km_distance), datetime of the hour
+    Output: Path of the neighbour list of the hour, the June 2013 lists may still use the old name '<day>_<hour>.csv'
+    """
+    path = os.path.join(result_path, f"{t:%Y%m%d%H}.csv")
+    legacy = os.path.join(result_path, f"{t.day}_{t.hour}.csv")
+    if not os.path.exists(path) and (t.year, t.month) == (2013, 6) and os.path.exists(legacy):
+        return legacy
+    return path
@@ -11,8 +11,10 @@ class Interface:
         self.sensor_lookup = db.sensors
         # Get trajectory data from database and preprocess it
         self.tr = db.trajectories.reset_index()
-        self.tr["day"] = self.tr["time"].apply(lambda x: x.day)
-        self.tr = self.tr.sort_values(by="time")
+        self.tr["day"] = self.tr["time"].dt.day
+        self.tr = self.tr.sort_values(by="time", kind="mergesort").reset_index(drop=True)
+        # dense label ids of the rows, the sensor values are gathered from db.encoding.sensor_values
+        self.label_ids = db.encoding.ids(self.tr.label.values)
 
     def get_graph_data(
         self,
@@ -31,17 +33,17 @@ class Interface:
         :param unique: Whether only one point per trajectory should be included in histogram
         :return: Pandas dataFrame filtered according to parameter of this function and with appended sensor values to each row
         """
+        # the rows are sorted by time, the time interval is a slice
+        times = self.tr.time.values
+        first = np.searchsorted(times, np.datetime64(start_time), side="left")
+        last = np.searchsorted(times, np.datetime64(end_time), side="left")
+        rows = self.tr.iloc[first:last]
+        lon = rows.longitude.values
+        lat = rows.latitude.values
+        selection = np.flatnonzero((lon >= fov.x_min) & (lon < fov.x_max) & (lat >= fov.y_min) & (lat < fov.y_max))
 
-        filtered_data = self.tr[
-            (self.tr.longitude >= fov.x_min)
-            & (self.tr.longitude < fov.x_max)
-            & (self.tr.latitude >= fov.y_min)
-            & (self.tr.longitude < fov.y_max)
-            & (self.tr.time >= start_time)
-            & (self.tr.time < end_time)
-        ]
-
-        sensor_vals = self.sensor_lookup[sensor]
-        data_with_sensor = pd.merge(filtered_data, sensor_vals, how="left", left_on="label", right_on="label")
+        data_with_sensor = rows.iloc[selection].reset_index(drop=True)
+        ids = self.label_ids[first:last][selection]
+        data_with_sensor[sensor] = self.db.encoding.sensor_values[ids, sensor_names.index(sensor)]
 
         return data_with_sensor
@@ -1,4 +1,6 @@
 import dash_leaflet as dl
+import numpy as np
+from globals import *
 
 
 class Map:
@@ -12,6 +14,8 @@ class Map:
         )
         self.heat_layer = []
         self.trajectory_layer = []
+        # zoom the trajectory overlay was loaded for
+        self.trajectory_zoom = None
         self.map = dl.Map(
             [
                 dl.LayersControl(
@@ -19,6 +23,8 @@ class Map:
                     + [
                         dl.Overlay(dl.LayerGroup(), name="Heat Map", checked=True),
                         dl.Overlay(dl.LayerGroup(), name="Trajectories", checked=False),
+                        dl.Overlay(dl.LayerGroup(id="playback_layer"), name="Playback", checked=True),
+                        dl.Overlay(dl.LayerGroup(id="client_layer"), name="Browser Heat Map", checked=True),
                     ]
                 )
             ],
@@ -35,49 +41,85 @@ class Map:
             },
         )
 
-    def load_trajectories(self, zoom_level=0):
+    @staticmethod
+    def trajectory_cut(zoom):
+        """
+        Distance cut (km) of the clustering shown at a map zoom: the cut of the deepest zoom of globals.cluster_zoom_cuts
+        that is not deeper than zoom, zooms beyond the deepest one keep its (finest) cut
+        :return: Cut or None if zoom is None
+        """
+        if zoom is None:
+            return None
+        zooms = [z for z in sorted(cluster_zoom_cuts) if z <= zoom] or [min(cluster_zoom_cuts)]
+        return cluster_zoom_cuts[zooms[-1]]
+
+    def load_trajectories(self, zoom=None, single=False):
+        """
+        Fills the trajectory overlay, the level of detail follows the zoom
+        :param zoom: Map zoom, the clustering of its cut is shown (see trajectory_cut).
+                     None or missing clusterings show the fixed clustering of clustered-10km.parquet
+        :param single: Show every single trajectory instead
+        :return: Children of the map
+        """
         self.trajectory_layer = []
-        if zoom_level == 0:
-            df = self.db.clustered
-        if zoom_level == 1:
+        cut = self.trajectory_cut(zoom)
+        if single:
             df = self.db.trajectories
-        positions = list()
-        label = df.head(1).index.get_level_values(0).values[0]
-        weight = 1
-        for index, row in df.iterrows():
-            if label != index[0]:
-                opacity = min(float(weight / 600), 1)
-                if zoom_level == 1:
-                    opacity = 1
+        elif cut is not None and self.db.clustered_levels is not None:
+            levels = self.db.clustered_levels
+            cuts = levels.index.get_level_values("cut").unique()
+            # nearest computed cut
+            df = levels.xs(cuts[abs(cuts - cut).argmin()], level="cut")
+        else:
+            df = self.db.clustered
+        labels = df.index.get_level_values(0).values
+        if len(labels):
+            starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+            ends = np.append(starts[1:], len(labels))
+            positions = np.stack([df.latitude.values, df.longitude.values], axis=1).tolist()
+            if "weight" in df.columns:
+                weights = df.weight.values[starts].astype(float)
+                # the fixed clustering keeps its scale, the levels are scaled to their largest cluster
+                scale = 600 if df is self.db.clustered else max(weights.max(), 1)
+                opacities = np.minimum(weights / scale, 1)
+                if df is not self.db.clustered:
+                    opacities = np.maximum(opacities, 0.2)
+            else:
+                opacities = np.ones(len(starts))
+            for start, end, opacity in zip(starts, ends, opacities):
                 self.trajectory_layer.append(
                     dl.Polyline(
-                        positions=positions,
+                        positions=positions[start:end],
                         color="blue",
-                        opacity=opacity,
+                        opacity=float(opacity),
                         smoothFactor=2,
                     )
                 )
-                positions = []
-                label = index[0]
-                weight = 1
-            positions.append([row["latitude"], row["longitude"]])
-            if zoom_level != 1:
-                weight = row["weight"]
+        self.trajectory_zoom = zoom
         self.map.children[0].children[2].children = [dl.LayerGroup(self.trajectory_layer)]
         return self.map.children
 
-    def add_rect(self, bounds, color, opacity):
-        self.heat_layer.append(
-            dl.Rectangle(
-                bounds=bounds,
-                color=color,
-                opacity=opacity,
-                fillOpacity=opacity,
-                stroke=False,
-            )
+    def add_rect(self, bounds, color, opacity, tooltip=None):
+        rect = dl.Rectangle(
+            bounds=bounds,
+            color=color,
+            opacity=opacity,
+            fillOpacity=opacity,
+            stroke=False,
         )
+        if tooltip is not None:
+            rect.children = dl.Tooltip(tooltip)
+        self.heat_layer.append(rect)
 
-    def render_heatmap(self, rects, max_heat, mbound):
+    def render_heatmap(self, rects, max_heat, mbound, errors=None):
+        """
+        Fills the heatmap overlay
+        :param rects: List of tuples (boundary, heat), see MapInterface.get_rects_and_heat
+        :param max_heat: Heat of the darkest colour
+        :param mbound: Visible map area, only the rectangles intersecting it are drawn
+        :param errors: Standard errors of approximate heats, shown as tooltips of the rectangles
+        :return: Children of the map
+        """
         self.heat_layer = []
         max_heat = max(1, max_heat)
         for i in range(len(rects)):
@@ -94,7 +136,8 @@ class Map:
             blue = round(blue_min * (1 - scale) + blue_max * scale)
             color = f"#{red:02x}{green:02x}{blue:02x}"
             if mbound.intersects(rect[0]) and scale != 0:
-                self.add_rect(rect[0].to_rect(), color, float(scale != 0) * 0.7)
+                tooltip = f"≈ {rect[1]:.0f} ± {errors[i]:.0f}" if errors is not None else None
+                self.add_rect(rect[0].to_rect(), color, float(scale != 0) * 0.7, tooltip)
         self.map.children[0].children[1].children = [dl.LayerGroup(self.heat_layer)]
         return self.map.children
 
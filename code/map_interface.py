@@ -1,9 +1,15 @@
+import base64
+from collections import OrderedDict
+import pandas as pd
 from globals import *
+import metrics
 
 
 class MapInterface:
-    def __init__(self, db):
+    def __init__(self, db, result_cache=None):
         self.db = db
+        # optional persistent cache shared by all workers (see result_cache.py)
+        self.result_cache = result_cache
 
         # Compatability functionality with database.py, Maps String to Function that can creates Sensor Object for querries
         self.sensor_map = {
@@ -19,26 +25,30 @@ class MapInterface:
         # Caching
         # tree cache keys = tuple(sensor, start_time, end_time, sensor_dist), values = tree reference
         self.tree_cache = dict()
-        self.layer9 = []
-        self.layer8 = []
-        self.layer7 = []
-        self.layer6 = []
-
-        # Maps map-zoom-level to tree level cells
-        self.mapzoom2treezoom = {
-            18: 9,
-            17: 9,
-            16: 9,
-            15: 8,
-            14: 8,
-            13: 7,
-            12: 7,
-            11: 6,
-            10: 6,
-            9: 6,
-            8: 6,
-            7: 6,
-        }
+        # heatmap layers of all tree levels: level -> DataFrame with the columns cell, count (and the cell bounds once shown)
+        self.layers = dict()
+        # deepest level of the cells in timeline_ranged
+        self.leaf_level = db.leaf_level
+
+        # Incremental day windows
+        # day cache keys = tuple(sensor, sensor_threshold, dist_threshold), values = dict(day -> (leaf counts, time distribution))
+        self.day_cache = OrderedDict()
+        self.day_cache_size = 8
+        # running leaf counts of the last day-aligned window: (day cache key, first day, last day, counts)
+        self.window = None
+        # leaf counts per sensor of the last "All sensors" query
+        self.sensor_counts = None
+
+        # Viewport-bounded aggregation
+        # area the current layers were aggregated for, None is the whole area of interest
+        self.extent = None
+        # tree cache key and time distribution of the viewport-bounded layers
+        self.extent_key = None
+        self.extent_distribution = None
+
+        # Progressive heatmap
+        # None if the current layers are exact, else dict(sampled=rows in the sample, rows=rows in the interval)
+        self.approximation = None
 
     def compute_current_tree(
         self,
@@ -47,6 +57,8 @@ class MapInterface:
         start_time=datetime.datetime(2013, 6, 1),
         end_time=datetime.datetime(2013, 6, 30),
         dist_threshold: int = 1,
+        viewport=None,
+        approximate=False,
     ):
         """
         Generate the current tree that supplies heatmap data and set it to self.tree
@@ -56,81 +68,607 @@ class MapInterface:
         :param start_time: Start time for time interval of interest
         :param end_time: End time for time interval of interest
         :param dist_threshold: Max spatial distance of contradictions
+        :param viewport: Visible map area in WGS coordinates. If it is small and the whole area is not cached yet,
+                         only the viewport plus a margin is aggregated and self.extent is set to that area
+        :param approximate: If the exact layers are not cached and the interval is long (see is_long_window), set
+                            approximate layers from a sample instead (see approximate_layers), they are not cached
         """
+        self.approximation = None
         # update database
         self.db.spatial_range_update(dist_threshold)
-        self.db.sensor_update(sensor=self.sensor_map[sensor](sensor_threshold))
+        if sensor != all_sensors:
+            self.db.sensor_update(sensor=self.sensor_map[sensor](sensor_threshold))
 
         # load from cache if possible
-        if (
-            sensor,
-            sensor_threshold,
-            start_time,
-            end_time,
-            dist_threshold,
-        ) in self.tree_cache:
-            (
-                self.layer9,
-                self.layer8,
-                self.layer7,
-                self.layer6,
-                contradiction_distribution,
-            ) = self.tree_cache[(sensor, sensor_threshold, start_time, end_time, dist_threshold)]
+        key = (sensor, sensor_threshold, start_time, end_time, dist_threshold)
+        if key in self.tree_cache:
+            metrics.count("tree_cache_total", cache="memory", result="hit")
+        elif self.result_cache is not None:
+            with metrics.span("compute_stage", stage="result_cache_get"):
+                stored = self.result_cache.get(self.result_cache.make_key(*key))
+            metrics.count("tree_cache_total", cache="disk", result="miss" if stored is None else "hit")
+            if stored is not None:
+                self.tree_cache[key] = stored
+        if key in self.tree_cache:
+            self.layers, contradiction_distribution = self.tree_cache[key]
+            self.extent = None
             return contradiction_distribution
-        # query
-        contradict_data = self.db.query(
-            timespan=TimeSpan(start_time, end_time),
-            sensor=self.sensor_map[sensor](),
-            contradictions=True,
-        )
-        # Layer 9
-        contradict_data.treecode = contradict_data.treecode.apply(lambda x: x[0 : 3 * 9] if (len(x) > 3 * 9) else x)
-        self.layer9 = contradict_data.groupby("treecode").size().to_frame().rename(columns={0: "count"}).reset_index()
-        self.layer9["bounds"] = self.layer9.treecode.map(self.db.rdict)
-        # Layer 8
-        self.layer9.treecode = self.layer9.treecode.apply(lambda x: x[0 : 3 * 8] if (len(x) > 3 * 8) else x)
-        self.layer8 = self.layer9.groupby("treecode")["count"].sum().to_frame().rename(columns={0: "count"}).reset_index()
-        self.layer8["bounds"] = self.layer8.treecode.map(self.db.rdict)
-        # Layer 7
-        self.layer8.treecode = self.layer8.treecode.apply(lambda x: x[0 : 3 * 7] if (len(x) > 3 * 7) else x)
-        self.layer7 = self.layer8.groupby("treecode")["count"].sum().to_frame().rename(columns={0: "count"}).reset_index()
-        self.layer7["bounds"] = self.layer7.treecode.map(self.db.rdict)
-        # Layer 6
-        self.layer7.treecode = self.layer7.treecode.apply(lambda x: x[0 : 3 * 6] if (len(x) > 3 * 6) else x)
-        self.layer6 = self.layer7.groupby("treecode")["count"].sum().to_frame().rename(columns={0: "count"}).reset_index()
-        self.layer6["bounds"] = self.layer6.treecode.map(self.db.rdict)
-        # remove unneccessary data
-        self.layer9 = self.layer9.drop(["treecode"], axis=1)
-        self.layer8 = self.layer8.drop(["treecode"], axis=1)
-        self.layer7 = self.layer7.drop(["treecode"], axis=1)
-        self.layer6 = self.layer6.drop(["treecode"], axis=1)
+        metrics.count("tree_cache_total", cache="memory", result="miss")
+        if self.is_small_viewport(viewport):
+            return self.compute_viewport(key, viewport)
+        self.extent = None
+        if approximate and self.is_long_window(sensor, sensor_threshold, start_time, end_time, dist_threshold):
+            with metrics.span("compute_stage", stage="approximate"):
+                return self.approximate_layers(sensor, sensor_threshold, start_time, end_time)
+        if sensor == all_sensors:
+            # one pass over all sensors, the heatmap shows contradictions in any of them
+            contradiction_distribution = self.compute_all_sensors(sensor_threshold, start_time, end_time)
+        elif self.is_day_aligned(start_time, end_time) and not self.db.streaming:
+            # only the days that entered or left the window are queried and added or subtracted
+            contradiction_distribution = self.update_window(sensor, sensor_threshold, start_time, end_time, dist_threshold)
+        else:
+            contradiction_distribution = self.compute_query(sensor, start_time, end_time)
+
+        # cache
+        self.tree_cache[key] = (self.layers, contradiction_distribution)
+        if self.result_cache is not None:
+            with metrics.span("compute_stage", stage="result_cache_put"):
+                self.result_cache.put(self.result_cache.make_key(*key), self.tree_cache[key])
+        return contradiction_distribution
+
+    def compute_query(self, sensor, start_time, end_time, region=default_region):
+        """
+        Queries the contradictions of a sensor in region and sets the layers
+        :param region: Area to aggregate, default is the whole area of interest
+        :return: Time distribution of the contradictions
+        """
+        if self.db.streaming:
+            with metrics.span("compute_stage", stage="stream"):
+                chunks = self.db.stream_contradictions(region, TimeSpan(start_time, end_time), self.sensor_map[sensor]())
+                counts, distribution = self.reduce_chunks(chunks, lambda chunk: (self.leaf_counts(chunk), self.hour_distribution(chunk.hour.values)))
+            with metrics.span("compute_stage", stage="layers"):
+                self.compute_layers(counts)
+            return distribution
+        with metrics.span("compute_stage", stage="query"):
+            contradict_data = self.db.query(
+                region=region,
+                timespan=TimeSpan(start_time, end_time),
+                sensor=self.sensor_map[sensor](),
+                contradictions=True,
+            )
+        with metrics.span("compute_stage", stage="layers"):
+            self.compute_layers(self.leaf_counts(contradict_data))
 
         # time distribution of contradictions
-        contradict_data = contradict_data.reset_index()
-        contradiction_distribution = contradict_data.groupby("time").size()
+        with metrics.span("compute_stage", stage="time_distribution"):
+            return self.hour_distribution(contradict_data.hour.values)
 
-        # cache
-        self.tree_cache[(sensor, sensor_threshold, start_time, end_time, dist_threshold)] = (
-            self.layer9.copy(),
-            self.layer8.copy(),
-            self.layer7.copy(),
-            self.layer6.copy(),
-            contradiction_distribution,
+    @staticmethod
+    def is_small_viewport(viewport):
+        """Whether the viewport covers less than viewport_aggregation_share of the area of interest"""
+        if viewport is None:
+            return False
+        area = max(min(viewport.x_max, lon_east) - max(viewport.x_min, lon_west), 0) * max(
+            min(viewport.y_max, lat_north) - max(viewport.y_min, lat_south), 0
         )
-        return contradiction_distribution
+        return area < viewport_aggregation_share * default_region.w * default_region.h
+
+    def compute_viewport(self, key, viewport):
+        """
+        Aggregates only the contradictions inside the viewport enlarged by viewport_margin.
+        The layers are reused as long as later viewports of the same parameters lie inside that area.
+        Viewport-bounded layers are not cached, zooming out computes the whole area
+        :param key: Tree cache key (sensor, sensor_threshold, start_time, end_time, dist_threshold)
+        :param viewport: Visible map area in WGS coordinates
+        :return: Time distribution of the contradictions inside the aggregated area
+        """
+        if self.extent is not None and self.extent_key == key and region_within(viewport, self.extent):
+            metrics.count("tree_cache_total", cache="viewport", result="hit")
+            return self.extent_distribution
+        metrics.count("tree_cache_total", cache="viewport", result="miss")
+        sensor, sensor_threshold, start_time, end_time, dist_threshold = key
+        extent = expand_region(viewport, viewport_margin)
+        if sensor == all_sensors:
+            distribution = self.compute_all_sensors(sensor_threshold, start_time, end_time, extent)
+        else:
+            distribution = self.compute_query(sensor, start_time, end_time, extent)
+        self.extent, self.extent_key, self.extent_distribution = extent, key, distribution
+        return distribution
+
+    @staticmethod
+    def relative_thresholds(relative_threshold):
+        """
+        Maps a threshold in [0, 1] onto the threshold range of every sensor
+        :param relative_threshold: 0 is the minimal, 1 the maximal threshold of each sensor
+        :return: Array of the 7 absolute sensor thresholds
+        """
+        mins = np.array(sensor_threshold_min)
+        maxs = np.array(sensor_threshold_max)
+        return mins + (maxs - mins) * relative_threshold
+
+    def compute_all_sensors(self, relative_threshold, start_time, end_time, region=default_region):
+        """
+        Evaluates all sensors in a single query and aggregates per-sensor and "any sensor" counts in one groupby.
+        Sets self.sensor_counts (leaf counts, one column per sensor and the column 'any') and the layers of the column 'any'
+        :param relative_threshold: Threshold relative to the threshold range of each sensor, see relative_thresholds()
+        :param region: Area to aggregate, default is the whole area of interest
+        :return: DataFrame of the time distribution with one column per sensor
+        """
+        thresholds = self.relative_thresholds(relative_threshold)
+        if self.db.streaming:
+            with metrics.span("compute_stage", stage="stream"):
+                chunks = self.db.stream_contradictions(region, TimeSpan(start_time, end_time), thresholds=thresholds)
+                self.sensor_counts, distribution = self.reduce_chunks(chunks, self.sensor_flag_counts)
+            with metrics.span("compute_stage", stage="layers"):
+                self.compute_layers(self.sensor_counts["any"])
+            return distribution
+        with metrics.span("compute_stage", stage="query"):
+            contradict_data = self.db.query_all_sensors(region=region, timespan=TimeSpan(start_time, end_time), thresholds=thresholds)
+        with metrics.span("compute_stage", stage="layers"):
+            self.sensor_counts, distribution = self.sensor_flag_counts(contradict_data)
+            self.compute_layers(self.sensor_counts["any"])
+        return distribution
+
+    @staticmethod
+    def sensor_flag_counts(contradict_data):
+        """
+        Leaf counts and time distribution per sensor of an "All sensors" query result
+        :param contradict_data: Result of Database.query_all_sensors()
+        :return: DataFrame of leaf counts (one column per sensor and the column 'any'), DataFrame of counts per hour and sensor
+        """
+        mask = contradict_data["mask"].values
+        flags = pd.DataFrame(
+            {name: (mask >> j) & 1 for j, name in enumerate(sensor_names)},
+            index=contradict_data.index,
+        )
+        flags["any"] = 1
+        flags["cell"] = contradict_data.cell.values
+        flags["hour"] = contradict_data.hour.values
+        counts = flags.drop(columns=["hour"]).groupby("cell").sum()
+        distribution = flags.drop(columns=["cell", "any"]).groupby("hour").sum()
+        distribution.index = pd.DatetimeIndex(hours_to_time(distribution.index.values), name="time")
+        return counts, distribution
+
+    @staticmethod
+    def reduce_chunks(chunks, reduce):
+        """
+        Reduces contradiction chunks one by one into running counts, every chunk is discarded after it was counted,
+        so the memory depends on the number of cells and hours, not on the number of rows
+        :param chunks: Iterable of contradiction DataFrames, see Database.stream_contradictions()
+        :param reduce: Function of a chunk returning a tuple of count Series/DataFrames indexed by cell and by time
+        :return: Tuple of the summed counts
+        """
+        result = None
+        for chunk in chunks:
+            metrics.count("stream_chunks_total")
+            partial = reduce(chunk)
+            if result is None:
+                result = partial
+            else:
+                result = tuple(total.add(part, fill_value=0) for total, part in zip(result, partial))
+        if result is None:
+            return reduce(pd.DataFrame({"hour": np.array([], dtype=np.uint16), "label": np.array([], dtype=np.int32),
+                                        "cell": np.array([], dtype=np.uint64), "mask": np.array([], dtype=np.uint8)}))
+        return tuple(total.astype("int64") for total in result)
+
+    @staticmethod
+    def is_day_aligned(start_time, end_time):
+        """Whether the time interval covers whole days, i.e. starts at 0:00 and ends at 23:00 like the day slider"""
+        return (start_time.hour, start_time.minute, end_time.hour, end_time.minute) == (0, 0, 23, 0) and start_time <= end_time
+
+    @staticmethod
+    def leaf_counts(contradict_data):
+        """
+        Counts contradictions per leaf of the tree
+        :param contradict_data: Result of a contradiction query, needs the column cell
+        :return: Series of counts indexed by the leaf cell code
+        """
+        cells, counts = np.unique(contradict_data.cell.values, return_counts=True)
+        return pd.Series(counts, index=pd.Index(cells, name="cell"))
+
+    @staticmethod
+    def hour_distribution(hours):
+        """
+        Number of contradictions per hour
+        :param hours: Array of hour offsets of the contradictions
+        :return: Series of counts indexed by time
+        """
+        hours, counts = np.unique(hours, return_counts=True)
+        return pd.Series(counts, index=pd.DatetimeIndex(hours_to_time(hours), name="time"))
+
+    def query_days(self, sensor, days):
+        """
+        Queries the contradictions of consecutive days with the current database thresholds and splits them per day
+        :param sensor: Sensor name
+        :param days: Sorted list of consecutive days (pd.Timestamp at 0:00)
+        :return: dict(day -> (leaf counts, time distribution))
+        """
+        with metrics.span("compute_stage", stage="query"):
+            contradict_data = self.db.query(
+                timespan=TimeSpan(days[0].to_pydatetime(), (days[-1] + pd.Timedelta(hours=23)).to_pydatetime()),
+                sensor=self.sensor_map[sensor](),
+                contradictions=True,
+            )
+        with metrics.span("compute_stage", stage="day_split"):
+            day = contradict_data.hour.values // 24
+            cell = pd.Series(contradict_data.cell.values, name="cell")
+            counts = cell.groupby([day, cell.values]).size().rename_axis(["day", "cell"])
+            distribution = self.hour_distribution(contradict_data.hour.values)
+            present = set(counts.index.get_level_values(0)) if len(counts) else set()
+            result = dict()
+            for d in days:
+                offset = (d - pd.Timestamp(time_epoch)).days
+                day_counts = counts.xs(offset, level=0) if offset in present else pd.Series(dtype="int64")
+                day_distribution = distribution[(distribution.index >= d) & (distribution.index < d + pd.Timedelta(days=1))]
+                result[d] = (day_counts, day_distribution)
+        return result
+
+    def update_window(self, sensor, sensor_threshold, start_time, end_time, dist_threshold):
+        """
+        Computes the layers of a day-aligned interval from per-day leaf counts.
+        If the previous window had the same parameters only the days that entered or left the window are added to or
+        subtracted from its leaf counts, so moving the day slider costs work proportional to the change.
+        Missing days are queried in consecutive runs and kept in self.day_cache.
+        :return: Time distribution of the contradictions in the interval
+        """
+        params = (sensor, sensor_threshold, dist_threshold)
+        days = list(pd.date_range(pd.Timestamp(start_time).normalize(), pd.Timestamp(end_time).normalize(), freq="D"))
+        if params not in self.day_cache:
+            self.day_cache[params] = dict()
+            while len(self.day_cache) > self.day_cache_size:
+                self.day_cache.popitem(last=False)
+        self.day_cache.move_to_end(params)
+        per_day = self.day_cache[params]
+
+        # reuse the previous window if that is cheaper than summing up all days
+        entered, left, counts = days, [], pd.Series(dtype="int64")
+        if self.window is not None and self.window[0] == params:
+            old_days = set(pd.date_range(self.window[1], self.window[2], freq="D"))
+            new_entered = [d for d in days if d not in old_days]
+            new_left = sorted(old_days - set(days))
+            if len(new_entered) + len(new_left) < len(days):
+                entered, left, counts = new_entered, new_left, self.window[3]
+        metrics.count("window_days_total", len(entered), change="entered")
+        metrics.count("window_days_total", len(left), change="left")
+
+        # query missing days, grouped into runs of consecutive days
+        missing = [d for d in entered if d not in per_day]
+        run = []
+        for d in missing + [None]:
+            if run and (d is None or d - run[-1] != pd.Timedelta(days=1)):
+                per_day.update(self.query_days(sensor, run))
+                run = []
+            if d is not None:
+                run.append(d)
+
+        with metrics.span("compute_stage", stage="layers"):
+            for d in entered:
+                counts = counts.add(per_day[d][0], fill_value=0)
+            for d in left:
+                counts = counts.sub(per_day[d][0], fill_value=0)
+            counts = counts[counts > 0].astype("int64")
+            self.window = (params, days[0], days[-1], counts)
+            self.compute_layers(counts)
+
+        with metrics.span("compute_stage", stage="time_distribution"):
+            distributions = [per_day[d][1] for d in days if len(per_day[d][1])]
+            if distributions:
+                return pd.concat(distributions)
+            return pd.Series(dtype="int64")
+
+    def is_long_window(self, sensor, sensor_threshold, start_time, end_time, dist_threshold, min_days=progressive_min_days):
+        """
+        Whether the exact layers need at least min_days days of timeline_ranged to be queried. Day-aligned intervals
+        only count the days missing in the day cache (see update_window), so moving a long window stays exact.
+        In streaming mode timeline_ranged is not in memory to be sampled, the layers are always exact
+        """
+        if self.db.streaming:
+            return False
+        days = pd.date_range(pd.Timestamp(start_time).normalize(), pd.Timestamp(end_time).normalize(), freq="D")
+        if sensor != all_sensors and self.is_day_aligned(start_time, end_time):
+            per_day = self.day_cache.get((sensor, sensor_threshold, dist_threshold), dict())
+            return sum(d not in per_day for d in days) >= min_days
+        return len(days) >= min_days
+
+    def approximate_layers(self, sensor, sensor_threshold, start_time, end_time, budget=approximate_sample_rows, seed=None):
+        """
+        Sets approximate layers estimated from a stratified sample of about budget rows of timeline_ranged, the cost does
+        not depend on the length of the interval. The days of the interval are the strata (like the day cache), every
+        day gets a share of the budget proportional to its rows. The sample of a day is systematic over its rows, which
+        are sorted by hour, so all hours of the day are covered.
+        The layers have the columns cell, count (estimate N_d / n_d * sampled contradictions summed over the days d) and
+        error (standard error of the estimate under stratified random sampling); self.approximation is set.
+        Uses the current database thresholds, see compute_current_tree
+        :param budget: Number of sampled rows, see globals.approximate_sample_rows
+        :param seed: Seed of the random offsets of the systematic samples
+        :return: Estimated time distribution of the contradictions
+        """
+        first_day, edges = self.db.day_rows(TimeSpan(start_time, end_time))
+        sizes = np.diff(edges)
+        total = int(sizes.sum())
+        n = np.minimum(sizes, np.ceil(budget * sizes / max(total, 1))).astype(np.int64)
+
+        # systematic sample of every day: n_d rows with the stride N_d / n_d from a random offset
+        rng = np.random.default_rng(seed)
+        stratum = np.repeat(np.arange(len(n)), n)
+        k = np.arange(len(stratum)) - np.repeat(np.cumsum(n) - n, n)
+        stride = sizes[stratum] / n[stratum]
+        positions = edges[stratum] + ((k + rng.random(len(n))[stratum]) * stride).astype(np.int64)
+        sample = self.db.tlr.iloc[positions]
+        if sensor == all_sensors:
+            rows = self.db.all_sensor_contradictions(sample, default_region, self.relative_thresholds(sensor_threshold))
+        else:
+            rows = self.db.contradictions(sample, default_region, self.sensor_map[sensor]().index)
+
+        # per day and cell: estimate and variance, p is the sampled share of the day that contradicts in the cell
+        size, sampled = sizes.astype(np.float64), np.maximum(n, 1).astype(np.float64)
+        variance_factor = np.where(n > 1, size**2 * (1 - n / np.maximum(size, 1)) / np.maximum(n - 1, 1), 0)
+        day = rows.hour.values.astype(np.int64) // 24 - first_day
+        counts = pd.Series(1, index=pd.MultiIndex.from_arrays([day, rows.cell.values], names=["day", "cell"])).groupby(level=[0, 1]).sum()
+        layers = dict()
+        for level in range(self.leaf_level, -1, -1):
+            days = counts.index.get_level_values(0).values
+            counts = counts.groupby([days, cell_ancestor(counts.index.get_level_values(1).values, level)]).sum().rename_axis(["day", "cell"])
+            days = counts.index.get_level_values(0).values
+            p = counts.values / sampled[days]
+            layer = pd.DataFrame({"count": p * size[days], "variance": variance_factor[days] * p * (1 - p)}, index=counts.index)
+            layer = layer.groupby(level="cell").sum()
+            layer["error"] = np.sqrt(layer.pop("variance").values)
+            layers[level] = layer.reset_index()
+        self.layers = layers
+        self.approximation = dict(sampled=len(positions), rows=total)
+
+        weights = size[day] / sampled[day]
+        distribution = pd.Series(weights).groupby(rows.hour.values).sum()
+        return pd.Series(distribution.values, index=pd.DatetimeIndex(hours_to_time(distribution.index.values), name="time"))
 
-    def get_rects_and_heat(self, zoom_level=18):
+    def compute_layers(self, leaf_counts):
         """
-        Gets the current zoom level of the map and returns a list of tuples (boundary, heat)
+        Aggregates the leaf counts bottom-up to every tree level from the leaf level to the root and sets self.layers
+        :param leaf_counts: Series of contradiction counts indexed by the leaf cell code
         """
-        layer = self.mapzoom2treezoom[zoom_level]
-        if layer == 6:
-            return self.layer6[["bounds", "count"]].values, self.layer6["count"].max()
-        if layer == 7:
-            return self.layer7[["bounds", "count"]].values, self.layer7["count"].max()
-        if layer == 8:
-            return self.layer8[["bounds", "count"]].values, self.layer8["count"].max()
-        if layer == 9:
-            return self.layer9[["bounds", "count"]].values, self.layer9["count"].max()
+        layers = dict()
+        counts = leaf_counts
+        for level in range(self.leaf_level, -1, -1):
+            counts = counts.groupby(cell_ancestor(counts.index.values, level)).sum().rename_axis("cell")
+            layers[level] = counts.to_frame("count").reset_index()
+        self.layers = layers
 
+    @staticmethod
+    def layer_bounds(layer):
+        """
+        Cell boundaries of a layer, computed on first use and kept as the columns x_min, x_max, y_min, y_max
+        :param layer: DataFrame of self.layers
+        :return: The layer with the boundary columns
+        """
+        if "x_min" not in layer.columns:
+            layer["x_min"], layer["x_max"], layer["y_min"], layer["y_max"] = cell_bounds(layer.cell.values)
         return layer
+
+    @staticmethod
+    def visible(layer, viewport):
+        """Boolean array of the cells of layer that intersect the viewport"""
+        return (
+            (layer.x_min.values < viewport.x_max)
+            & (layer.x_max.values > viewport.x_min)
+            & (layer.y_min.values < viewport.y_max)
+            & (layer.y_max.values > viewport.y_min)
+        )
+
+    def choose_level(self, viewport=default_region, budget=heatmap_cell_budget):
+        """
+        Deepest tree level with at most budget non-empty cells inside the viewport.
+        The number of non-empty cells never decreases with the level, so the search stops at the first level over budget
+        :param viewport: Visible map area in WGS coordinates
+        :param budget: Maximal number of rectangles, see globals.heatmap_cell_budget
+        :return: Tree level
+        """
+        chosen = 0
+        for level in sorted(self.layers):
+            if self.visible(self.layer_bounds(self.layers[level]), viewport).sum() > budget:
+                break
+            chosen = level
+        return chosen
+
+    def preview_rects_and_heat(self, sensor, sensor_threshold, start_time, end_time, dist_threshold, viewport=default_region):
+        """
+        Heatmap from the sweep histograms, used while a slider is dragged. Does not query the database.
+        Counts are approximate as thresholds and distances are quantized, the level is restricted to globals.sweep_levels.
+        :return: list of tuples (boundary, heat) and the maximal heat or None if no sweep histograms are available
+        """
+        if self.db.sweep is None or sensor not in self.sensor_map:
+            return None
+        level = min(max(self.choose_level(viewport), min(sweep_levels)), max(sweep_levels))
+        sensor_index = self.sensor_map[sensor]().index
+        counts = self.db.sweep.counts(level, sensor_index, sensor_threshold, dist_threshold, start_time, end_time)
+        layer = counts.rename_axis("cell").to_frame("count").reset_index()
+        layer["bounds"] = cell_regions(layer.cell.values)
+        return layer[["bounds", "count"]].values, layer["count"].max() if len(layer) else 0
+
+    def threshold_curve(self, sensor, lon, lat, start_time, end_time, dist_threshold, level=max(sweep_levels)):
+        """
+        Contradictions vs threshold for the cell containing (lon, lat) from the sweep histograms
+        :return: Tuple (thresholds, counts) or None if no sweep histograms are available
+        """
+        if self.db.sweep is None or sensor not in self.sensor_map:
+            return None
+        cell = point_cells([lon], [lat], level)[0]
+        return self.db.sweep.threshold_curve(level, cell, self.sensor_map[sensor]().index, dist_threshold, start_time, end_time)
+
+    def contradiction_rows(self, sensor, sensor_threshold, start_time, end_time, dist_threshold, region=default_region):
+        """
+        Contradictions of a sensor (or of any sensor for all_sensors) without aggregation
+        :return: DataFrame with at least the columns hour, label, cell
+        """
+        self.db.spatial_range_update(dist_threshold)
+        timespan = TimeSpan(start_time, end_time)
+        if sensor == all_sensors:
+            return self.db.query_all_sensors(region=region, timespan=timespan, thresholds=self.relative_thresholds(sensor_threshold))
+        self.db.sensor_update(sensor=self.sensor_map[sensor](sensor_threshold))
+        return self.db.query(region=region, timespan=timespan, sensor=self.sensor_map[sensor](), contradictions=True)
+
+    def budget_cells(self, cells, budget=heatmap_cell_budget):
+        """
+        Deepest tree level on which the given leaf cells fall into at most budget distinct cells
+        :param cells: Leaf cell codes, e.g. the cell column of rows of timeline_ranged
+        :return: Tuple (level, sorted distinct cell codes on that level, index of every input cell in them)
+        """
+        level = self.leaf_level
+        cells = cell_ancestor(cells, level)
+        while level > 0 and len(np.unique(cells)) > budget:
+            level -= 1
+            cells = cell_ancestor(cells, level)
+        distinct, index = np.unique(cells, return_inverse=True)
+        return level, distinct, index
+
+    def playback_frames(self, sensor, sensor_threshold, start_time, end_time, dist_threshold, viewport=default_region,
+                        budget=heatmap_cell_budget):
+        """
+        Contradiction counts of every hour of the interval for the animated playback, computed with a single query.
+        The counts are on the deepest tree level whose non-empty cells over all hours fit the budget
+        :param viewport: Visible map area, only its contradictions are counted
+        :return: Dictionary for the client (see assets/playback.js) with the keys
+                 start (first hour, ISO format), hours (number of frames), level, bounds (per cell [[south, west], [north, east]]),
+                 counts (base64 of the little-endian uint16 array of shape (hours, cells)) and max (largest count of a frame)
+        """
+        region = default_region if viewport is None or region_within(default_region, viewport) else viewport
+        with metrics.span("compute_stage", stage="playback_query"):
+            rows = self.contradiction_rows(sensor, sensor_threshold, start_time, end_time, dist_threshold, region)
+        with metrics.span("compute_stage", stage="playback_frames"):
+            first, last = math.ceil(hour_offset(start_time)), math.floor(hour_offset(end_time))
+            n_hours = max(last - first + 1, 0)
+            hours = rows.hour.values.astype(np.int64) - first
+            level, frame_cells, cell_index = self.budget_cells(rows.cell.values, budget)
+            frames = np.zeros((n_hours, len(frame_cells)), dtype=np.int64)
+            np.add.at(frames, (hours, cell_index), 1)
+            frames = np.minimum(frames, np.iinfo(np.uint16).max).astype("<u2")
+            x_min, x_max, y_min, y_max = cell_bounds(frame_cells)
+        return {
+            "start": (time_epoch + datetime.timedelta(hours=first)).isoformat(),
+            "hours": n_hours,
+            "level": level,
+            "bounds": np.stack([np.stack([y_min, x_min], axis=1), np.stack([y_max, x_max], axis=1)], axis=1).round(6).tolist(),
+            "counts": base64.b64encode(frames.tobytes()).decode("ascii"),
+            "max": int(frames.max(initial=0)),
+        }
+
+    def client_table(self, sensor, start_time, end_time, viewport=default_region, budget=heatmap_cell_budget, max_rows=client_table_rows):
+        """
+        Rows of timeline_ranged in the viewport (enlarged by viewport_margin) for filtering in the browser (see
+        assets/client_heatmap.js): the threshold, distance and time filters and the aggregation to cells run on the client.
+        Only rows that contradict for some threshold and distance of the sliders are sent. For all_sensors the value of
+        a row is its largest sensor difference relative to the threshold range of the sensor (see relative_thresholds()),
+        so that the relative threshold applies to it directly.
+        The cells are on the deepest level whose cells with any of these rows fit the budget, i.e. the level for the
+        smallest threshold; the heat is scaled to the largest count among them rather than of the whole layer
+        :param budget: Maximal number of cells, at most 65535 as cell indexes are sent as uint16
+        :param max_rows: Maximal number of rows, larger tables are not sent
+        :return: None if the table exceeds max_rows, otherwise a dictionary with the keys
+                 sensor, extent ([x_min, x_max, y_min, y_max]), rows, level, bounds (per cell [[south, west], [north, east]]),
+                 distance_unit and the base64 little-endian arrays hour (uint16 offset from time_epoch), cell (uint16 index
+                 into bounds), rmin and rmax (uint16 in distance_unit) and value (float32 sensor difference)
+        """
+        extent = default_region if viewport is None or not self.is_small_viewport(viewport) else expand_region(viewport, viewport_margin)
+        with metrics.span("compute_stage", stage="client_table_query"):
+            rows = self.db.region_rows(extent, TimeSpan(start_time, end_time))
+        if sensor == all_sensors:
+            mins = np.array(sensor_threshold_min, dtype=np.float32)
+            ranges = np.array(sensor_threshold_max, dtype=np.float32) - mins
+            values = ((rows[["s0", "s1", "s2", "s3", "s4", "s5", "s6"]].values.astype(np.float32) - mins) / ranges).max(axis=1)
+            minimum = 0
+        else:
+            j = self.sensor_map[sensor]().index
+            values = rows[f"s{j}"].values.astype(np.float32)
+            minimum = sensor_threshold_min[j]
+        # rows that no slider position can select
+        selection = (values > minimum) & (rows.rmin.values <= max_distance_threshold / distance_unit)
+        if selection.sum() > max_rows:
+            return None
+        rows, values = rows[selection], values[selection]
+        level, cells, cell_index = self.budget_cells(rows.cell.values, min(budget, np.iinfo(np.uint16).max))
+        x_min, x_max, y_min, y_max = cell_bounds(cells)
+
+        def encode(array, dtype):
+            return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode("ascii")
+
+        metrics.count("client_table_rows_total", len(rows))
+        return {
+            "sensor": sensor,
+            "extent": [extent.x_min, extent.x_max, extent.y_min, extent.y_max],
+            "rows": len(rows),
+            "level": level,
+            "bounds": np.stack([np.stack([y_min, x_min], axis=1), np.stack([y_max, x_max], axis=1)], axis=1).round(6).tolist(),
+            "distance_unit": distance_unit,
+            "hour": encode(rows.hour.values, "<u2"),
+            "cell": encode(cell_index, "<u2"),
+            "rmin": encode(rows.rmin.values, "<u2"),
+            "rmax": encode(rows.rmax.values, "<u2"),
+            "value": encode(values, "<f4"),
+        }
+
+    def cell_drilldown(self, sensor, sensor_threshold, lon, lat, start_time, end_time, dist_threshold, viewport=default_region):
+        """
+        Contradictions in the heatmap cell at (lon, lat), on the level shown for the viewport (see choose_level)
+        :param sensor: Sensor name or all_sensors, for all_sensors the threshold is relative (see relative_thresholds)
+        :return: Tuple (cell boundary, DataFrame of Database.cell_contradictions) or None if no cell with contradictions is there
+        """
+        level = self.choose_level(viewport)
+        layer = self.layers.get(level)
+        if layer is None or not len(layer):
+            return None
+        layer = self.layer_bounds(layer)
+        inside = np.flatnonzero(
+            (layer.x_min.values <= lon) & (layer.x_max.values > lon) & (layer.y_min.values <= lat) & (layer.y_max.values > lat)
+        )
+        if not len(inside):
+            return None
+        cell = layer.cell.values[inside[0]]
+        self.db.spatial_range_update(dist_threshold)
+        timespan = TimeSpan(start_time, end_time)
+        if sensor == all_sensors:
+            rows = self.db.cell_contradictions(cell, level, timespan, thresholds=self.relative_thresholds(sensor_threshold))
+        else:
+            self.db.sensor_update(sensor=self.sensor_map[sensor](sensor_threshold))
+            rows = self.db.cell_contradictions(cell, level, timespan, self.sensor_map[sensor]())
+        bounds = layer.loc[layer.index[inside[0]], ["x_min", "x_max", "y_min", "y_max"]]
+        return Region(*bounds.tolist()), rows
+
+    def clicked_neighbours(self, sensor, sensor_threshold, lon, lat, start_time, end_time, dist_threshold):
+        """
+        Neighbours of the trajectory point nearest to (lon, lat) in the time interval, from the neighbour graph
+        :param sensor: Sensor name or all_sensors, for all_sensors the threshold is relative (see relative_thresholds)
+        :return: Tuple (label, time, longitude, latitude) of the point and DataFrame of its neighbours (see Database.neighbours)
+                 with the boolean column 'conflict', or None if there is no point in the time interval
+        """
+        point = self.db.nearest_point(lon, lat, TimeSpan(start_time, end_time))
+        if point is None:
+            return None
+        label, t, _, _ = point
+        neighbours = self.db.neighbours(label, t, dist_threshold)
+        if sensor == all_sensors:
+            thresholds = self.relative_thresholds(sensor_threshold)
+            neighbours["conflict"] = (neighbours[sensor_names].values > thresholds).any(axis=1)
+        else:
+            neighbours["conflict"] = neighbours[sensor].values > sensor_threshold
+        return point, neighbours
+
+    def get_rects_and_heat(self, viewport=default_region, errors=False):
+        """
+        Returns the cells of the deepest tree level that fits the cell budget in the viewport
+        as list of tuples (boundary, heat) and the maximal heat of that level
+        :param viewport: Visible map area in WGS coordinates
+        :param errors: Also return the standard errors of the shown cells (None if the layers are exact)
+        """
+        level = self.choose_level(viewport)
+        metrics.count("heatmap_level_total", level=level)
+        layer = self.layers.get(level)
+        if layer is None or not len(layer):
+            return ([], 0, None) if errors else ([], 0)
+        shown = layer[self.visible(layer, viewport)]
+        regions = [
+            Region(*bounds)
+            for bounds in zip(shown.x_min.tolist(), shown.x_max.tolist(), shown.y_min.tolist(), shown.y_max.tolist())
+        ]
+        if errors:
+            return list(zip(regions, shown["count"].tolist())), layer["count"].max(), shown["error"].tolist() if "error" in shown.columns else None
+        return list(zip(regions, shown["count"].tolist())), layer["count"].max()
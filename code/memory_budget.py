@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import benchmark
+
+"""
+Memory budget harness for the load and preprocessing stages.
+Every stage runs in a fresh interpreter, once without tracing for its peak RSS and once under tracemalloc for the peak
+of the traced Python allocations and the allocation hotspots at that peak (tracing slows the stage down and adds to its RSS).
+The peak RSS of every stage is checked against its budget, the report is written as JSON to the results directory and
+the exit code is 1 if a stage is over budget.
+Runs on a synthetic dataset (see synthetic.py) or with --data on an existing one, e.g. the real data/. The outputs of
+getddict go to a temporary directory, uniteTrajectories writes clustered.parquet to the data directory like the script.
+
+Usage:
+    python memory_budget.py [--data DIR] [--labels N] [--hours H] [--results DIR] [--budgets FILE] [--stages NAME ...] [--no-trace]
+"""
+
+# Peak RSS budgets in MB for the default synthetic dataset (500 labels, 48 hours), where about 160 MB are the imported
+# modules (start RSS), --budgets takes a JSON file {stage: MB} for other datasets
+stage_budgets = {
+    "Database.__init__": 256,
+    "getddict": 256,
+    "uniteTrajectories": 256,
+}
+# Number of allocation hotspots (source lines) per stage in the report
+hotspot_count = 10
+# A new tracemalloc snapshot is taken whenever the traced memory grew by this factor since the last one
+snapshot_growth = 1.1
+
+
+def run_database():
+    import database
+
+    return database.Database()
+
+
+def run_getddict():
+    import database
+    from globals import neighbour_prefix
+
+    return database.getddict(
+        output=os.path.join(neighbour_prefix, "timelinenew.parquet"), graph_path=os.path.join(neighbour_prefix, "neighbour_graph")
+    )
+
+
+def run_unite_trajectories():
+    return runpy.run_path(os.path.join(benchmark.preprocessing_path, "uniteTrajectories.py"), run_name="__main__")
+
+
+stages = {
+    "Database.__init__": run_database,
+    "getddict": run_getddict,
+    "uniteTrajectories": run_unite_trajectories,
+}
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process and of its largest waited-for child process (e.g. a multiprocessing pool).
+
+    @return: Bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit
+
+
+class PeakSnapshots(threading.Thread):
+    """
+    Polls the traced memory every interval seconds and takes a tracemalloc snapshot whenever it grew by snapshot_growth
+    since the last snapshot, so the last snapshot is within that factor of the peak (peaks shorter than the interval
+    can be missed). The number of snapshots grows only with the logarithm of the peak.
+    """
+
+    def __init__(self, interval=0.05, growth=snapshot_growth):
+        super().__init__(name="peak-snapshots", daemon=True)
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self.size = 0
+        self.stopped = threading.Event()
+
+    def take(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if self.snapshot is None or current > self.size * self.growth:
+            self.snapshot, self.size = tracemalloc.take_snapshot(), current
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.take()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        # stages shorter than the interval
+        self.take()
+
+
+def hotspots(snapshot, count=hotspot_count):
+    """
+    Source lines with the largest traced allocations of a snapshot.
+
+    @param snapshot: tracemalloc.Snapshot.
+    @param count: Number of lines.
+    @return: List of dictionaries with the keys file, line, size_mb and blocks.
+    """
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ]
+    )
+    result = []
+    for statistic in snapshot.statistics("lineno")[:count]:
+        frame = statistic.traceback[0]
+        result.append({"file": frame.filename, "line": frame.lineno, "size_mb": statistic.size / 2**20, "blocks": statistic.count})
+    return result
+
+
+def measure_stage(name, trace):
+    """
+    Runs a stage in this process, the result of the stage stays referenced until the measurement is done.
+
+    @param name: Key of stages.
+    @param trace: Whether the allocations are traced with tracemalloc.
+    @return: Dictionary with the peak RSS in MB, the runtime and with trace the traced peak in MB and the hotspots.
+    """
+    start_rss = peak_rss()
+    sampler = None
+    if trace:
+        tracemalloc.start()
+        sampler = PeakSnapshots()
+        sampler.start()
+    t0 = time.perf_counter()
+    result = stages[name]()
+    seconds = time.perf_counter() - t0
+    measurement = {"start_rss_mb": start_rss / 2**20, "peak_rss_mb": peak_rss() / 2**20, "seconds": seconds}
+    if trace:
+        sampler.stop()
+        measurement["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        measurement["hotspots"] = hotspots(sampler.snapshot)
+        tracemalloc.stop()
+    del result
+    return measurement
+
+
+def run_stage(name, trace):
+    """Runs a stage in a fresh interpreter with the harness environment, see measure_stage()."""
+    handle, output = tempfile.mkstemp(prefix="otv-memory-", suffix=".json")
+    os.close(handle)
+    try:
+        benchmark.run_script([os.path.abspath(__file__), "--run-stage", name, "--output", output] + (["--trace"] if trace else []))
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def report(results):
+    """Prints the stages with their budgets and the top hotspots, returns the number of stages over budget"""
+    over = 0
+    print(f"{'stage':20} {'start RSS [MB]':>15} {'peak RSS [MB]':>14} {'budget [MB]':>12} {'traced [MB]':>12}  status")
+    for name, result in results.items():
+        budget = result["budget_mb"]
+        traced = f"{result['traced_peak_mb']:12.1f}" if "traced_peak_mb" in result else f"{'-':>12}"
+        status = "ok" if result["within_budget"] else "OVER BUDGET"
+        over += not result["within_budget"]
+        print(f"{name:20} {result['start_rss_mb']:15.1f} {result['peak_rss_mb']:14.1f} {budget if budget is not None else '-':>12} {traced}  {status}")
+    for name, result in results.items():
+        if result.get("hotspots"):
+            print(f"\nAllocation hotspots of {name} at its traced peak:")
+            for spot in result["hotspots"][:3]:
+                print(f"    {spot['size_mb']:8.1f} MB {spot['blocks']:>9} blocks  {spot['file']}:{spot['line']}")
+    return over
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the peak memory of the load and preprocessing stages against budgets")
+    parser.add_argument("--data", help="directory with an existing dataset, a synthetic one is generated into a temporary directory if omitted")
+    parser.add_argument("--labels", type=int, default=500)
+    parser.add_argument("--hours", type=int, default=48)
+    parser.add_argument("--results", default=benchmark.default_results_path)
+    parser.add_argument("--budgets", help="JSON file {stage: MB} replacing the default budgets")
+    parser.add_argument("--stages", nargs="+", choices=list(stages), default=list(stages))
+    parser.add_argument("--no-trace", action="store_true", help="only measure the peak RSS")
+    parser.add_argument("--run-stage", choices=list(stages), help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    parser.add_argument("--trace", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        # child process of run_stage(), the modules of the stages are imported before the measurement
+        import database
+
+        with open(args.output, "w") as f:
+            json.dump(measure_stage(args.run_stage, args.trace), f)
+        sys.exit(0)
+
+    budgets = dict(stage_budgets)
+    if args.budgets:
+        with open(args.budgets) as f:
+            budgets = json.load(f)
+
+    work_path = tempfile.mkdtemp(prefix="otv-memory-")
+    data_path = args.data or os.path.join(work_path, "data")
+    os.environ["OTV_DATA_PREFIX"] = data_path
+    os.environ["OTV_NEIGHBOUR_PREFIX"] = os.path.join(work_path, "neighbours")
+    os.environ["OTV_TREE_PREFIX"] = os.path.join(work_path, "trees")
+    os.environ["OTV_METRICS"] = "0"
+    os.makedirs(os.environ["OTV_NEIGHBOUR_PREFIX"])
+
+    if not args.data:
+        import synthetic
+
+        synthetic.generate(data_path, args.labels, args.hours)
+
+    results = dict()
+    for name in args.stages:
+        if name == "getddict":
+            # neighbour lists of the timeline, not measured
+            benchmark.run_script(["nearestneighbours.py"])
+        print(f"Measuring {name}")
+        result = run_stage(name, trace=False)
+        if not args.no_trace:
+            traced = run_stage(name, trace=True)
+            result.update({"traced_peak_mb": traced["traced_peak_mb"], "hotspots": traced["hotspots"], "traced_seconds": traced["seconds"]})
+        result["budget_mb"] = budgets.get(name)
+        result["within_budget"] = result["budget_mb"] is None or result["peak_rss_mb"] <= result["budget_mb"]
+        results[name] = result
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": benchmark.git_commit(),
+        "python": platform.python_version(),
+        "scale": {"labels": args.labels, "hours": args.hours, "data": args.data},
+        "results": results,
+    }
+    os.makedirs(args.results, exist_ok=True)
+    output = os.path.join(args.results, f"memory-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    over = report(results)
+    print(f"Report written to {output}")
+    sys.exit(1 if over else 0)
@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from globals import *
+
+"""
+Latency and counter instrumentation for the Dash callbacks.
+Stages are timed with span(), events counted with count(). All values are exposed as Prometheus text on /metrics
+and every finished span is written as a JSON log line to the 'otv.metrics' logger.
+Set OTV_METRICS=0 to switch it off, span() then returns a shared no-op context manager.
+"""
+
+enabled = os.environ.get("OTV_METRICS", "1") != "0"
+
+# upper bounds of the latency histogram buckets in seconds
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+logger = logging.getLogger("otv.metrics")
+if enabled and not logger.handlers:
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+_lock = threading.Lock()
+# (name, labels) -> [bucket counts..., count above the last bucket, sum, count]
+_histograms = dict()
+# (name, labels) -> value
+_counters = dict()
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """
+    Records a duration in the histogram name.
+
+    @param name: Metric name without unit, e.g. 'update_map_stage'.
+    @param seconds: Measured duration.
+    @param labels: Prometheus labels, e.g. stage='query'.
+    @return: None.
+    """
+    if not enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(buckets) + 3)
+        # index len(buckets) is the overflow slot of the +Inf bucket
+        histogram[bisect_left(buckets, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+def count(name, value=1, **labels):
+    """
+    Increases the counter name by value.
+
+    @param name: Metric name, e.g. 'tree_cache_total'.
+    @param value: Increment, e.g. a payload size in bytes.
+    @param labels: Prometheus labels, e.g. result='hit'.
+    @return: None.
+    """
+    if not enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        observe(self.name, seconds, **self.labels)
+        logger.info(json.dumps({"metric": self.name, **self.labels, "seconds": round(seconds, 6), "error": exc_type is not None}))
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name, **labels):
+    """
+    Context manager timing the enclosed block, e.g. with span('update_map_stage', stage='render_heatmap'): ...
+
+    @param name: Histogram name.
+    @param labels: Prometheus labels of the span.
+    @return: Context manager.
+    """
+    if not enabled:
+        return _null_span
+    return _Span(name, labels)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+def prometheus_text():
+    """
+    Renders all metrics in the Prometheus text exposition format.
+
+    @return: String.
+    """
+    lines = []
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    for name in sorted({k[0] for k in histograms}):
+        lines.append(f"# TYPE otv_{name}_seconds histogram")
+        for (hname, labels), values in sorted(histograms.items()):
+            if hname != name:
+                continue
+            cumulative = 0
+            for bound, n in zip(buckets + ["+Inf"], values[:-2]):
+                cumulative += n
+                lines.append(f"otv_{name}_seconds_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"otv_{name}_seconds_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"otv_{name}_seconds_count{_format_labels(labels)} {values[-1]}")
+    for name in sorted({k[0] for k in counters}):
+        lines.append(f"# TYPE otv_{name} counter")
+        for (cname, labels), value in sorted(counters.items()):
+            if cname == name:
+                lines.append(f"otv_{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def register(server):
+    """
+    Adds the /metrics route to the Flask server of the Dash app and records latency and response size of every callback request.
+
+    @param server: Flask instance (app.server).
+    @return: None.
+    """
+    import flask
+
+    @server.route("/metrics")
+    def metrics_endpoint():
+        return flask.Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+    if not enabled:
+        return
+
+    @server.before_request
+    def start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        if flask.request.path.endswith("_dash-update-component"):
+            body = flask.request.get_json(silent=True) or {}
+            output = body.get("output", "unknown")
+            observe("callback_request", time.perf_counter() - flask.g.get("metrics_start", time.perf_counter()), output=output)
+            count("callback_payload_bytes_total", response.calculate_content_length() or 0, output=output)
+        return response
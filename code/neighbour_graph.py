@@ -0,0 +1,180 @@
+import time
+import numpy
+from globals import *
+
+"""
+Neighbour graph of the trajectory points, kept after getddict() instead of the per-hour neighbour lists.
+
+The graph is stored in CSR form in the directory path_neighbour_graph as .npy files, which are memory-mapped:
+    hours.npy       uint16 hour offset (from time_epoch) of every point with neighbours, sorted by (hour, label)
+    labels.npy      int32 label of every point
+    offsets.npy     int64 start of the neighbours of point i in neighbours.npy and distances.npy, point i ends at offsets[i + 1]
+    neighbours.npy  int32 labels of the neighbours
+    distances.npy   float32 distances in km, ascending per point
+The files are written to a temporary directory next to the graph and then moved over the old ones with os.replace,
+so a running app that has the old files memory-mapped keeps reading them until it reopens the graph.
+"""
+
+graph_files = ["hours", "labels", "offsets", "neighbours", "distances"]
+
+
+def _sorted_csr(hours, labels, neighbours, distances):
+    """CSR arrays of an edge list (one edge per (hour, label, neighbour) with its distance)"""
+    order = numpy.lexsort((distances, labels, hours))
+    hours, labels, neighbours, distances = hours[order], labels[order], neighbours[order], distances[order]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], (hours[1:] != hours[:-1]) | (labels[1:] != labels[:-1])])) if len(hours) else []
+    offsets = numpy.append(starts, len(hours)).astype(numpy.int64)
+    return {
+        "hours": hours[starts].astype(numpy.uint16),
+        "labels": labels[starts].astype(numpy.int32),
+        "offsets": offsets,
+        "neighbours": neighbours.astype(numpy.int32),
+        "distances": distances.astype(numpy.float32),
+    }
+
+
+def _temporary_path(path):
+    """Empty temporary directory next to the graph directory path, on the same file system for os.replace"""
+    temporary = f"{os.path.normpath(path)}.{os.getpid()}.tmp"
+    os.makedirs(temporary, exist_ok=True)
+    return temporary
+
+
+def _replace_files(temporary, path):
+    """Moves the .npy files from the temporary directory over the files of the graph directory path"""
+    os.makedirs(path, exist_ok=True)
+    for name in graph_files:
+        os.replace(os.path.join(temporary, f"{name}.npy"), os.path.join(path, f"{name}.npy"))
+    os.rmdir(temporary)
+
+
+def build_neighbour_graph(hours, labels, neighbours, distances, path=path_neighbour_graph):
+    """
+    Writes the neighbour graph from an edge list.
+
+    @param hours: Hour offsets of the edges.
+    @param labels: Labels of the points.
+    @param neighbours: Labels of their neighbours.
+    @param distances: Distances in km.
+    @param path: Output directory, created if necessary.
+    @return: None.
+    """
+    t0 = time.time()
+    csr = _sorted_csr(numpy.asarray(hours), numpy.asarray(labels), numpy.asarray(neighbours), numpy.asarray(distances))
+    temporary = _temporary_path(path)
+    for name in graph_files:
+        numpy.save(os.path.join(temporary, f"{name}.npy"), csr[name])
+    _replace_files(temporary, path)
+    print(f"Neighbour graph with {len(csr['labels'])} points and {len(csr['neighbours'])} edges written in {time.time()-t0:.02f}s")
+
+
+def update_neighbour_graph(hours, labels, neighbours, distances, path=path_neighbour_graph):
+    """
+    Replaces the edges of the given hours (e.g. after new hours were appended) and keeps all other hours.
+    Creates the graph if it does not exist.
+    """
+    if not os.path.exists(os.path.join(path, "offsets.npy")):
+        build_neighbour_graph(hours, labels, neighbours, distances, path)
+        return
+    graph = NeighbourGraph(path)
+    counts = numpy.diff(graph.offsets)
+    old_hours = numpy.repeat(numpy.asarray(graph.hours), counts)
+    keep = ~numpy.isin(old_hours, numpy.unique(hours))
+    edges = (
+        numpy.concatenate([old_hours[keep], hours]),
+        numpy.concatenate([numpy.repeat(numpy.asarray(graph.labels), counts)[keep], labels]),
+        numpy.concatenate([numpy.asarray(graph.neighbour_labels)[keep], neighbours]),
+        numpy.concatenate([numpy.asarray(graph.distances)[keep], distances]),
+    )
+    # the new files replace the memory-mapped ones
+    del graph
+    build_neighbour_graph(*edges, path)
+
+
+class NeighbourGraphWriter:
+    """
+    Writes the neighbour graph chunk by chunk, only one chunk of edges is in memory at a time.
+    The chunks have to be given in hour order, every hour in one chunk. The arrays are appended to raw files in a
+    temporary directory, close() converts them to the .npy files of NeighbourGraph and replaces the files in path.
+    """
+
+    def __init__(self, path=path_neighbour_graph):
+        self.path = path
+        self.temporary = _temporary_path(path)
+        self.files = {name: open(os.path.join(self.temporary, f"{name}.raw"), "wb") for name in graph_files}
+        self.dtypes = dict()
+        self.points = 0
+        self.edges = 0
+        # the offsets of a chunk start at the number of edges written before it
+        self.files["offsets"].write(numpy.zeros(1, dtype=numpy.int64).tobytes())
+
+    def append(self, hours, labels, neighbours, distances):
+        """
+        Appends the edges of the next hours, see build_neighbour_graph() for the parameters.
+
+        @return: None.
+        """
+        if not len(hours):
+            return
+        csr = _sorted_csr(numpy.asarray(hours), numpy.asarray(labels), numpy.asarray(neighbours), numpy.asarray(distances))
+        csr["offsets"] = csr["offsets"][1:] + self.edges
+        for name in graph_files:
+            self.files[name].write(csr[name].tobytes())
+            self.dtypes[name] = csr[name].dtype
+        self.points += len(csr["labels"])
+        self.edges += len(csr["neighbours"])
+
+    def close(self):
+        """
+        Converts the raw files to .npy files, block by block through memory maps, and moves them to path.
+
+        @return: None.
+        """
+        empty = _sorted_csr(*[numpy.array([])] * 4)
+        for name in graph_files:
+            self.files[name].close()
+            raw = os.path.join(self.temporary, f"{name}.raw")
+            dtype = self.dtypes.get(name, empty[name].dtype)
+            count = os.path.getsize(raw) // dtype.itemsize
+            target = numpy.lib.format.open_memmap(os.path.join(self.temporary, f"{name}.npy"), mode="w+", dtype=dtype, shape=(count,))
+            if count:
+                source = numpy.memmap(raw, dtype=dtype, mode="r", shape=(count,))
+                for start in range(0, count, 1 << 24):
+                    target[start : start + (1 << 24)] = source[start : start + (1 << 24)]
+                del source
+            target.flush()
+            del target
+            os.remove(raw)
+        _replace_files(self.temporary, self.path)
+        print(f"Neighbour graph with {self.points} points and {self.edges} edges written")
+
+
+class NeighbourGraph:
+    """Read access to the neighbour graph written by build_neighbour_graph(), the arrays are memory-mapped"""
+
+    def __init__(self, path=path_neighbour_graph):
+        arrays = {name: numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in graph_files}
+        self.hours = arrays["hours"]
+        self.labels = arrays["labels"]
+        self.offsets = arrays["offsets"]
+        self.neighbour_labels = arrays["neighbours"]
+        self.distances = arrays["distances"]
+
+    def neighbours(self, label, hour, distance=max_distance_threshold):
+        """
+        Neighbours of one point, two binary searches and a slice of the edge arrays.
+
+        @param label: Trajectory label.
+        @param hour: Hour offset from time_epoch.
+        @param distance: Distance threshold in km, neighbours at most this far away are returned.
+        @return: Tuple (neighbour labels, distances) of arrays sorted by distance, empty if the point has no neighbours.
+        """
+        first = numpy.searchsorted(self.hours, hour, side="left")
+        last = numpy.searchsorted(self.hours, hour, side="right")
+        i = first + numpy.searchsorted(self.labels[first:last], label)
+        if i >= last or self.labels[i] != label:
+            return numpy.array([], dtype=numpy.int32), numpy.array([], dtype=numpy.float32)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        distances = numpy.array(self.distances[start:end])
+        end = start + numpy.searchsorted(distances, distance, side="right")
+        return numpy.array(self.neighbour_labels[start:end]), distances[: end - start]
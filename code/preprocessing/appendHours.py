@@ -0,0 +1,101 @@
+from globals import *
+import sys
+import time
+import pickle
+import numpy as np
+import pandas as pd
+import database
+import nearestneighbours
+import preprocessing
+import sweep
+
+"""
+This script appends new hourly trajectory files (synop_YYYYMMDDHH.nc, backward and forward) to the existing dataset
+and only processes the hours that are not in the timeline yet:
+    trajectories.parquet, timeline.parquet    positions of the new hours
+    neighbours/[distance]km_distance/         neighbour lists of the new hours
+    timeline_ranged.parquet                   rows of the new hours, treecodes of the existing TimeQuadTree
+    rangedict.pickle                          bounds of treecodes that were not known yet
+    sweep_histograms.npz                      histograms of the days with new hours (if the file exists)
+The TimeQuadTree is not rebuilt, new points get the code of the leaf that contains them.
+
+Usage: python appendHours.py FILE [FILE ...]
+"""
+
+
+def append_positions(positions):
+    """Appends the positions (columns label, time, longitude, latitude) to trajectories.parquet and timeline.parquet"""
+    positions = positions.astype({"label": "int64", "longitude": "float32", "latitude": "float32"})
+    trajectories = pd.read_parquet(path_trajectories_db)
+    trajectories = pd.concat([trajectories, positions.set_index(["label", "time"])]).sort_index()
+    trajectories.to_parquet(path_trajectories_db, engine="pyarrow")
+
+    timeline = pd.read_parquet(path_time_db)
+    new_timeline = positions.set_index(["time", "label"])
+    if "hour" in timeline.columns:
+        timeline = pd.concat([timeline, database.compact_timeline(new_timeline)], ignore_index=True)
+        timeline = timeline.sort_values(["hour", "label"], kind="mergesort").reset_index(drop=True)
+        timeline.to_parquet(path_time_db, index=False)
+    else:
+        timeline = pd.concat([timeline, new_timeline]).sort_index()
+        timeline.to_parquet(path_time_db, engine="pyarrow")
+
+
+def update_range_dict(cells):
+    """Adds the bounds of all treecodes (and their prefixes) of cells that are not in rangedict.pickle"""
+    rdict = pd.read_pickle(path_range_dict)
+    added = 0
+    for cell in np.unique(cells):
+        code = cell_to_treecode(cell)
+        for level in range(1, len(code) // 3 + 1):
+            prefix = code[0 : 3 * level]
+            if prefix not in rdict:
+                rdict[prefix] = treecode_region(prefix)
+                added += 1
+    with open(path_range_dict, "wb") as f:
+        pickle.dump(rdict, f)
+    return added
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    files = [path for path in sys.argv[1:] if synop_time(path) is not None]
+    if len(files) < len(sys.argv[1:]):
+        print("Skipped arguments that are not named synop_YYYYMMDDHH.nc")
+
+    # only hours that are not in the timeline yet
+    known = set(database.read_timeline(path_time_db).index.get_level_values("time").unique())
+    files = [path for path in files if pd.Timestamp(synop_time(path)) not in known]
+    if not files:
+        print("No new hours")
+        sys.exit(0)
+    frames = [frame for frame in (preprocessing.read_synop(path) for path in files) if frame is not None]
+    positions = pd.concat(frames, ignore_index=True)[["label", "time", "longitude", "latitude"]]
+    hours = sorted(positions.time.unique())
+    print(f"{len(hours)} new hours from {hours[0]} to {hours[-1]}, {len(positions)} positions")
+
+    append_positions(positions)
+    print(f"Positions appended after {time.time()-t0:.02f}s")
+
+    # neighbour lists of the new hours
+    result_path = neighbour_dir()
+    os.makedirs(result_path, exist_ok=True)
+    for t in hours:
+        t = pd.Timestamp(t).to_pydatetime()
+        timestamp_data = positions[positions.time == t].set_index("label")[["longitude", "latitude"]]
+        nearestneighbours.write_neighbours(timestamp_data, neighbour_file(result_path, t), max_distance_threshold)
+    print(f"Neighbours computed after {time.time()-t0:.02f}s")
+
+    # timeline_ranged rows of the new hours
+    new_tlr = database.getddict([pd.Timestamp(t).to_pydatetime() for t in hours], graph_path=path_neighbour_graph)
+    tlr = database.read_timeline_ranged(path_timeline_ranged_db)
+    tlr = pd.concat([tlr, new_tlr], ignore_index=True).sort_values("hour", kind="mergesort").reset_index(drop=True)
+    tlr.to_parquet(path_timeline_ranged_db, index=False)
+    print(f"{len(new_tlr)} timeline_ranged rows appended after {time.time()-t0:.02f}s")
+
+    print(f"{update_range_dict(new_tlr.cell.values)} cells added to the range dict")
+
+    if os.path.exists(path_sweep_histograms):
+        sweep.update_sweep_histograms(tlr, np.unique(new_tlr.hour.values.astype(np.int64) // 24))
+
+    print(f"Hours appended in {time.time()-t0:.02f}s")
@@ -0,0 +1,71 @@
+from globals import *
+import shutil
+import time
+import pandas as pd
+import database
+
+"""
+This script converts data/timeline_ranged.parquet and data/timeline.parquet to the compact schema
+(hour offsets, int32 labels, quantized distances, float32 sensor values, integer cell codes, see database.compact_timeline_ranged)
+and reports the in-memory size and the query time of a full-month contradiction query before and after.
+The original files are kept as *.legacy.parquet. A timeline_ranged converted with float16 sensor values by an earlier
+version is converted again from its *.legacy.parquet.
+"""
+
+
+def query_time(tlr, repeat=5):
+    """Best time of a full-month contradiction query (Salinity, threshold 1, distance 1km) on tlr"""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        if "treecode" in tlr.columns:
+            selection = (tlr.rmin <= 1) & (tlr.rmax > 1) & (tlr.s0 > 1)
+            result = tlr.loc[selection, ["time", "label", "treecode"]]
+        else:
+            selection = (tlr.rmin.values <= 1 / distance_unit) & (tlr.rmax.values > 1 / distance_unit) & (tlr.s0.values > 1)
+            result = tlr.loc[selection, ["hour", "label", "cell"]]
+        best = min(best, time.perf_counter() - t0)
+    return best, len(result)
+
+
+def report(name, legacy, compact, legacy_time=None, compact_time=None):
+    legacy_bytes = legacy.memory_usage(deep=True).sum()
+    compact_bytes = compact.memory_usage(deep=True).sum()
+    print(f"{name}: {legacy_bytes / 2**20:.1f} MiB -> {compact_bytes / 2**20:.1f} MiB ({legacy_bytes / compact_bytes:.1f}x smaller)")
+    if legacy_time is not None:
+        print(f"{name} full-month query: {legacy_time:.3f}s -> {compact_time:.3f}s ({legacy_time / compact_time:.1f}x faster)")
+
+
+def convert(path, legacy, compact):
+    backup = path.replace(".parquet", ".legacy.parquet")
+    if not os.path.exists(backup):
+        shutil.copyfile(path, backup)
+    compact.to_parquet(path, index=False)
+    print(f"{path} written, original kept as {backup}")
+
+
+if __name__ == "__main__":
+    tlr = pd.read_parquet(path_timeline_ranged_db)
+    legacy_path = path_timeline_ranged_db.replace(".parquet", ".legacy.parquet")
+    if "treecode" not in tlr.columns and tlr.s0.dtype == "float16" and os.path.exists(legacy_path):
+        print(f"{path_timeline_ranged_db} has float16 sensor values, converting {legacy_path} again")
+        tlr = pd.read_parquet(legacy_path)
+    if "treecode" not in tlr.columns:
+        print(f"{path_timeline_ranged_db} already uses the compact schema")
+    else:
+        compact = database.compact_timeline_ranged(tlr)
+        legacy_time, legacy_rows = query_time(tlr)
+        compact_time, compact_rows = query_time(compact)
+        report("timeline_ranged", tlr, compact, legacy_time, compact_time)
+        # distances are rounded up to distance_unit, so rows within one meter of the distance threshold may switch sides;
+        # sensor values are rounded up by less than one float32 ulp and stay above every threshold they exceeded
+        print(f"Contradictions: {legacy_rows} (legacy), {compact_rows} (compact)")
+        convert(path_timeline_ranged_db, tlr, compact)
+
+    timeline = pd.read_parquet(path_time_db)
+    if "hour" in timeline.columns:
+        print(f"{path_time_db} already uses the compact schema")
+    else:
+        compact = database.compact_timeline(timeline)
+        report("timeline", timeline, compact)
+        convert(path_time_db, timeline, compact)
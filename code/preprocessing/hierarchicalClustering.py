@@ -0,0 +1,150 @@
+from globals import *
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+"""
+This script clusters the trajectories hierarchically (single linkage) on the distance of uniteTrajectories.compare:
+the mean distance over the shared timestamps, trajectories with fewer than cluster_min_shared_hours shared timestamps
+are never linked directly. The minimum spanning tree of this distance is the single linkage tree, cutting it at a
+distance gives the clusters of that distance for any cut.
+
+Output in data/:
+    clustered-linkage.npz       edges of the minimum spanning tree (columns first, second, distance) and the labels
+    clustered-levels.parquet    centroid tracks per cut of globals.cluster_cuts, index (cut, label, time),
+                                columns longitude, latitude, weight (number of trajectories in the cluster);
+                                a cluster is labelled with its smallest trajectory label
+
+Usage: python hierarchicalClustering.py [CUT_KM ...]
+"""
+
+
+def position_vectors(trajectories):
+    """
+    Positions of all trajectories on a common time axis as unit vectors, the chord between two vectors gives the
+    haversine distance without trigonometry per pair.
+
+    @param trajectories: DataFrame indexed by (label, time) with the columns longitude, latitude.
+    @return: Tuple (labels, vectors float32 array of shape (labels, times, 3), present bool array of shape (labels, times)).
+    """
+    labels, label_index = np.unique(trajectories.index.get_level_values("label").values, return_inverse=True)
+    times, time_index = np.unique(trajectories.index.get_level_values("time").values, return_inverse=True)
+    lon = np.radians(trajectories.longitude.values.astype(np.float64))
+    lat = np.radians(trajectories.latitude.values.astype(np.float64))
+    vectors = np.zeros((len(labels), len(times), 3), dtype=np.float32)
+    vectors[label_index, time_index] = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+    present = np.zeros((len(labels), len(times)), dtype=bool)
+    present[label_index, time_index] = True
+    return labels, vectors, present
+
+
+def mean_distances(vectors, present, i, others, min_shared=cluster_min_shared_hours):
+    """
+    Mean haversine distance (km) over the shared timestamps between trajectory i and the trajectories others.
+
+    @return: float64 array, inf where fewer than min_shared timestamps are shared.
+    """
+    shared = present[others] & present[i]
+    chord = np.linalg.norm(vectors[others] - vectors[i], axis=2)
+    distances = 2 * 6371 * np.arcsin(np.minimum(chord / 2, 1))
+    counts = shared.sum(axis=1)
+    sums = np.where(shared, distances, 0).sum(axis=1, dtype=np.float64)
+    result = np.full(len(others), np.inf)
+    enough = counts >= min_shared
+    result[enough] = sums[enough] / counts[enough]
+    return result
+
+
+def minimum_spanning_tree(vectors, present, min_shared=cluster_min_shared_hours):
+    """
+    Prim's algorithm on the dense distance matrix, one row of distances is computed per added trajectory.
+    Unconnected trajectories are joined with infinite distance, so the result always has n - 1 edges.
+
+    @return: Tuple (first, second, distance) of arrays with one entry per edge, in the order the edges were added.
+    """
+    n = len(vectors)
+    in_tree = np.zeros(n, dtype=bool)
+    best = np.full(n, np.inf)
+    parent = np.full(n, -1, dtype=np.int64)
+    first, second, distance = [], [], []
+    t0 = time.time()
+    current = 0
+    for step in range(n):
+        in_tree[current] = True
+        if step > 0:
+            first.append(parent[current])
+            second.append(current)
+            distance.append(best[current])
+        outside = np.flatnonzero(~in_tree)
+        if not len(outside):
+            break
+        row = mean_distances(vectors, present, current, outside, min_shared)
+        closer = row < best[outside]
+        best[outside[closer]] = row[closer]
+        parent[outside[closer]] = current
+        candidates = best[outside]
+        current = outside[np.argmin(candidates)]
+        if not np.isfinite(candidates.min()):
+            # new component: the edge of infinite distance joins it to the tree
+            parent[current] = second[-1] if second else 0
+        if step % 1000 == 0:
+            print(f"{step}/{n} trajectories in the tree after {time.time()-t0:.02f}s")
+    return np.array(first, dtype=np.int64), np.array(second, dtype=np.int64), np.array(distance, dtype=np.float64)
+
+
+def cut_clusters(first, second, distance, n, cut):
+    """
+    Clusters of the single linkage tree at a distance cut: the components of the spanning tree edges of at most cut km.
+
+    @return: int64 array of the cluster id (its smallest member index) of every trajectory.
+    """
+    root = np.arange(n)
+
+    def find(x):
+        while root[x] != x:
+            root[x] = root[root[x]]
+            x = root[x]
+        return x
+
+    for a, b in zip(first[distance <= cut], second[distance <= cut]):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            root[max(ra, rb)] = min(ra, rb)
+    return np.array([find(x) for x in range(n)], dtype=np.int64)
+
+
+def centroid_tracks(trajectories, labels, clusters):
+    """
+    Mean track and size of every cluster, like uniteTrajectories.cluster() but for all clusters at once.
+
+    @return: DataFrame indexed by (label, time) with the columns longitude, latitude, weight.
+    """
+    members = pd.Series(labels[clusters], index=labels)
+    sizes = members.value_counts()
+    frame = trajectories.reset_index()
+    frame["label"] = members.loc[frame.label.values].values
+    tracks = frame.groupby(["label", "time"]).agg(longitude=("longitude", "mean"), latitude=("latitude", "mean"))
+    tracks["weight"] = sizes.loc[tracks.index.get_level_values("label")].values
+    return tracks
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    cuts = [float(cut) for cut in sys.argv[1:]] or cluster_cuts
+    trajectories = pd.read_parquet(path_trajectories_db)
+    labels, vectors, present = position_vectors(trajectories)
+    print(f"{len(labels)} trajectories on {present.shape[1]} timestamps loaded after {time.time()-t0:.02f}s")
+
+    first, second, distance = minimum_spanning_tree(vectors, present)
+    np.savez_compressed(path_cluster_linkage, first=first, second=second, distance=distance, labels=labels)
+    print(f"Single linkage tree written after {time.time()-t0:.02f}s")
+
+    levels = []
+    for cut in cuts:
+        clusters = cut_clusters(first, second, distance, len(labels), cut)
+        tracks = centroid_tracks(trajectories, labels, clusters)
+        print(f"Cut {cut:g}km: {tracks.index.get_level_values('label').nunique()} clusters")
+        levels.append(pd.concat({cut: tracks}, names=["cut"]))
+    pd.concat(levels).to_parquet(path_clustered_levels, engine="pyarrow")
+    print(f"Clustering written to {path_clustered_levels} in {time.time()-t0:.02f}s")
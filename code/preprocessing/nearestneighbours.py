@@ -1,5 +1,6 @@
 import os
 import pickle
+import sys
 import time
 import datetime
 import quadTree as qt
@@ -7,38 +8,143 @@ from globals import *
 import database
 
 
+class GridIndex:
+    """
+    Points on a grid of cells that are at least distance wide, sorted by cell. A query only compares the points in the
+    same or an adjacent cell, so the work grows with the number of pairs. Built once per hour, it can be queried
+    with the points of the hour itself and of other hours.
+    """
+
+    def __init__(self, lon, lat, distance, highest=None):
+        """
+        @param lon: Longitudes of the points.
+        @param lat: Latitudes of the points.
+        @param distance: Neighbour distance in km.
+        @param highest: Largest absolute latitude of the indexed and of all queried points, default from lat.
+        @return: None.
+        """
+        self.lon, self.lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        self.distance = distance
+        # cell size in degrees: km per degree of latitude of distance_wgs, longitudes scaled for the highest latitude (+1% margin)
+        km_per_degree = 6371 * math.pi / 180
+        self.height = 1.01 * distance / km_per_degree
+        if highest is None:
+            highest = np.abs(self.lat).max(initial=0)
+        self.width = self.height / math.cos(math.radians(min(highest + self.height, 89.0)))
+        column, row = self.cells(self.lon, self.lat)
+        # cells as one sortable key, rows are shifted to 1..n_rows - 2
+        self.first_row = row.min(initial=0) - 1
+        self.n_rows = int(row.max(initial=0) - self.first_row) + 2
+        keys = column * self.n_rows + (row - self.first_row)
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+
+    def cells(self, lon, lat):
+        return np.floor(lon / self.width).astype(np.int64), np.floor(lat / self.height).astype(np.int64)
+
+    def query(self, lon, lat, same=False, block=100_000):
+        """
+        Pairs of the given points and the indexed points at most distance apart.
+
+        @param lon: Longitudes of the queried points.
+        @param lat: Latitudes of the queried points.
+        @param same: Whether the queried points are the indexed points, a point is then not paired with itself.
+        @param block: Number of queried points compared at once, bounds the memory of the candidate pairs.
+        @return: Tuple (first, second, distances) of the indexes into the queried and the indexed points and the
+                 distances in km, sorted by (first, second).
+        """
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        column, row = self.cells(lon, lat)
+        firsts, seconds, distances = [], [], []
+        for start in range(0, len(lon) if len(self.lon) else 0, block):
+            points = np.arange(start, min(start + block, len(lon)))
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    shifted = row[points] + dy - self.first_row
+                    keys = (column[points] + dx) * self.n_rows + shifted
+                    low = np.searchsorted(self.sorted_keys, keys, side="left")
+                    high = np.searchsorted(self.sorted_keys, keys, side="right")
+                    counts = np.where((shifted >= 0) & (shifted < self.n_rows), high - low, 0)
+                    if not counts.sum():
+                        continue
+                    first = np.repeat(points, counts)
+                    # positions low .. high - 1 of every point in the sorted indexed points
+                    positions = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                    second = self.order[positions]
+                    d = distance_wgs(lon[first], lat[first], self.lon[second], self.lat[second])
+                    keep = d <= self.distance
+                    if same:
+                        keep &= first != second
+                    firsts.append(first[keep])
+                    seconds.append(second[keep])
+                    distances.append(d[keep])
+        if not firsts:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        first, second, d = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(distances)
+        sort = np.lexsort((second, first))
+        return first[sort], second[sort], d[sort]
+
+
+def neighbour_pairs(lon, lat, distance, other_lon=None, other_lat=None, block=100_000):
+    """
+    Pairs of points at most distance apart, see GridIndex.
+
+    @param lon: Longitudes of the points.
+    @param lat: Latitudes of the points.
+    @param distance: Neighbour distance in km.
+    @param other_lon: Longitudes of a second point set, default is the first set (a point is not paired with itself).
+    @param other_lat: Latitudes of the second point set.
+    @param block: Number of points of the first set compared at once, bounds the memory of the candidate pairs.
+    @return: Tuple (first, second, distances) of the indexes into the first and the second set and the distances in km,
+             sorted by (first, second).
+    """
+    same = other_lon is None
+    if same:
+        other_lon, other_lat = lon, lat
+    highest = max(np.abs(np.asarray(lat, dtype=np.float64)).max(initial=0), np.abs(np.asarray(other_lat, dtype=np.float64)).max(initial=0))
+    return GridIndex(other_lon, other_lat, distance, highest).query(lon, lat, same, block)
+
+
+def write_neighbours(timestamp_data, file_path, contradiction_distance=max_distance_threshold):
+    """
+    Writes the neighbour list of one hour: one line per label with the labels within contradiction_distance.
+
+    @param timestamp_data: Positions of the hour indexed by label with the columns longitude, latitude.
+    @param file_path: Output csv file.
+    @param contradiction_distance: Neighbour distance in km.
+    @return: Number of neighbour pairs.
+    """
+    labels = timestamp_data.index.values
+    first, second, _ = neighbour_pairs(timestamp_data.longitude.values, timestamp_data.latitude.values, contradiction_distance)
+    bounds = np.searchsorted(first, np.arange(len(labels) + 1))
+    with open(file_path, "w") as f:
+        for i, label in enumerate(labels):
+            f.write(f"{label},{','.join(map(str, labels[second[bounds[i] : bounds[i + 1]]]))}\n")
+    return len(first)
+
+
 if __name__ == "__main__":
     t10 = time.time()
 
-    # Value for neighbour distance in km
-    contradiction_distance = max_distance_threshold
+    # Value for neighbour distance in km, --distance D for another radius than max_distance_threshold
+    contradiction_distance = float(sys.argv[sys.argv.index("--distance") + 1]) if "--distance" in sys.argv else max_distance_threshold
+    # --append: only hours without a neighbour list are processed
+    append = "--append" in sys.argv[1:]
 
     db = database.Database()
 
-    neighbour_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../neighbours")
-    try:
-        os.mkdir(neighbour_path)
-    except FileExistsError:
-        pass
-    result_path = os.path.join(neighbour_path, f"{contradiction_distance}km_distance")
-    try:
-        os.mkdir(result_path)
-    except FileExistsError:
-        pass
-
-    for day in range(1, 31):
-        for hour in range(0, 24):
-            print(f"{str(day).zfill(2)}/{str(hour).zfill(2)}")
-            with open(os.path.join(result_path, f"{day}_{hour}.csv"), "w") as f:
-                t1 = datetime.datetime(2013, 6, day, hour)
-                ts = TimeSpan(t1, t1)
-                timestamp_data = db.query(timespan=ts)
-                timestamp_data = timestamp_data.reset_index(level=0, drop=True)
-                vfunc = np.vectorize(distance_wgs)
-                for row in timestamp_data.itertuples():
-                    label, lon, lat = row
-                    tsd = timestamp_data.drop([label])
-                    within_distance_data = tsd[vfunc(lon, lat, tsd["longitude"], tsd["latitude"]) <= contradiction_distance]
-                    f.write(f"{label},{','.join(within_distance_data.index.format())}\n")
+    result_path = neighbour_dir(contradiction_distance)
+    os.makedirs(result_path, exist_ok=True)
+
+    for t1 in db.timeline.index.get_level_values("time").unique().sort_values():
+        t1 = t1.to_pydatetime()
+        file_path = neighbour_file(result_path, t1)
+        if append and os.path.exists(file_path):
+            continue
+        print(f"{t1:%Y-%m-%d %H}")
+        ts = TimeSpan(t1, t1)
+        timestamp_data = db.query(timespan=ts)
+        timestamp_data = timestamp_data.reset_index(level=0, drop=True)
+        write_neighbours(timestamp_data, file_path, contradiction_distance)
     t12 = time.time()
     print(f"Benchmarked time:{t12-t10:.02f}")
@@ -0,0 +1,74 @@
+from globals import *
+import sys
+import time
+import pandas as pd
+import pyarrow.parquet as pq
+import database
+import nearestneighbours
+
+"""
+This script computes the neighbour lists and timeline_ranged for one or more neighbour radii and reports the build time
+and the output size per radius. The neighbour pairs grow with the square of the radius, timeline_ranged only with
+the number of distance bands (the distances at which the running maximum of the sensor differences changes).
+
+Output per radius R (km):
+    neighbours/Rkm_distance/                            neighbour lists
+    neighbours/Rkm_distance/timeline_ranged.parquet     timeline_ranged of the radius (compact schema)
+    neighbours/Rkm_distance/neighbour_graph/            neighbour graph of the radius
+    neighbours/radius_report.csv                        one row per radius
+To use a radius, copy its timeline_ranged.parquet and neighbour_graph/ to data/ and start the app with OTV_MAX_DISTANCE=R.
+
+Usage: python neighbourRadius.py RADIUS_KM [RADIUS_KM ...]
+"""
+
+
+def directory_size(path, suffix=""):
+    """Summed size of the files in path (with names ending in suffix) in bytes"""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names if name.endswith(suffix))
+
+
+def build_radius(timeline, radius):
+    """
+    Writes the neighbour lists, timeline_ranged and the neighbour graph of one radius.
+
+    @param timeline: Positions indexed by (time, label) with the columns longitude, latitude, see database.read_timeline.
+    @param radius: Neighbour radius in km.
+    @return: Dictionary of the report row.
+    """
+    result_path = neighbour_dir(radius)
+    os.makedirs(result_path, exist_ok=True)
+    t0 = time.time()
+    pairs = 0
+    for t, positions in timeline.groupby(level="time"):
+        pairs += nearestneighbours.write_neighbours(
+            positions.reset_index(level=0, drop=True), neighbour_file(result_path, t.to_pydatetime()), radius
+        )
+    neighbour_seconds = time.time() - t0
+    neighbour_bytes = directory_size(result_path, ".csv")
+
+    t0 = time.time()
+    output = os.path.join(result_path, "timeline_ranged.parquet")
+    graph_path = os.path.join(result_path, "neighbour_graph")
+    database.getddict(max_distance=radius, output=output, graph_path=graph_path)
+    return {
+        "radius_km": radius,
+        "neighbour_pairs": pairs,
+        "neighbour_seconds": round(neighbour_seconds, 2),
+        "neighbour_list_bytes": neighbour_bytes,
+        "timeline_ranged_seconds": round(time.time() - t0, 2),
+        "timeline_ranged_rows": pq.ParquetFile(output).metadata.num_rows,
+        "timeline_ranged_bytes": os.path.getsize(output),
+        "neighbour_graph_bytes": directory_size(graph_path),
+    }
+
+
+if __name__ == "__main__":
+    radii = [float(radius) for radius in sys.argv[1:]] or [max_distance_threshold]
+    timeline = database.read_timeline(path_time_db)
+    report = []
+    for radius in radii:
+        print(f"Radius {radius:g}km")
+        report.append(build_radius(timeline, radius))
+    report = pd.DataFrame(report)
+    report.to_csv(os.path.join(neighbour_prefix, "radius_report.csv"), index=False)
+    print(report.to_string(index=False))
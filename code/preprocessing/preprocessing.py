@@ -3,17 +3,13 @@ import time
 import datetime
 import xarray as xa
 import pandas
+from globals import synop_time
 
 debug = True
 
 path_sensors_raw = r"data/obs_2013.nc"
 path_bw = r"data/BW"
 path_fw = r"data/FW"
-prefix = r"synop_201306"
-suffix = r".nc"
-year = 2013
-month = 6
-month_days = 30
 
 path_sensors_db = r"data/sensors.parquet"
 path_meta_db = r"data/sensors_metadata.csv"
@@ -21,6 +17,28 @@ path_trajectories_db = r"data/trajectories.parquet"
 path_time_db = r"data/timeline.parquet"
 
 
+def synop_files(directory):
+    """ Hourly files synop_YYYYMMDDHH.nc in directory, sorted by time """
+    if not os.path.isdir(directory):
+        return []
+    files = [os.path.join(directory, name) for name in os.listdir(directory) if synop_time(name) is not None]
+    return sorted(files, key=lambda file_path: (synop_time(file_path), file_path))
+
+
+def read_synop(file_path):
+    """ Positions of one hourly file as DataFrame with the columns label, time, longitude, latitude, None if it can't be read """
+    try:
+        ds = xa.load_dataset(file_path)
+        df = ds.to_dataframe()
+    except Exception as e1:
+        print(f"Problem with file {file_path}\n", e1)
+        return None
+    df = df.drop(labels=["initial_year", "travel_time"], axis=1)
+    df.label = df.label.str.decode(encoding='ASCII').astype(int)
+    df["time"] = synop_time(file_path)
+    return df
+
+
 def preprocessing():
     """ sensors.parquet
 
@@ -56,40 +74,13 @@ def preprocessing():
     tr = tr.astype(dtype={
                    'label': 'int64', 'time': 'datetime64[ns]', 'longitude': 'float32', 'latitude': 'float32'})
     count = 0
-    # BW
-    for day in range(1, month_days+1):
-        for hour in range(0, 24):
-            file_path = os.path.join(
-                path_bw, f"{prefix}{day:02i}{hour:02i}{suffix}")
-            bw = 0
-            try:
-                ds = xa.load_dataset(file_path)
-                bw = ds.to_dataframe()
-                count += len(bw)
-            except Exception as e1:
-                print(f"Problem with file {file_path}\n", e1)
-                continue
-            bw = bw.drop(labels=["initial_year", "travel_time"], axis=1)
-            bw.label = bw.label.str.decode(encoding='ASCII').astype(int)
-            bw["time"] = datetime.datetime(year, month, day, hour)
-            tr = pandas.concat([tr, bw], axis=0, ignore_index=True)
-    # FW
-    for day in range(1, month_days+1):
-        for hour in range(0, 24):
-            file_path = os.path.join(
-                path_fw, f"{prefix}{day:02i}{hour:02i}{suffix}")
-            fw = 0
-            try:
-                ds = xa.load_dataset(file_path)
-                fw = ds.to_dataframe()
-                count += len(fw)
-            except Exception as e1:
-                print(f"Problem with file {file_path}\n", e1)
-                continue
-            fw = fw.drop(labels=["initial_year", "travel_time"], axis=1)
-            fw.label = fw.label.str.decode(encoding='ASCII').astype(int)
-            fw["time"] = datetime.datetime(year, month, day, hour)
-            tr = pandas.concat([tr, fw], axis=0, ignore_index=True)
+    # BW + FW, every hourly file that is present
+    for file_path in synop_files(path_bw) + synop_files(path_fw):
+        hour_data = read_synop(file_path)
+        if hour_data is None:
+            continue
+        count += len(hour_data)
+        tr = pandas.concat([tr, hour_data], axis=0, ignore_index=True)
     # save by trajectory
     tr = tr.set_index(['label', 'time']).sort_index()
     tr.to_parquet(path_trajectories_db, engine='pyarrow')
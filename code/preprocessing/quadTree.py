@@ -1,8 +1,31 @@
+import bisect
+import heapq
 import numpy as np
-from globals import Region, default_region
+from globals import Region, default_region, distance_wgs
 import os
 import pandas as pd
 
+# Radius of earth in kilometers, as in globals.distance_wgs
+earth_radius = 6371
+
+
+def min_distance(boundary, lon, lat):
+    """
+    Lower bound of the haversine distance (km) between positions and any point of boundary.
+    The distance is at least the latitude difference to the boundary and the distance to the great circle through the
+    nearest boundary meridian, both are exact for points beside the boundary.
+    :param boundary: Region in WGS 84
+    :param lon: Longitude or array of longitudes
+    :param lat: Latitude or array of latitudes
+    :return: Lower bound or array of lower bounds, 0 for positions inside boundary
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    dlon = np.radians(np.maximum(np.maximum(boundary.x_min - lon, lon - boundary.x_max), 0))
+    dlat = np.radians(np.maximum(np.maximum(boundary.y_min - lat, lat - boundary.y_max), 0))
+    meridian = np.arcsin(np.clip(np.cos(np.radians(lat)) * np.sin(np.minimum(dlon, np.pi / 2)), 0, 1))
+    return earth_radius * np.maximum(dlat, meridian)
+
 
 class Point:
     """A point located at (long, lat) in 2D space.
@@ -288,13 +311,18 @@ class QuadTree:
 
 
 class TimeQuadTree(QuadTree):
-    """A class implementing a quadtree that also records the time interval of its points and allows to query for timestamps"""
+    """A class implementing a quadtree that also records the time interval of its points and allows to query for timestamps
+
+    The points of a leaf are kept sorted by time together with the list point_times of their times,
+    so the points of a time interval in a leaf are found with two binary searches (see points_in_time).
+    """
 
     def __init__(self, boundary, max_points=4, depth=0, max_depth=20, parent=None, code=""):
         """Constructor is the same as for QuadTrees but also creates the fields for the time interval stored in this (sub)tree """
 
         self.minTime = None
         self.maxTime = None
+        self.point_times = []
         super().__init__(boundary, max_points, depth, max_depth, parent, code)
 
     def __str__(self):
@@ -346,24 +374,51 @@ class TimeQuadTree(QuadTree):
             self.se.insert(point)
             self.sw.insert(point)
         self.points = []
+        self.point_times = []
 
         self.divided = True
 
     def insert(self, point):
         """
         Inserts the Point point like in QuadTree.insert() but also updates the time Interval of this (sub)Tree
-        As QuadTree.insert() is recursive the time interval of a parent tree always includes the intervals of its children
+        and keeps the points of a leaf sorted by time (points with equal times in insertion order)
+        As the insertion is recursive the time interval of a parent tree always includes the intervals of its children
         """
 
-        if super().insert(point):  # this is True if the insertion was successful
+        if not self.boundary.contains(point):
+            return False
+
+        inserted = False
+        if not self.divided:
+            if len(self.points) < self.max_points or self.depth == self.max_depth:
+                i = bisect.bisect_right(self.point_times, point.time)
+                self.points.insert(i, point)
+                self.point_times.insert(i, point.time)
+                inserted = True
+            else:
+                self.divide()
+        if not inserted:
+            inserted = (self.ne.insert(point) or
+                        self.nw.insert(point) or
+                        self.se.insert(point) or
+                        self.sw.insert(point))
+        if inserted:
             point_time = point.time
             if self.minTime is None or point_time < self.minTime:
                 self.minTime = point_time
             if self.maxTime is None or point_time > self.maxTime:
                 self.maxTime = point_time
-            return True
-        else:
-            return False
+        return inserted
+
+    def points_in_time(self, timeMin, timeMax):
+        """
+        The points of this node inside a time interval, a slice of the time-sorted points found with two binary searches
+        Trees pickled before the points were sorted have no point_times, their points are filtered one by one
+        """
+        point_times = getattr(self, "point_times", None)
+        if point_times is None or len(point_times) != len(self.points):
+            return [point for point in self.points if timeMin <= point.time <= timeMax]
+        return self.points[bisect.bisect_left(point_times, timeMin):bisect.bisect_right(point_times, timeMax)]
 
     def checkTimeConstraints(self, timeMin, timeMax):
         """Check whether a queried time interval satisfies certain criteria"""
@@ -391,9 +446,9 @@ class TimeQuadTree(QuadTree):
             # search region, we don't need to look in it for points.
             return False
 
-        # Search this node's points to see if they lie within boundary and queried time interval...
-        for point in self.points:
-            if boundary.contains(point) and timeMin <= point.time <= timeMax:
+        # Search this node's points of the queried time interval to see if they lie within boundary...
+        for point in self.points_in_time(timeMin, timeMax):
+            if boundary.contains(point):
                 found_points.append(point)
         # ... and if this node has children, search them too.
         if self.divided:
@@ -421,8 +476,8 @@ class TimeQuadTree(QuadTree):
         # Search this node's points to see if they lie within boundary,
         # within the queried time interval
         # and also lie within a circle of given radius around the centre point.
-        for point in self.points:
-            if boundary.contains(point) and point.distance_to(centre) <= radius and timeMin <= point.time <= timeMax:
+        for point in self.points_in_time(timeMin, timeMax):
+            if boundary.contains(point) and point.distance_to(centre) <= radius:
                 found_points.append(point)
 
         # Recurse the search into this node's children.
@@ -440,3 +495,94 @@ class TimeQuadTree(QuadTree):
         # First find the square that bounds the search circle as a Rect object.
         boundary = Region(cx - radius, cx + radius, cy - radius, cy + radius)
         return self.time_query_circle(boundary, centre, radius, found_points, timeMin, timeMax)
+
+    def children(self):
+        """The four subtrees of a divided node, an empty list for leaves"""
+        return [self.nw, self.ne, self.se, self.sw] if self.divided else []
+
+    def knn(self, centre, k, timeMin, timeMax, max_distance=np.inf, predicate=None):
+        """Find the k points nearest to centre (haversine distance) inside a time interval.
+
+        The nodes are visited best-first: a priority queue holds nodes keyed by a lower bound of their distance
+        (see min_distance) and points keyed by their distance, so a point is final once it is popped.
+        Nodes outside the time interval are pruned by their min/max time.
+        :param centre: Tuple (longitude, latitude)
+        :param k: Number of points
+        :param timeMin: Start of the time interval
+        :param timeMax: End of the time interval
+        :param max_distance: Only points at most this far away (km) are returned
+        :param predicate: Optional function Point -> bool, e.g. whether the point is a conflicting water parcel
+        :return: List of tuples (distance in km, Point) sorted by distance, fewer than k if there are not enough points
+        """
+        cx, cy = centre[0], centre[1]
+        found = []
+        # entries (key, tie breaker, node or point), the tie breaker keeps nodes and points from being compared
+        heap = [(0.0, 0, self)]
+        counter = 1
+        while heap and len(found) < k:
+            distance, _, item = heapq.heappop(heap)
+            if distance > max_distance:
+                break
+            if isinstance(item, Point):
+                found.append((distance, item))
+                continue
+            if not item.checkTimeConstraints(timeMin, timeMax):
+                continue
+            for point in item.points_in_time(timeMin, timeMax):
+                if predicate is None or predicate(point):
+                    heapq.heappush(heap, (float(distance_wgs(cx, cy, point.long, point.lat)), counter, point))
+                    counter += 1
+            for child in item.children():
+                if child.checkTimeConstraints(timeMin, timeMax):
+                    heapq.heappush(heap, (float(min_distance(child.boundary, cx, cy)), counter, child))
+                    counter += 1
+        return found
+
+    def knn_batch(self, centres, k, timeMin, timeMax, max_distance=np.inf, predicate=None):
+        """Batched version of knn() for many query points in one traversal of the tree.
+
+        Every node is tested against all queries that are still active below it at once: a query leaves a subtree when
+        the lower bound of the node exceeds its current k-th distance. Children are visited closest first (by the mean
+        lower bound of the active queries), so the k-th distances shrink early.
+        :param centres: Array of shape (n, 2) with longitude, latitude per query
+        :return: List with the result of knn() for every query
+        """
+        centres = np.asarray(centres, dtype=np.float64).reshape(-1, 2)
+        n = len(centres)
+        best_distances = np.full((n, k), np.inf)
+        best_points = np.full((n, k), -1, dtype=np.int64)
+        points = []
+
+        def visit(node, active):
+            if not node.checkTimeConstraints(timeMin, timeMax):
+                return
+            bound = min_distance(node.boundary, centres[active, 0], centres[active, 1])
+            keep = (bound < best_distances[active, -1]) & (bound <= max_distance)
+            active, bound = active[keep], bound[keep]
+            if not len(active):
+                return
+            candidates = [point for point in node.points_in_time(timeMin, timeMax) if predicate is None or predicate(point)]
+            if candidates:
+                lon = np.array([point.long for point in candidates], dtype=np.float64)
+                lat = np.array([point.lat for point in candidates], dtype=np.float64)
+                distances = distance_wgs(centres[active, 0][:, None], centres[active, 1][:, None], lon[None, :], lat[None, :])
+                distances[distances > max_distance] = np.inf
+                ids = np.arange(len(points), len(points) + len(candidates))
+                points.extend(candidates)
+                merged_distances = np.concatenate([best_distances[active], distances], axis=1)
+                merged_points = np.concatenate([best_points[active], np.broadcast_to(ids, distances.shape)], axis=1)
+                order = np.argsort(merged_distances, axis=1, kind="stable")[:, :k]
+                best_distances[active] = np.take_along_axis(merged_distances, order, axis=1)
+                best_points[active] = np.take_along_axis(merged_points, order, axis=1)
+            children = node.children()
+            if children:
+                bounds = [min_distance(child.boundary, centres[active, 0], centres[active, 1]).mean() for child in children]
+                for i in np.argsort(bounds, kind="stable"):
+                    visit(children[i], active)
+
+        if n:
+            visit(self, np.arange(n))
+        return [
+            [(float(d), points[j]) for d, j in zip(best_distances[q], best_points[q]) if j >= 0 and np.isfinite(d)]
+            for q in range(n)
+        ]
@@ -6,10 +6,10 @@ import pandas as pd
 from globals import *
 
 """
-This script builds a timeQuadTree for all data and a single timeQuadTree for each day in June 2013 from the observation data.
+This script builds a timeQuadTree for all data and a single timeQuadTree for each day from the observation data.
 Trees are serialised in the './trees/[name]/' directory.
 The timeQuadTree is saved to the file './trees/[name]timeQuadTree.p'
-The Daily Trees are saved as './trees/[name]/day_[day_of_month].p'
+The Daily Trees are saved as './trees/[name]/day_[day number].p', day 1 is 2013-06-01 (see globals.day_number)
 
 Accepts the path to a dataset in parquet format as an optional first parameter and builds the trees from this dataset.
 If no parameter is supplied default is '/data/trajectories.parquet' and [name] is "allData"
@@ -36,7 +36,7 @@ if __name__ == '__main__':
         name = "allData"
 
     # get output path
-    output_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'trees/{name}')
+    output_path = os.path.join(os.environ.get("OTV_TREE_PREFIX", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trees')), name)
 
     targetArea = default_region
 
@@ -51,8 +51,8 @@ if __name__ == '__main__':
     # single tree
     tree = qt.TimeQuadTree(targetArea, max_points=20)
 
-    # daily trees
-    d_trees = [qt.TimeQuadTree(targetArea, max_points=20) for i in range(30)]
+    # daily trees by day number
+    d_trees = dict()
 
     # Insert each datapoint from the dataset
     for row in data.iterrows():
@@ -61,20 +61,22 @@ if __name__ == '__main__':
         if not tree.insert(p):
             raise Exception(
                 f"Can't insert Point {str(p)} into Time Quad Tree maybe increase maximal allowed points in single quad tree cell")
-        if not d_trees[p.time.day-1].insert(p):  # array 0-indexed, days start at 1
+        day = day_number(p.time)
+        if day not in d_trees:
+            d_trees[day] = qt.TimeQuadTree(targetArea, max_points=20)
+        if not d_trees[day].insert(p):
             raise Exception(
                 f"Can't insert Point {str(p)} into Time Quad Tree maybe increase maximal allowed points in single quad tree cell")
 
     # Save trees to files
     try:
-        os.mkdir(output_path)
+        os.makedirs(output_path)
         os.mkdir(os.path.join(output_path, 'daily'))
     except FileExistsError:  # we don't care if directories already exist
         pass
     with open(os.path.join(output_path, 'timeQuadTree.p'), 'wb') as f:
         pickle.dump(tree, f)
 
-    for index, tree in enumerate(d_trees):
-        day_index = index+1  # array 0-indexed, days start at 1
+    for day_index, tree in d_trees.items():
         with open(os.path.join(output_path, f'daily/day_{day_index}.p'), 'wb') as f:
             pickle.dump(tree, f)
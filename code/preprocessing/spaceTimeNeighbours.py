@@ -0,0 +1,125 @@
+from globals import *
+import time
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
+import database
+from nearestneighbours import GridIndex
+
+"""
+This script detects space-time contradictions: the neighbours of a point are the points within max_distance_threshold
+in the same hour and in the hours before and after it (only the same parcel one hour apart is left out).
+Water that contradicts one hour apart at the same spot is then visible as well.
+
+The hours are processed as a sliding window: the grid index of every hour is built once, the pairs of two adjacent
+hours are computed once and give the neighbours of the points of both hours.
+
+Output in data/:
+    timeline_ranged_spacetime.parquet   like timeline_ranged (compact schema), start the app with OTV_SPACETIME=1 to show it;
+                                        sweepHistograms.py run with OTV_SPACETIME=1 writes its sweep histograms
+
+Usage: python spaceTimeNeighbours.py
+"""
+
+
+def hour_bands(point, pairs, sensor_values, max_distance):
+    """
+    timeline_ranged rows of one hour from the neighbour pairs of its points, see database.distance_bands.
+
+    @param point: Dictionary of the hour (time, labels, ids, lon, lat), see space_time_rows.
+    @param pairs: List of tuples (point index, neighbour label id, distance in km).
+    @param sensor_values: Sensor values by label id, see database.LabelEncoding.
+    @param max_distance: Neighbour radius in km.
+    @return: DataFrame of the rows, None if no point has neighbours.
+    """
+    lines = np.concatenate([p[0] for p in pairs])
+    if not len(lines):
+        return None
+    neighbour_ids = np.concatenate([p[1] for p in pairs])
+    distance = np.concatenate([p[2] for p in pairs]).astype(np.float32)
+    order = np.argsort(lines, kind="stable")
+    lines, neighbour_ids, distance = lines[order], neighbour_ids[order], distance[order]
+    sensor_difference = np.abs(sensor_values[point["ids"][lines]] - sensor_values[neighbour_ids])
+    sensor_difference[np.isnan(sensor_difference)] = 0
+    return database.distance_bands(
+        point["time"], lines, point["labels"][lines], point["lon"][lines], point["lat"][lines], distance, sensor_difference, max_distance
+    )
+
+
+def space_time_rows(timeline, encoding, max_distance=max_distance_threshold, adjacent=True):
+    """
+    timeline_ranged rows of every hour with the neighbours in the same and the adjacent hours.
+
+    @param timeline: Positions indexed by (time, label) with the columns longitude, latitude, see database.read_timeline.
+    @param encoding: LabelEncoding of the sensors and the timeline.
+    @param max_distance: Neighbour radius in km.
+    @param adjacent: Whether the adjacent hours are included, False gives the same-hour rows of getddict().
+    @return: Generator of DataFrames (one per hour with neighbours) with the columns of database.distance_bands.
+    """
+    # latitude bound of the grid cells, the same for all hours so that every index can be queried with every hour
+    highest = float(np.abs(timeline.latitude.values).max(initial=0))
+    previous = None
+    for t, positions in timeline.groupby(level="time"):
+        labels = positions.index.get_level_values("label").values
+        point = {
+            "time": t.to_pydatetime(),
+            "hour": hour_offset(t.to_pydatetime()),
+            "labels": labels,
+            "ids": encoding.ids(labels),
+            "lon": positions.longitude.values,
+            "lat": positions.latitude.values,
+            "pairs": [],
+        }
+        point["index"] = GridIndex(point["lon"], point["lat"], max_distance, highest)
+        first, second, distance = point["index"].query(point["lon"], point["lat"], same=True)
+        point["pairs"].append((first, point["ids"][second], distance))
+        if adjacent and previous is not None and previous["hour"] + 1 == point["hour"]:
+            # pairs of the hour and the hour before, used for the points of both hours
+            first, second, distance = previous["index"].query(point["lon"], point["lat"])
+            other = labels[first] != previous["labels"][second]
+            first, second, distance = first[other], second[other], distance[other]
+            point["pairs"].append((first, previous["ids"][second], distance))
+            previous["pairs"].append((second, point["ids"][first], distance))
+        if previous is not None:
+            frame = hour_bands(previous, previous["pairs"], encoding.sensor_values, max_distance)
+            if frame is not None:
+                yield frame
+        previous = point
+    if previous is not None:
+        frame = hour_bands(previous, previous["pairs"], encoding.sensor_values, max_distance)
+        if frame is not None:
+            yield frame
+
+
+def write_chunk(writer, frames, points2trees):
+    """Appends the frames of some hours to the output, creates the writer with the schema of the first chunk"""
+    chunk = database.compact_timeline_ranged(database.with_treecodes(pd.concat(frames, ignore_index=True), points2trees))
+    table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+    writer = writer or pq.ParquetWriter(path_timeline_ranged_spacetime_db, table.schema)
+    writer.write_table(table)
+    return writer, len(chunk)
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    timeline = database.read_timeline(path_time_db)
+    encoding = database.LabelEncoding(pd.read_parquet(path_sensors_db), timeline)
+    points2treecode_path = os.path.join(tree_path, "points2treecode.p")
+    points2trees = pd.read_pickle(points2treecode_path) if os.path.exists(points2treecode_path) else None
+
+    writer = None
+    rows = 0
+    frames = []
+    for frame in space_time_rows(timeline, encoding):
+        frames.append(frame)
+        if len(frames) == getddict_chunk_hours:
+            writer, written = write_chunk(writer, frames, points2trees)
+            rows += written
+            frames = []
+            print(f"{rows} rows written after {time.time()-t0:.02f}s")
+    if frames or writer is None:
+        writer, written = write_chunk(writer, frames or [pd.DataFrame(columns=database.timeline_ranged_columns)], points2trees)
+        rows += written
+    writer.close()
+    print(f"{rows} space-time timeline_ranged rows written to {path_timeline_ranged_spacetime_db} in {time.time()-t0:.02f}s")
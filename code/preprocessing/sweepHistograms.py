@@ -0,0 +1,12 @@
+from globals import *
+import database
+import sweep
+
+"""
+This script writes the threshold/distance sweep histograms of timeline_ranged to data/sweep_histograms.npz
+They are used by the app for the live heatmap preview while the threshold or distance slider is dragged
+and for the "contradictions vs threshold" curve of a clicked cell.
+"""
+if __name__ == "__main__":
+    tlr = database.read_timeline_ranged(path_timeline_ranged_db)
+    sweep.build_sweep_histograms(tlr)
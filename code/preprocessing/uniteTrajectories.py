@@ -1,8 +1,10 @@
+import os
 import pandas as pd
 import datetime
 import math
 import numpy as np
 from multiprocessing import Pool
+from globals import path_trajectories_db, data_prefix
 
 
 def compare(traj1, traj2, threshhold=15):
@@ -65,8 +67,6 @@ def newlabel(labels):
     return rer
 
 
-path_trajectories_db = r"../../data/trajectories.parquet"
-
 df = pd.read_parquet(path_trajectories_db)
 
 labels = list()
@@ -102,4 +102,4 @@ for to_cluster in matches:
     clustered = clustered.reset_index().set_index(['label', 'time']).sort_index()
     new_trajectories.append(clustered)
 
-pd.concat(new_trajectories).to_parquet('../data/clustered.parquet', engine='pyarrow')
+pd.concat(new_trajectories).to_parquet(os.path.join(data_prefix, 'clustered.parquet'), engine='pyarrow')
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+from globals import *
+
+
+def data_fingerprint(paths=None):
+    """
+    Computes a fingerprint of the input data files from their names, sizes and modification times and of the result
+    format version. Any change to one of the files (e.g. a re-run of the preprocessing) or to the format of the cached
+    results (globals.result_format_version) yields a different fingerprint.
+
+    @param paths: List of file paths to include, default are the files listed in globals.result_cache_inputs.
+    @return: Hex digest string identifying the current state of the input data.
+    """
+    if paths is None:
+        paths = result_cache_inputs
+    digest = hashlib.sha1()
+    digest.update(f"format:{result_format_version}".encode())
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        try:
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        except FileNotFoundError:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk store for computed heatmap layers and time distributions.
+    Results are kept in a SQLite file, so every worker process and every restart of the app shares them.
+    Entries are bound to the fingerprint of the input data and evicted least-recently-used once the store exceeds max_bytes.
+    """
+
+    def __init__(self, path=path_result_cache, max_bytes=result_cache_max_bytes, fingerprint=None):
+        """
+        Opens (and if necessary creates) the cache file and drops all entries computed from other input data.
+
+        @param path: Location of the SQLite file.
+        @param max_bytes: Upper bound for the summed size of all stored results in bytes.
+        @param fingerprint: Fingerprint of the input data, computed from the data files if None.
+        @return: None.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fingerprint = data_fingerprint() if fingerprint is None else fingerprint
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT, value BLOB, size INTEGER, last_access REAL)"
+            )
+            # automatic invalidation: results of outdated data are never valid again
+            con.execute("DELETE FROM results WHERE fingerprint != ?", (self.fingerprint,))
+            # requested parameter combinations, kept across data changes to rank the views of the cache warmer
+            con.execute("CREATE TABLE IF NOT EXISTS requests (key TEXT PRIMARY KEY, params TEXT, count INTEGER, last_access REAL)")
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        return con
+
+    @staticmethod
+    def make_key(*params):
+        """
+        Builds the string key of a parameter combination, e.g. (sensor, threshold, start_time, end_time, distance).
+
+        @param params: Parameters identifying a result, they have to have a stable repr.
+        @return: String key.
+        """
+        return repr(tuple(params))
+
+    def get(self, key):
+        """
+        Loads a stored result.
+
+        @param key: Key created with make_key.
+        @return: The stored object or None if there is no valid entry for key.
+        """
+        try:
+            with self._connect() as con:
+                row = con.execute(
+                    "SELECT value FROM results WHERE key = ? AND fingerprint = ?", (key, self.fingerprint)
+                ).fetchone()
+                if row is None:
+                    return None
+                con.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            print(f"Result cache read failed: {e}")
+            return None
+
+    def put(self, key, value):
+        """
+        Stores a result and evicts the least recently used entries if the store grew larger than max_bytes.
+
+        @param key: Key created with make_key.
+        @param value: Picklable result, e.g. the tuple of heatmap layers and the time distribution.
+        @return: None.
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        try:
+            with self._connect() as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO results (key, fingerprint, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, self.fingerprint, sqlite3.Binary(blob), len(blob), time.time()),
+                )
+                self._evict(con)
+        except sqlite3.Error as e:
+            print(f"Result cache write failed: {e}")
+
+    def record_request(self, *params):
+        """
+        Counts a request of a parameter combination for the ranking of frequent_requests().
+
+        @param params: (sensor, threshold, start_time, end_time, distance) with datetimes for the times.
+        @return: None.
+        """
+        encoded = json.dumps([param.isoformat() if isinstance(param, datetime.datetime) else param for param in params])
+        try:
+            with self._connect() as con:
+                con.execute(
+                    "INSERT INTO requests (key, params, count, last_access) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET count = count + 1, last_access = excluded.last_access",
+                    (self.make_key(*params), encoded, time.time()),
+                )
+        except sqlite3.Error as e:
+            print(f"Request log write failed: {e}")
+
+    def frequent_requests(self, limit):
+        """
+        The most requested parameter combinations, see record_request().
+
+        @param limit: Maximal number of combinations.
+        @return: List of parameter tuples, most requested (then most recent) first.
+        """
+        try:
+            with self._connect() as con:
+                rows = con.execute("SELECT params FROM requests ORDER BY count DESC, last_access DESC LIMIT ?", (limit,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Request log read failed: {e}")
+            return []
+        decoded = []
+        for (params,) in rows:
+            sensor, threshold, start_time, end_time, distance = json.loads(params)
+            decoded.append(
+                (sensor, threshold, datetime.datetime.fromisoformat(start_time), datetime.datetime.fromisoformat(end_time), distance)
+            )
+        return decoded
+
+    def _evict(self, con):
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in con.execute("SELECT key, size FROM results ORDER BY last_access ASC").fetchall():
+            con.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        """Removes all entries."""
+        with self._connect() as con:
+            con.execute("DELETE FROM results")
@@ -0,0 +1,173 @@
+import time
+import numpy
+import pandas
+from globals import *
+
+"""
+Threshold- and distance-sweep histograms per tree cell.
+
+For every (day, cell) on the levels in globals.sweep_levels and every sensor, a 2D table holds the number of
+contradictions for a grid of thresholds and distances:
+    hist[entry, sensor, k, i] = number of rows with s >= k * threshold_step[sensor] and rmin <= i * sweep_distance_step < rmax
+The thresholds are quantized into sweep_threshold_bins bins between 0 and the maximal threshold of each sensor,
+counts saturate at 65535. With these tables the heatmap and "contradictions vs threshold" curves can be shown for
+any threshold and distance without querying timeline_ranged.
+"""
+
+
+def grid():
+    """
+    Output: threshold step per sensor (array of 7), number of threshold bins, distance grid points in km
+    """
+    threshold_steps = numpy.array(sensor_threshold_max) / sweep_threshold_bins
+    distance_points = numpy.arange(int(round(max_distance_threshold / sweep_distance_step)) + 1) * sweep_distance_step
+    return threshold_steps, sweep_threshold_bins, distance_points
+
+
+def _day_histograms(tlr, level, threshold_steps, n_thresholds, n_distances):
+    """Histograms of the rows of tlr (one day) on level, returns (cells, hist)"""
+    cells, cell_index = numpy.unique(cell_ancestor(tlr.cell.values, level), return_inverse=True)
+    rmin = tlr.rmin.values * distance_unit
+    rmax = tlr.rmax.values * distance_unit
+    # grid point i is valid for a row if rmin <= i * step < rmax, the end is encoded as difference -1
+    first = numpy.clip(numpy.ceil(rmin / sweep_distance_step - 1e-9), 0, n_distances).astype(numpy.int64)
+    last = numpy.clip(numpy.ceil(rmax / sweep_distance_step - 1e-9), 0, n_distances).astype(numpy.int64)
+    raw = numpy.zeros((len(cells), 7, n_thresholds, n_distances + 1), dtype=numpy.int32)
+    for j in range(7):
+        s = tlr[f"s{j}"].values.astype(numpy.float64)
+        valid = s > 0
+        k = numpy.clip((s[valid] / threshold_steps[j]).astype(numpy.int64), 0, n_thresholds - 1)
+        numpy.add.at(raw, (cell_index[valid], j, k, first[valid]), 1)
+        numpy.add.at(raw, (cell_index[valid], j, k, last[valid]), -1)
+    # cumulative over the distance grid and reverse cumulative over the threshold bins
+    hist = numpy.cumsum(raw, axis=3)[:, :, :, :n_distances]
+    hist = numpy.flip(numpy.cumsum(numpy.flip(hist, axis=2), axis=2), axis=2)
+    return cells, numpy.minimum(hist, 65535).astype(numpy.uint16)
+
+
+def build_sweep_histograms(tlr, path=path_sweep_histograms):
+    """
+    Computes the sweep histograms day by day and writes them as compressed npz file.
+
+    @param tlr: timeline_ranged DataFrame in the compact schema (see database.compact_timeline_ranged).
+    @param path: Output file.
+    @return: None.
+    """
+    t0 = time.time()
+    threshold_steps, n_thresholds, distance_points = grid()
+    n_distances = len(distance_points)
+    days = tlr.hour.values.astype(numpy.int64) // 24
+    result = {"threshold_steps": threshold_steps, "distance_points": distance_points}
+    for level in sweep_levels:
+        level_cells, level_days, level_hists = [], [], []
+        for day, rows in tlr.groupby(days).indices.items():
+            cells, hist = _day_histograms(tlr.iloc[rows], level, threshold_steps, n_thresholds, n_distances)
+            level_cells.append(cells)
+            level_days.append(numpy.full(len(cells), day, dtype=numpy.int16))
+            level_hists.append(hist)
+        result[f"cells_{level}"] = numpy.concatenate(level_cells) if level_cells else numpy.array([], dtype=numpy.uint64)
+        result[f"days_{level}"] = numpy.concatenate(level_days) if level_days else numpy.array([], dtype=numpy.int16)
+        result[f"hist_{level}"] = (
+            numpy.concatenate(level_hists) if level_hists else numpy.zeros((0, 7, n_thresholds, n_distances), dtype=numpy.uint16)
+        )
+        print(f"Level {level}: {len(result[f'cells_{level}'])} (day, cell) entries, {result[f'hist_{level}'].nbytes / 2**20:.1f} MiB")
+    numpy.savez_compressed(path, **result)
+    print(f"Sweep histograms built in {time.time()-t0:.02f}s")
+
+
+def update_sweep_histograms(tlr, days, path=path_sweep_histograms):
+    """
+    Recomputes the sweep histograms of some days (e.g. after new hours were appended) and keeps all other days.
+
+    @param tlr: timeline_ranged DataFrame in the compact schema, only the rows of the given days are used.
+    @param days: Day offsets from time_epoch (hour // 24) to recompute.
+    @param path: Existing npz file, it is rewritten.
+    @return: None.
+    """
+    t0 = time.time()
+    data = dict(numpy.load(path))
+    threshold_steps, n_thresholds, distance_points = grid()
+    n_distances = len(distance_points)
+    hours = tlr.hour.values.astype(numpy.int64)
+    rows = numpy.isin(hours // 24, numpy.asarray(days))
+    tlr_days = tlr[rows]
+    day_index = hours[rows] // 24
+    for level in sweep_levels:
+        keep = ~numpy.isin(data[f"days_{level}"], numpy.asarray(days))
+        level_cells, level_days, level_hists = [data[f"cells_{level}"][keep]], [data[f"days_{level}"][keep]], [data[f"hist_{level}"][keep]]
+        for day, day_rows in tlr_days.groupby(day_index).indices.items():
+            cells, hist = _day_histograms(tlr_days.iloc[day_rows], level, threshold_steps, n_thresholds, n_distances)
+            level_cells.append(cells)
+            level_days.append(numpy.full(len(cells), day, dtype=numpy.int16))
+            level_hists.append(hist)
+        data[f"cells_{level}"] = numpy.concatenate(level_cells).astype(numpy.uint64)
+        data[f"days_{level}"] = numpy.concatenate(level_days)
+        data[f"hist_{level}"] = numpy.concatenate(level_hists)
+    numpy.savez_compressed(path, **data)
+    print(f"Sweep histograms of {len(days)} days updated in {time.time()-t0:.02f}s")
+
+
+class SweepHistograms:
+    """Read access to the sweep histograms written by build_sweep_histograms()"""
+
+    def __init__(self, path=path_sweep_histograms):
+        data = numpy.load(path)
+        self.threshold_steps = data["threshold_steps"]
+        self.distance_points = data["distance_points"]
+        self.n_thresholds = sweep_threshold_bins
+        self.levels = dict()
+        for level in sweep_levels:
+            self.levels[level] = (data[f"cells_{level}"], data[f"days_{level}"], data[f"hist_{level}"])
+
+    def threshold_index(self, sensor_index, threshold):
+        """Index of the first threshold bin whose lower edge is at least threshold"""
+        k = int(numpy.ceil(threshold / self.threshold_steps[sensor_index] - 1e-9))
+        return min(max(k, 0), self.n_thresholds - 1)
+
+    def distance_index(self, distance):
+        """Index of the distance grid point nearest to distance"""
+        return int(numpy.abs(self.distance_points - distance).argmin())
+
+    def _select(self, level, start_time, end_time):
+        cells, days, hist = self.levels[level]
+        first_day = (start_time - time_epoch).days
+        last_day = (end_time - time_epoch).days
+        selection = (days >= first_day) & (days <= last_day)
+        return cells[selection], hist[selection]
+
+    def counts(self, level, sensor_index, threshold, distance, start_time, end_time):
+        """
+        Approximate contradiction counts per cell without a query.
+
+        @param level: Tree level, one of globals.sweep_levels.
+        @param sensor_index: Index of the sensor (0..6).
+        @param threshold: Sensor threshold, rounded up to the next threshold bin.
+        @param distance: Distance threshold in km, rounded to the nearest grid point.
+        @param start_time: Start of the interval, only whole days are considered.
+        @param end_time: End of the interval.
+        @return: Series of counts indexed by cell code.
+        """
+        cells, hist = self._select(level, start_time, end_time)
+        values = hist[:, sensor_index, self.threshold_index(sensor_index, threshold), self.distance_index(distance)].astype(numpy.int64)
+        counts = pandas.Series(values, index=cells).groupby(level=0).sum()
+        return counts[counts > 0]
+
+    def threshold_curve(self, level, cell, sensor_index, distance, start_time, end_time):
+        """
+        Contradictions vs threshold for a single cell.
+
+        @return: Tuple (thresholds, counts) of arrays of length sweep_threshold_bins.
+        """
+        cells, hist = self._select(level, start_time, end_time)
+        curve = hist[cells == cell][:, sensor_index, :, self.distance_index(distance)].astype(numpy.int64).sum(axis=0)
+        return numpy.arange(self.n_thresholds) * self.threshold_steps[sensor_index], curve
+
+    def distance_curve(self, level, cell, sensor_index, threshold, start_time, end_time):
+        """
+        Contradictions vs distance for a single cell.
+
+        @return: Tuple (distances, counts) of arrays with one entry per distance grid point.
+        """
+        cells, hist = self._select(level, start_time, end_time)
+        curve = hist[cells == cell][:, sensor_index, self.threshold_index(sensor_index, threshold), :].astype(numpy.int64).sum(axis=0)
+        return self.distance_points, curve
@@ -0,0 +1,164 @@
+import argparse
+import pickle
+import time
+import numpy
+import pandas
+from globals import *
+
+"""
+Generates a synthetic dataset with the same schema as the real one in data/:
+sensors.parquet, sensors_metadata.csv, timeline.parquet, trajectories.parquet, timeline_ranged.parquet,
+clustered-10km.parquet and rangedict.pickle.
+The scale is given by the number of trajectory labels and the number of hours (starting 2013-06-01 00:00).
+Run the app or the benchmarks on it by setting OTV_DATA_PREFIX to the output directory.
+
+Usage: python synthetic.py OUTPUT_DIR [--labels N] [--hours H] [--seed S]
+"""
+
+# name, long_name, units, mean, standard deviation of the generated sensor values
+sensor_spec = [
+    ("sensor_1", "Salinity", "PSU", 30.0, 3.0),
+    ("sensor_2", "Temperature", "Degree Celsius", 15.0, 2.0),
+    ("sensor_3", "CDOM", "ug/l", 20.0, 10.0),
+    ("sensor_4", "Chlorophyll", "arb. unit", 5.0, 3.0),
+    ("sensor_5", "DO", "umol", 250.0, 30.0),
+    ("sensor_6", "DOSat", "percent", 100.0, 10.0),
+    ("sensor_7", "DO_Anomaly", "umol", 0.0, 20.0),
+]
+
+start_time = datetime.datetime(2013, 6, 1)
+tree_depth = 12
+
+
+def float32_inside(values, low, high):
+    """
+    Casts values to float32 and clips them to [low, high) in float32, e.g. float32(7.2) is below 7.2 and would lie
+    outside the area of interest.
+
+    @param values: Array of coordinates.
+    @param low: Smallest allowed value.
+    @param high: Values must be smaller.
+    @return: float32 array.
+    """
+    lowest, highest = numpy.float32(low), numpy.float32(high)
+    while lowest < low:
+        lowest = numpy.nextafter(lowest, numpy.float32(numpy.inf))
+    while highest >= high:
+        highest = numpy.nextafter(highest, numpy.float32(-numpy.inf))
+    return numpy.clip(numpy.asarray(values).astype(numpy.float32), lowest, highest)
+
+
+def generate(output_dir, n_labels=500, n_hours=48, seed=0, neighbour_rate=0.3):
+    """
+    Writes a synthetic dataset to output_dir.
+
+    @param output_dir: Target directory, created if necessary.
+    @param n_labels: Number of trajectories.
+    @param n_hours: Number of hours starting 2013-06-01, at most 65535 (hour offsets are stored as uint16).
+    @param seed: Seed of the random generator.
+    @param neighbour_rate: Share of (time, label) pairs that have neighbours in timeline_ranged.
+    @return: Dictionary with the number of rows written per file.
+    """
+    if n_hours > numpy.iinfo(numpy.uint16).max:
+        raise ValueError("Hour offsets are stored as uint16, n_hours must be at most 65535")
+    os.makedirs(output_dir, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    labels = numpy.arange(1, n_labels + 1, dtype=numpy.int64) * 10 + rng.integers(0, 10, n_labels)
+    times = pandas.date_range(start_time, periods=n_hours, freq="H")
+
+    # sensors + metadata
+    sensors = pandas.DataFrame(
+        {
+            "time": pandas.Timestamp(2013, 6, 1) + pandas.to_timedelta(rng.integers(0, 30 * 24, n_labels), unit="h"),
+            "longitude": float32_inside(rng.uniform(lon_west, lon_east, n_labels), lon_west, lon_east),
+            "latitude": float32_inside(rng.uniform(lat_south, lat_north, n_labels), lat_south, lat_north),
+        },
+        index=pandas.Index(labels, name="label"),
+    )
+    for name, long_name, units, mean, std in sensor_spec:
+        values = rng.normal(mean, std, n_labels)
+        values[rng.random(n_labels) < 0.05] = numpy.nan
+        sensors[long_name] = values
+    meta = pandas.DataFrame(
+        [(long_name, units) for _, long_name, units, _, _ in sensor_spec],
+        columns=["long_name", "units"],
+        index=pandas.Index([name for name, _, _, _, _ in sensor_spec], name="name"),
+    )
+
+    # trajectories: random walks inside the area of interest
+    steps = rng.normal(0, 0.01, (n_hours, n_labels, 2))
+    steps[0] = 0
+    lon = float32_inside(sensors.longitude.values + numpy.cumsum(steps[:, :, 0], axis=0), lon_west, lon_east)
+    lat = float32_inside(sensors.latitude.values + numpy.cumsum(steps[:, :, 1], axis=0), lat_south, lat_north)
+    timeline = pandas.DataFrame(
+        {"longitude": lon.ravel(), "latitude": lat.ravel()},
+        index=pandas.MultiIndex.from_product([times, labels], names=["time", "label"]),
+    )
+    trajectories = timeline.reset_index().set_index(["label", "time"]).sort_index()
+
+    # timeline_ranged: 1-3 distance bands per (time, label) pair with neighbours
+    pairs = timeline.reset_index()
+    pairs = pairs[rng.random(len(pairs)) < neighbour_rate].reset_index(drop=True)
+    bands = rng.integers(1, 4, len(pairs))
+    tlr = pairs.loc[numpy.repeat(pairs.index.values, bands)].reset_index()
+    tlr["rmin"] = rng.uniform(0, max_distance_threshold, len(tlr)).astype(numpy.float32)
+    tlr = tlr.sort_values(["index", "rmin"]).reset_index(drop=True)
+    next_rmin = tlr.groupby("index").rmin.shift(-1)
+    tlr["rmax"] = next_rmin.fillna(max_distance_threshold + 0.0001).astype(numpy.float32)
+    for j, (_, _, _, _, std) in enumerate(sensor_spec):
+        tlr[f"s{j}"] = rng.exponential(std / 2, len(tlr)).astype(numpy.float32)
+        tlr[f"s{j}"] = tlr.groupby("index")[f"s{j}"].cummax()
+    tlr["id"] = tlr.time.dt.strftime("%d%H") + tlr.label.astype(str)
+    tlr["treecode"] = treecodes(tlr.longitude.values, tlr.latitude.values, tree_depth)
+    tlr = tlr.drop(columns=["index"])[
+        ["time", "label", "longitude", "latitude", "rmin", "rmax", "s0", "s1", "s2", "s3", "s4", "s5", "s6", "id", "treecode"]
+    ]
+
+    # clustered trajectories: groups of 5 consecutive labels with their mean track, labelled like uniteTrajectories.newlabel()
+    groups = numpy.arange(n_labels) // 5
+    group_labels = {g: "".join(str(label) for label in labels[groups == g]) for g in numpy.unique(groups)}
+    clustered = trajectories.reset_index()
+    clustered["label"] = groups[numpy.searchsorted(labels, clustered.label.values)]
+    clustered = clustered.groupby(["label", "time"]).agg(
+        longitude=("longitude", "mean"), latitude=("latitude", "mean"), weight=("longitude", "size")
+    )
+    clustered = clustered.rename(index=group_labels, level="label")
+
+    # range dict: bounds of every cell that appears as a prefix of a treecode
+    rdict = dict()
+    for code in numpy.unique(tlr.treecode.values):
+        for level in range(1, tree_depth + 1):
+            prefix = code[0 : 3 * level]
+            if prefix not in rdict:
+                rdict[prefix] = treecode_region(prefix)
+
+    sensors.to_parquet(os.path.join(output_dir, sensors_suffix))
+    meta.to_csv(os.path.join(output_dir, sensor_metadata_suffix))
+    timeline.to_parquet(os.path.join(output_dir, timeline_suffix), engine="pyarrow")
+    trajectories.to_parquet(os.path.join(output_dir, trajectories_suffix), engine="pyarrow")
+    tlr.to_parquet(os.path.join(output_dir, timeline_ranged_suffix))
+    clustered.to_parquet(os.path.join(output_dir, clustered_suffix), engine="pyarrow")
+    with open(os.path.join(output_dir, range_dict_suffix), "wb") as f:
+        pickle.dump(rdict, f)
+    return {
+        "sensors": len(sensors),
+        "timeline": len(timeline),
+        "timeline_ranged": len(tlr),
+        "trajectories": len(trajectories),
+        "clustered": len(clustered),
+        "rangedict": len(rdict),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset with the schema of data/")
+    parser.add_argument("output_dir")
+    parser.add_argument("--labels", type=int, default=500)
+    parser.add_argument("--hours", type=int, default=48)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    t0 = time.time()
+    counts = generate(args.output_dir, args.labels, args.hours, args.seed)
+    for name, count in counts.items():
+        print(f"{name}: {count} rows")
+    print(f"Synthetic data generated in {time.time()-t0:.02f}s")
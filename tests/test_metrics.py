@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import metrics
+
+
+def test_span_past_last_bucket(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "_histograms", dict())
+    monkeypatch.setattr(metrics, "_counters", dict())
+    metrics.observe("test_stage", 0.001, stage="a")
+    metrics.observe("test_stage", metrics.buckets[-1] * 2, stage="a")
+
+    lines = dict(line.rsplit(" ", 1) for line in metrics.prometheus_text().splitlines() if not line.startswith("#"))
+    assert float(lines['otv_test_stage_seconds_sum{stage="a"}']) == metrics.buckets[-1] * 2 + 0.001
+    assert lines['otv_test_stage_seconds_count{stage="a"}'] == "2"
+    assert lines[f'otv_test_stage_seconds_bucket{{stage="a",le="{metrics.buckets[-1]}"}}'] == "1"
+    assert lines['otv_test_stage_seconds_bucket{stage="a",le="+Inf"}'] == "2"